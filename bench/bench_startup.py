@@ -0,0 +1,65 @@
+"""
+Cold start benchmark of the Cloud Functions entry point.
+Each sample runs in a new Python process and measures import time of src/main.py
+and latency of the first cloud_functions_main call.
+src/conf/config.py and GCP credentials are needed.
+
+    python bench/bench_startup.py
+    python bench/bench_startup.py --payload '{"action": "backup_dataset", "dataset": "myds"}' -n 10
+
+The default payload is an unknown action, which initializes only logging (error path).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+app_home = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CHILD_CODE = """
+import json
+import sys
+import time
+start = time.perf_counter()
+sys.path.insert(0, {app_home!r})
+import main
+imported = time.perf_counter()
+
+
+class Request(object):
+    def get_json(self):
+        return {payload!r}
+
+
+status = main.cloud_functions_main(Request())[1]
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "first_request": done - imported, "status": status}}))
+"""
+
+
+def run_sample(payload) -> dict:
+    code = CHILD_CODE.format(app_home=os.path.abspath(app_home), payload=payload)
+    out = subprocess.run([sys.executable, "-c", code], cwd=app_home, stdout=subprocess.PIPE, check=True)
+    # the last line. logging may print before it
+    return json.loads(out.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payload", default='{"action": "unknown"}', help="JSON body of the request")
+    parser.add_argument("-n", type=int, default=5, help="number of samples (new process each)")
+    args = parser.parse_args()
+    payload = json.loads(args.payload)
+    sample_list = [run_sample(payload) for _ in range(args.n)]
+    print(f"payload={args.payload} samples={args.n} status={sorted(set(s['status'] for s in sample_list))}")
+    print(f"{'phase':>14} {'min(ms)':>10} {'median(ms)':>10} {'max(ms)':>10}")
+    for phase in ["import", "first_request"]:
+        sec_list = [s[phase] for s in sample_list]
+        print(f"{phase:>14} {min(sec_list) * 1000:>10.1f} {statistics.median(sec_list) * 1000:>10.1f}"
+              f" {max(sec_list) * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
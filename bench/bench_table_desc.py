@@ -0,0 +1,240 @@
+"""
+Micro-benchmark of TableDesc / DatasetDesc hot paths, which run once or more per table in backup and restore.
+Each operation is measured on synthetic flat and nested schemas of 10 to 100k fields:
+time per call (best of repeats) and allocations per call (tracemalloc peak and number of blocks).
+Time per field should stay flat as the number of fields grows.
+
+    python bench/bench_table_desc.py                    # print results
+    python bench/bench_table_desc.py --save-baseline    # update bench/baseline_table_desc.json
+    python bench/bench_table_desc.py --check            # exit 1 if slower than baseline by --threshold
+
+Each time is also normalized by a fixed calibration workload measured right before it, so that a baseline taken
+on another (or a busy) machine can be compared. Allocations do not depend on the machine.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+app_home = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(os.path.join(app_home))
+from lib.dataset_desc import DatasetDesc
+from lib.table_desc import TableDesc
+
+NUM_OF_FIELDS_LIST = [10, 100, 1000, 10000, 100000]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_table_desc.json")
+# each case is repeated until this seconds pass (at least MIN_REPEAT times), and the best is taken
+MIN_TOTAL_SEC = 0.2
+MIN_REPEAT = 3
+# cases faster than this are compared by allocations only, time of them is mostly noise
+MIN_CHECKED_US = 20
+# regressed cases are measured again this times (and the best is taken), not to fail by a noisy neighbor
+NUM_OF_RECHECK = 2
+# allocations smaller than these are noise of tracemalloc itself, and are not compared
+MIN_CHECKED_KIB = 16
+MIN_CHECKED_BLOCKS = 100
+
+
+def make_table_dict(num_of_fields, desc_prefix):
+    """
+    :param desc_prefix: None means no description at all
+    """
+    def desc(name):
+        return {} if desc_prefix is None else {'description': f'{desc_prefix} {name}'}
+    return dict({
+        'schema': {'fields': [dict({'name': f'col{i}', 'type': 'STRING', 'mode': 'NULLABLE'}, **desc(f'col{i}'))
+                              for i in range(num_of_fields)]},
+        'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+    }, **desc('table'))
+
+
+def make_nested_table_dict(num_of_fields, desc_prefix, leaves_per_record=10):
+    """
+    Event table like schema. RECORD columns with leaves_per_record leaves each (num_of_fields leaves in total).
+    """
+    def desc(name):
+        return {} if desc_prefix is None else {'description': f'{desc_prefix} {name}'}
+    return dict({
+        'schema': {'fields': [dict({'name': f'rec{r}', 'type': 'RECORD', 'mode': 'REPEATED', 'fields': [
+            dict({'name': f'col{i}', 'type': 'STRING'}, **desc(f'rec{r}.col{i}'))
+            for i in range(leaves_per_record)]}, **desc(f'rec{r}'))
+            for r in range(max(1, num_of_fields // leaves_per_record))]},
+        'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+    }, **desc('table'))
+
+
+def make_case_list():
+    """
+    :return: [(case key, number of fields, func)]
+    """
+    case_list = []
+    for schema, make_func in [("flat", make_table_dict), ("nested", make_nested_table_dict)]:
+        for num_of_fields in NUM_OF_FIELDS_LIST:
+            now_dict = make_func(num_of_fields, 'now')
+            new_dict = make_func(num_of_fields, 'new')
+            now_table_desc = TableDesc(now_dict)
+            new_table_desc = TableDesc(new_dict)
+            no_desc_table_desc = TableDesc(make_func(num_of_fields, None))
+            for name, func in [
+                ("__init__", lambda d=now_dict: TableDesc(d)),
+                ("to_dict", now_table_desc.to_dict),
+                ("content_hash", now_table_desc.content_hash),
+                ("check_diff", lambda n=now_table_desc, w=new_table_desc: w.check_diff(n)),
+                ("update_description", lambda n=now_table_desc, w=new_table_desc: n.update_description(w)),
+                # worst case: all fields are scanned
+                ("is_no_description", no_desc_table_desc.is_no_description),
+                ("num_of_field_desc", now_table_desc.num_of_field_desc),
+            ]:
+                case_list.append((f"TableDesc.{name}/{schema}/{num_of_fields}", num_of_fields, func))
+    dataset_dict = {"description": "dataset", "datasetReference": {"projectId": "a", "datasetId": "b"}}
+    dataset_desc = DatasetDesc(dataset_dict)
+    for name, func in [("__init__", lambda: DatasetDesc(dataset_dict)),
+                       ("to_dict", dataset_desc.to_dict),
+                       ("content_hash", dataset_desc.content_hash),
+                       ("is_no_description", dataset_desc.is_no_description)]:
+        case_list.append((f"DatasetDesc.{name}", 1, func))
+    return case_list
+
+
+def measure_time(func) -> float:
+    """
+    :return: best seconds per call
+    """
+    best = float("inf")
+    num_of_repeat = 0
+    start = time.perf_counter()
+    # small cases are looped, so that one sample is long enough for the timer
+    num_of_loop = 1
+    while True:
+        sample_start = time.perf_counter()
+        for _ in range(num_of_loop):
+            func()
+        sample_sec = time.perf_counter() - sample_start
+        if sample_sec < 0.001 and num_of_repeat == 0:
+            num_of_loop *= 10
+            continue
+        best = min(best, sample_sec / num_of_loop)
+        num_of_repeat += 1
+        if num_of_repeat >= MIN_REPEAT and time.perf_counter() - start >= MIN_TOTAL_SEC:
+            return best
+
+
+def measure_alloc(func) -> (int, int):
+    """
+    :return: (peak bytes, number of memory blocks still alive after the call, including the return value)
+        allocated by one call
+    """
+    tracemalloc.start()
+    try:
+        func()  # warm up (caches, interned strings)
+        # clear_traces also resets the peak
+        tracemalloc.clear_traces()
+        base_bytes, _ = tracemalloc.get_traced_memory()
+        base_blocks = _num_of_blocks()
+        ret = func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        num_of_blocks = _num_of_blocks() - base_blocks
+        del ret
+    finally:
+        tracemalloc.stop()
+    return max(0, peak_bytes - base_bytes), max(0, num_of_blocks)
+
+
+def _num_of_blocks() -> int:
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+
+
+def calibrate() -> float:
+    """
+    Seconds of a fixed pure Python workload (dict and str building), used to normalize times across machines.
+    """
+    def workload():
+        fields = [{"name": f"col{i}", "description": f"d{i}"} for i in range(10000)]
+        return {f["name"]: f["description"].upper() for f in fields}
+    return measure_time(workload)
+
+
+def run(filter_str=None, key_set=None) -> dict:
+    result_dict = {}
+    for key, num_of_fields, func in make_case_list():
+        if (filter_str and filter_str not in key) or (key_set is not None and key not in key_set):
+            continue
+        calibration_sec = calibrate()
+        sec = measure_time(func)
+        peak_bytes, num_of_blocks = measure_alloc(func)
+        result_dict[key] = {"fields": num_of_fields, "us_per_call": round(sec * 1e6, 3),
+                            "ns_per_field": round(sec * 1e9 / num_of_fields, 1),
+                            "normalized": float(f"{sec / calibration_sec:.4g}"),
+                            "peak_kib": round(peak_bytes / 1024, 1), "blocks": num_of_blocks}
+        print(f"{key:>40} {sec * 1e6:>12.1f}us {sec * 1e9 / num_of_fields:>9.1f}ns/field"
+              f" {peak_bytes / 1024:>10.1f}KiB {num_of_blocks:>8} blocks", file=sys.stderr)
+    return result_dict
+
+
+def check(result_dict, baseline, threshold, verbose=False) -> list:
+    """
+    :return: list of (key, message) of regressions. A case regresses if its normalized time or its allocations
+        are more than threshold times of the baseline.
+    """
+    regression_list = []
+    if verbose:
+        print(f"{'case':>40} {'time':>8} {'peak':>8} {'blocks':>8}   (ratio to baseline)")
+    for key, result in result_dict.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        time_ratio = result["normalized"] / base["normalized"]
+        peak_ratio = result["peak_kib"] / max(base["peak_kib"], MIN_CHECKED_KIB)
+        blocks_ratio = result["blocks"] / max(base["blocks"], MIN_CHECKED_BLOCKS)
+        status = ""
+        if base["us_per_call"] >= MIN_CHECKED_US and time_ratio > threshold:
+            status = " SLOWER"
+            regression_list.append((key, f"{key} time x{time_ratio:.2f}"))
+        if max(peak_ratio, blocks_ratio) > threshold:
+            status += " MORE ALLOCATION"
+            regression_list.append((key, f"{key} allocation x{max(peak_ratio, blocks_ratio):.2f}"))
+        if verbose:
+            print(f"{key:>40} {time_ratio:>8.2f} {peak_ratio:>8.2f} {blocks_ratio:>8.2f}{status}")
+    return regression_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", help="run only cases whose key contains this string. e.g. check_diff/nested")
+    parser.add_argument("--save-baseline", action="store_true", help=f"save results to {BASELINE_PATH}")
+    parser.add_argument("--check", action="store_true", help="compare with the baseline and exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="regression if time or allocation is more than this times of the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    result_dict = run(args.filter)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "results": result_dict}, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print(f"saved {args.baseline}")
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regression_list = check(result_dict, baseline, args.threshold)
+        for _ in range(NUM_OF_RECHECK):
+            if not regression_list:
+                break
+            print(f"measuring {len(regression_list)} regressed cases again", file=sys.stderr)
+            for key, result in run(key_set={key for key, _ in regression_list}).items():
+                if result["normalized"] < result_dict[key]["normalized"]:
+                    result_dict[key] = result
+            regression_list = check(result_dict, baseline, args.threshold)
+        regression_list = check(result_dict, baseline, args.threshold, verbose=True)
+        if regression_list:
+            print(f"REGRESSION (threshold x{args.threshold}):\n  " + "\n  ".join(m for _, m in regression_list))
+            sys.exit(1)
+        print("no regression")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,773 @@
+"""
+Offline load harness of controller actions.
+BigQuery and FireStore clients are replaced with in-process fakes, so whole "backup all" / "restore all" runs
+can be measured without GCP access, and compared across commits.
+
+- Catalog: generated tables (default 100k) with realistic schema widths (log-normal number of fields,
+  nested RECORDs, partly described). Same seed, same catalog.
+- Fakes: per-call latency (log-normal around a median per operation), error injection (500 backendError,
+  retried by the client retry of lib.bigquery) and quota injection (403 rateLimitExceeded above a calls/sec quota,
+  handled by lib.rate_limiter).
+- Scenario: backup all (full) -> modify some tables -> backup all (incremental) -> drift some descriptions
+  -> restore all -> drift again -> restore plan -> restore apply. Each action reports throughput, p50/p99 latency per entity (dataset or table) and API call counts.
+
+google-cloud-* packages of src/requirements.txt are needed (for exception and Table classes), GCP access is not.
+
+    python bench/load_harness.py --out before.json
+    python bench/load_harness.py --tables 5000 --latency-scale 0.2 --compare before.json
+    python bench/load_harness.py --error-rate 0.01 --quota-per-sec 200 --set backup_worker_num=16
+"""
+import argparse
+import ast
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+app_home = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(os.path.join(app_home))
+from google.api_core.exceptions import Forbidden, InternalServerError, NotFound, PreconditionFailed
+
+from conf.config_sample import Config
+from lib.bigquery import Bigquery
+from lib.controller import Controller
+from lib.firestore import Firestore
+
+# median latency of one call (ms). page / commit latency grows with number of items (PER_ITEM_LATENCY_MS)
+BIGQUERY_LATENCY_MS = {"get_table": 60, "get_dataset": 50, "update_table": 250, "update_dataset": 200,
+                       "list_tables": 150, "list_datasets": 120, "list_projects": 100, "query": 1500}
+FIRESTORE_LATENCY_MS = {"get": 15, "set": 25, "update": 25, "delete": 25, "commit": 40, "query": 30, "get_all": 20}
+PER_ITEM_LATENCY_MS = {"commit": 0.2, "query": 0.05, "get_all": 0.05}
+# page size of tables.list / datasets.list
+LIST_PAGE_SIZE = 1000
+LATENCY_SIGMA = 0.3
+
+FIELD_TYPE_LIST = ["STRING", "STRING", "STRING", "INTEGER", "FLOAT", "TIMESTAMP", "BOOLEAN", "DATE", "NUMERIC"]
+STANDARD_TYPE_MAP = {"INTEGER": "INT64", "FLOAT": "FLOAT64", "BOOLEAN": "BOOL"}
+
+
+# -----------------------------------------
+# Catalog
+# -----------------------------------------
+
+class Catalog(object):
+    """
+    Generated BigQuery tables. Table resources are kept pickled, as a real client decodes JSON on each get.
+    Number of fields of a table is log-normal (median median_fields, long tail up to max_fields).
+    """
+
+    def __init__(self, project, num_of_tables, tables_per_dataset, seed, median_fields=20, max_fields=3000):
+        self.project = project
+        self.seed = seed
+        self.median_fields = median_fields
+        self.max_fields = max_fields
+        self.dataset_dict = {}
+        self.table_dict = {}
+        self.now_ms = 1577836800000
+        num_of_datasets = max(1, math.ceil(num_of_tables / tables_per_dataset))
+        for d in range(num_of_datasets):
+            dataset_id = f"ds{d:04d}"
+            self.dataset_dict[dataset_id] = {
+                "datasetReference": {"projectId": project, "datasetId": dataset_id},
+                "description": f"dataset {dataset_id}" if d % 4 else "",
+                "labels": {}, "etag": self._etag(dataset_id)}
+            self.table_dict[dataset_id] = {}
+            for t in range(d * tables_per_dataset, min(num_of_tables, (d + 1) * tables_per_dataset)):
+                table_id = f"t{t:06d}"
+                self.table_dict[dataset_id][table_id] = pickle.dumps(self._make_table(dataset_id, table_id))
+
+    def _rand(self, *key) -> random.Random:
+        return random.Random(zlib.crc32(":".join([str(self.seed)] + list(key)).encode("utf-8")))
+
+    @staticmethod
+    def _etag(*key) -> str:
+        return hashlib.md5(":".join(str(k) for k in key).encode("utf-8")).hexdigest()[:16]
+
+    def _make_table(self, dataset_id, table_id) -> dict:
+        rand = self._rand(dataset_id, table_id)
+        num_of_fields = min(self.max_fields, max(1, int(rand.lognormvariate(math.log(self.median_fields), 1.0))))
+        return {
+            "kind": "bigquery#table",
+            "tableReference": {"projectId": self.project, "datasetId": dataset_id, "tableId": table_id},
+            "description": f"table {table_id} of {dataset_id}" if rand.random() < 0.8 else "",
+            "schema": {"fields": [self._make_field(rand, f"c{i}", 0) for i in range(num_of_fields)]},
+            "type": "TABLE",
+            "numRows": str(rand.randrange(10 ** 7)),
+            "etag": self._etag(dataset_id, table_id, 0),
+            "lastModifiedTime": str(self.now_ms - rand.randrange(10 ** 9)),
+        }
+
+    def _make_field(self, rand, name, depth) -> dict:
+        field = {"name": name, "type": rand.choice(FIELD_TYPE_LIST), "mode": "NULLABLE"}
+        r = rand.random()
+        if depth < 2 and r < 0.1:
+            field["type"] = "RECORD"
+            field["fields"] = [self._make_field(rand, f"{name}_{i}", depth + 1) for i in range(rand.randint(2, 12))]
+        if r > 0.95:
+            field["mode"] = "REPEATED"
+        elif r > 0.85:
+            field["mode"] = "REQUIRED"
+        if rand.random() < 0.6:
+            field["description"] = f"description of {name}"
+        return field
+
+    def touch(self, ratio, change_description, tag):
+        """
+        Modify ratio of tables: bump lastModifiedTime (data load), and if change_description, change description.
+        :return: number of modified tables
+        """
+        num_of_modified = 0
+        self.now_ms += 3600 * 1000
+        for dataset_id, table_pickle_dict in self.table_dict.items():
+            for table_id in table_pickle_dict.keys():
+                if self._rand(tag, dataset_id, table_id).random() >= ratio:
+                    continue
+                table = pickle.loads(table_pickle_dict[table_id])
+                table["lastModifiedTime"] = str(self.now_ms)
+                table["etag"] = self._etag(dataset_id, table_id, tag)
+                if change_description:
+                    table["description"] = f"{tag} {table['description']}"
+                table_pickle_dict[table_id] = pickle.dumps(table)
+                num_of_modified += 1
+        return num_of_modified
+
+    def num_of_tables(self) -> int:
+        return sum(len(t) for t in self.table_dict.values())
+
+
+# -----------------------------------------
+# Fault injection
+# -----------------------------------------
+
+class Injector(object):
+    """
+    Latency, error and quota injection of one service, and call counts per operation. Thread safe.
+    """
+
+    def __init__(self, latency_ms_dict, latency_scale=1.0, error_rate=0.0, quota_per_sec=0, seed=0):
+        self.latency_ms_dict = latency_ms_dict
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.quota_per_sec = quota_per_sec
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_sec = None
+        self.window_calls = 0
+        self.stats_dict = {}
+
+    def draw(self, op, num_of_items=0) -> float:
+        """
+        Count a call, and raise an injected error or return latency (sec) of the call.
+        """
+        with self.lock:
+            stats = self.stats_dict.setdefault(op, {"calls": 0, "items": 0, "errors": 0, "quota_errors": 0})
+            stats["calls"] += 1
+            stats["items"] += num_of_items
+            now_sec = int(time.monotonic())
+            if now_sec != self.window_sec:
+                self.window_sec, self.window_calls = now_sec, 0
+            self.window_calls += 1
+            if self.quota_per_sec and self.window_calls > self.quota_per_sec:
+                stats["quota_errors"] += 1
+                raise Forbidden(f"injected quota error of {op}", errors=[{"reason": "rateLimitExceeded"}])
+            if self.rand.random() < self.error_rate:
+                stats["errors"] += 1
+                raise InternalServerError(f"injected error of {op}", errors=[{"reason": "backendError"}])
+            latency_ms = self.latency_ms_dict.get(op, 10) * self.rand.lognormvariate(0, LATENCY_SIGMA) + \
+                PER_ITEM_LATENCY_MS.get(op, 0) * num_of_items
+        return latency_ms * self.latency_scale / 1000
+
+    def call(self, op, num_of_items=0):
+        time.sleep(self.draw(op, num_of_items))
+
+    def take_stats(self) -> dict:
+        with self.lock:
+            stats_dict, self.stats_dict = self.stats_dict, {}
+        return stats_dict
+
+
+# -----------------------------------------
+# Fake BigQuery client
+# -----------------------------------------
+
+class Item(object):
+    """
+    List item / query row / reference / API resource. Attributes and row["key"] access.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def table(self, table_id):
+        return Item(project=self.project, dataset_id=self.dataset_id, table_id=table_id)
+
+    def to_api_repr(self) -> dict:
+        return self.resource
+
+
+class FakeBigqueryClient(object):
+    """
+    Fake of the part of bigquery.Client used by lib.bigquery. retry arguments are honored, as the real client does.
+    Supported queries are __TABLES__ and the INFORMATION_SCHEMA query of lib.bulk_metadata.
+    """
+
+    def __init__(self, catalog: Catalog, injector: Injector):
+        self.catalog = catalog
+        self.injector = injector
+        self.lock = threading.Lock()
+        self.etag_seq = 0
+
+    def _call(self, op, func, retry=None, num_of_items=0):
+        def do():
+            self.injector.call(op, num_of_items)
+            return func()
+        return retry(do)() if retry is not None else do()
+
+    def dataset(self, dataset_id):
+        return Item(project=self.catalog.project, dataset_id=dataset_id)
+
+    def list_projects(self, retry=None):
+        return self._call("list_projects", lambda: [Item(project_id=self.catalog.project)], retry)
+
+    def list_datasets(self, filter=None, retry=None):
+        # label filter is not supported (no labels in the catalog)
+        dataset_id_list = sorted(self.catalog.dataset_dict.keys())
+        return self._call("list_datasets", lambda: [Item(dataset_id=d, labels={}) for d in dataset_id_list], retry,
+                          num_of_items=math.ceil(len(dataset_id_list) / LIST_PAGE_SIZE))
+
+    def list_tables(self, dataset_ref, retry=None):
+        table_id_list = sorted(self._table_pickle_dict(dataset_ref.dataset_id).keys())
+        return self._call("list_tables", lambda: [Item(table_id=t, labels={}) for t in table_id_list], retry,
+                          num_of_items=math.ceil(len(table_id_list) / LIST_PAGE_SIZE))
+
+    def get_dataset(self, dataset_ref, retry=None):
+        return self._call("get_dataset", lambda: Item(resource=copy.deepcopy(
+            self._dataset_resource(dataset_ref.dataset_id))), retry)
+
+    def update_dataset(self, dataset, fields, retry=None):
+        def update():
+            with self.lock:
+                resource = self._dataset_resource(dataset.dataset_id)
+                if dataset.etag and dataset.etag != resource["etag"]:
+                    raise PreconditionFailed(f"dataset {dataset.dataset_id} etag mismatch")
+                for field in fields:
+                    resource[field] = dataset.to_api_repr().get(field)
+                resource["etag"] = self._new_etag()
+                return Item(resource=copy.deepcopy(resource))
+        return self._call("update_dataset", update, retry)
+
+    def get_table(self, table_ref, retry=None):
+        return self._call("get_table", lambda: Item(resource=pickle.loads(
+            self._table_pickle_dict(table_ref.dataset_id)[self._table_id(table_ref)])), retry)
+
+    def update_table(self, table, fields, retry=None):
+        def update():
+            with self.lock:
+                table_pickle_dict = self._table_pickle_dict(table.dataset_id)
+                resource = pickle.loads(table_pickle_dict[self._table_id(table)])
+                if table.etag and table.etag != resource["etag"]:
+                    raise PreconditionFailed(f"table {table.dataset_id}.{table.table_id} etag mismatch")
+                new_resource = table.to_api_repr()
+                for field in fields:
+                    resource[field] = new_resource.get(field)
+                resource["etag"] = self._new_etag()
+                resource["lastModifiedTime"] = str(self.catalog.now_ms)
+                table_pickle_dict[table.table_id] = pickle.dumps(resource)
+                return Item(resource=resource)
+        return self._call("update_table", update, retry)
+
+    def query(self, sql, retry=None, job_retry=None):
+        return Item(result=lambda retry=None: self._call("query", lambda: self._query_rows(sql), retry))
+
+    def _query_rows(self, sql) -> list:
+        if "__TABLES__" in sql:
+            dataset_id = sql.split("`")[1].split(".")[1]
+            return [Item(table_id=table_id, last_modified_time=int(pickle.loads(p)["lastModifiedTime"]))
+                    for table_id, p in self._table_pickle_dict(dataset_id).items()]
+        if "INFORMATION_SCHEMA" in sql:
+            dataset_id = sql.split("`")[1].split(".")[1]
+            return information_schema_row_list(dataset_id, self._table_pickle_dict(dataset_id))
+        raise Exception(f"query is not supported by fake client: {sql}")
+
+    def _dataset_resource(self, dataset_id) -> dict:
+        if dataset_id not in self.catalog.dataset_dict:
+            raise NotFound(f"dataset {dataset_id}")
+        return self.catalog.dataset_dict[dataset_id]
+
+    def _table_pickle_dict(self, dataset_id) -> dict:
+        if dataset_id not in self.catalog.table_dict:
+            raise NotFound(f"dataset {dataset_id}")
+        return self.catalog.table_dict[dataset_id]
+
+    def _table_id(self, table_ref) -> str:
+        if table_ref.table_id not in self.catalog.table_dict[table_ref.dataset_id]:
+            raise NotFound(f"table {table_ref.dataset_id}.{table_ref.table_id}")
+        return table_ref.table_id
+
+    def _new_etag(self) -> str:
+        self.etag_seq += 1
+        return f"etag-{self.etag_seq}"
+
+
+def standard_type_of(field) -> str:
+    data_type = STANDARD_TYPE_MAP.get(field["type"], field["type"])
+    if data_type == "RECORD":
+        data_type = "STRUCT<" + ", ".join(f"{f['name']} {standard_type_of(f)}" for f in field["fields"]) + ">"
+    if field.get("mode") == "REPEATED":
+        data_type = f"ARRAY<{data_type}>"
+    return data_type
+
+
+def information_schema_row_list(dataset_id, table_pickle_dict) -> list:
+    """
+    Rows of TABLE_DESC_QUERY of lib.bulk_metadata
+    """
+    row_list = []
+    for table_id, table_pickle in table_pickle_dict.items():
+        table = pickle.loads(table_pickle)
+        table_description = json.dumps(table["description"]) if table["description"] else None
+
+        def add_rows(field_list, ordinal_position, is_nullable, parent_path):
+            for i, field in enumerate(field_list):
+                field_path = f"{parent_path}{field['name']}"
+                position = ordinal_position or i + 1
+                nullable = is_nullable or ("NO" if field.get("mode") == "REQUIRED" else "YES")
+                row_list.append(Item(table_schema=dataset_id, table_name=table_id,
+                                     table_description=table_description, ordinal_position=position,
+                                     is_nullable=nullable, is_hidden="NO", field_path=field_path,
+                                     data_type=standard_type_of(field), description=field.get("description")))
+                add_rows(field.get("fields", []), position, nullable, field_path + ".")
+        add_rows(table["schema"]["fields"], None, None, "")
+    return row_list
+
+
+# -----------------------------------------
+# Fake FireStore client
+# -----------------------------------------
+
+class FakeDocumentSnapshot(object):
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakeDocumentReference(object):
+    def __init__(self, client, col, document_id):
+        self.client = client
+        self.col = col
+        self.id = document_id
+
+    def get(self):
+        self.client.injector.call("get")
+        return FakeDocumentSnapshot(self, self.client.read(self.col, self.id))
+
+    def set(self, dic, merge=False):
+        self.client.injector.call("set")
+        self.client.write([("set_merge" if merge else "set", self, dic)])
+
+    def update(self, dic):
+        self.client.injector.call("update")
+        self.client.write([("update", self, dic)])
+
+    def delete(self):
+        self.client.injector.call("delete")
+        self.client.write([("delete", self, None)])
+
+
+class FakeQuery(object):
+    """
+    Collection reference and query. Documents are always ordered by id.
+    """
+
+    def __init__(self, client, col, projection=None, num_of_limit=None, start_after_id=None, filter_list=()):
+        self.client = client
+        self.id = col
+        self.projection = projection
+        self.num_of_limit = num_of_limit
+        self.start_after_id = start_after_id
+        self.filter_list = filter_list
+
+    def _copy(self, **kwargs):
+        query = copy.copy(self)
+        query.__dict__.update(kwargs)
+        return query
+
+    def document(self, document_id):
+        return FakeDocumentReference(self.client, self.id, document_id)
+
+    def select(self, field_path_list):
+        return self._copy(projection=list(field_path_list))
+
+    def order_by(self, field_path):
+        return self
+
+    def limit(self, num_of_limit):
+        return self._copy(num_of_limit=num_of_limit)
+
+    def start_after(self, doc_snapshot):
+        return self._copy(start_after_id=doc_snapshot.id)
+
+    def where(self, filter):
+        # only document id ranges ("__name__") are used
+        return self._copy(filter_list=self.filter_list + ((filter.op_string, filter.value.id),))
+
+    def _match(self, document_id) -> bool:
+        for op, value in self.filter_list:
+            if not {">=": document_id >= value, "<": document_id < value}[op]:
+                return False
+        return self.start_after_id is None or document_id > self.start_after_id
+
+    def _run(self) -> list:
+        doc_list = [(document_id, data) for document_id, data in self.client.scan(self.id) if self._match(document_id)]
+        if self.num_of_limit is not None:
+            doc_list = doc_list[:self.num_of_limit]
+        return [FakeDocumentSnapshot(self.document(document_id), select_fields(data, self.projection))
+                for document_id, data in doc_list]
+
+    def stream(self, read_time=None):
+        doc_snapshot_list = self._run()
+        self.client.injector.call("query", len(doc_snapshot_list))
+        return iter(doc_snapshot_list)
+
+
+class FakeAsyncQuery(object):
+    def __init__(self, query: FakeQuery):
+        self.query = query
+
+    def order_by(self, field_path):
+        return self
+
+    def limit(self, num_of_limit):
+        return FakeAsyncQuery(self.query.limit(num_of_limit))
+
+    def start_after(self, doc_snapshot):
+        return FakeAsyncQuery(self.query.start_after(doc_snapshot))
+
+    async def stream(self):
+        doc_snapshot_list = self.query._run()
+        await asyncio.sleep(self.query.client.injector.draw("query", len(doc_snapshot_list)))
+        for doc_snapshot in doc_snapshot_list:
+            yield doc_snapshot
+
+
+class FakeAsyncClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def collection(self, col):
+        return FakeAsyncQuery(self.client.collection(col))
+
+
+class FakeWriteBatch(object):
+    def __init__(self, client):
+        self.client = client
+        self.write_list = []
+
+    def set(self, doc_ref, dic):
+        self.write_list.append(("set", doc_ref, dic))
+
+    def update(self, doc_ref, dic):
+        self.write_list.append(("update", doc_ref, dic))
+
+    def delete(self, doc_ref):
+        self.write_list.append(("delete", doc_ref, None))
+
+    def commit(self):
+        self.client.injector.call("commit", len(self.write_list))
+        self.client.write(self.write_list)
+
+
+class FakeFirestoreClient(object):
+    """
+    Fake of the part of firestore.Client used by lib.firestore. Documents are kept pickled in memory.
+    """
+
+    def __init__(self, injector: Injector):
+        self.injector = injector
+        self.lock = threading.Lock()
+        self.store = {}
+
+    def collection(self, col):
+        return FakeQuery(self, col)
+
+    def collections(self):
+        with self.lock:
+            return [FakeQuery(self, col) for col in sorted(self.store.keys())]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def async_client(self):
+        return FakeAsyncClient(self)
+
+    def get_all(self, doc_ref_list, field_paths=None):
+        doc_ref_list = list(doc_ref_list)
+        self.injector.call("get_all", len(doc_ref_list))
+        return [FakeDocumentSnapshot(doc_ref, select_fields(self.read(doc_ref.col, doc_ref.id), field_paths))
+                for doc_ref in doc_ref_list]
+
+    def read(self, col, document_id):
+        with self.lock:
+            data = self.store.get(col, {}).get(document_id)
+        return None if data is None else pickle.loads(data)
+
+    def scan(self, col) -> list:
+        with self.lock:
+            item_list = sorted(self.store.get(col, {}).items())
+        return [(document_id, pickle.loads(data)) for document_id, data in item_list]
+
+    def write(self, write_list):
+        with self.lock:
+            for op, doc_ref, dic in write_list:
+                col_dict = self.store.setdefault(doc_ref.col, {})
+                if op == "delete":
+                    col_dict.pop(doc_ref.id, None)
+                    continue
+                if op == "set":
+                    new_dic = dic
+                else:
+                    if op == "update" and doc_ref.id not in col_dict:
+                        raise NotFound(f"document {doc_ref.col}/{doc_ref.id}")
+                    new_dic = merge_dict(pickle.loads(col_dict[doc_ref.id]) if doc_ref.id in col_dict else {}, dic)
+                col_dict[doc_ref.id] = pickle.dumps(new_dic)
+
+
+def merge_dict(base, dic) -> dict:
+    for key, value in dic.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_dict(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def select_fields(data, field_path_list):
+    if data is None or field_path_list is None:
+        return data
+    return {f: data[f] for f in field_path_list if f in data}
+
+
+# -----------------------------------------
+# Harness
+# -----------------------------------------
+
+class EntityTimer(object):
+    """
+    Wraps methods which process one dataset or table, and records their latency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sec_list = []
+
+    def wrap(self, obj, name):
+        func = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.sec_list.append(time.perf_counter() - start)
+        setattr(obj, name, timed)
+
+    def take(self) -> list:
+        with self.lock:
+            sec_list, self.sec_list = self.sec_list, []
+        return sec_list
+
+
+def percentile(sorted_list, p):
+    if not sorted_list:
+        return 0.0
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * p))]
+
+
+def make_config(set_list):
+    class HarnessConfig(Config):
+        gcp_project = "load-harness"
+    for item in set_list:
+        key, value = item.split("=", 1)
+        if not hasattr(Config, key):
+            raise Exception(f"unknown config: {key}")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(HarnessConfig, key, value)
+    return HarnessConfig
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=app_home, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode("utf-8").strip()
+    except Exception:
+        return "unknown"
+
+
+def run_action(name, func, timer, bq_injector, fs_injector, rate_limiter) -> dict:
+    limiter_stats_before = rate_limiter.stats()
+    start = time.perf_counter()
+    try:
+        result = func()
+    except Exception as e:
+        result = f"failed: {e}"
+    wall_sec = time.perf_counter() - start
+    sec_list = sorted(timer.take())
+    limiter_stats = rate_limiter.stats()
+    report = {
+        "wall_sec": round(wall_sec, 3),
+        "entities": len(sec_list),
+        "throughput_per_sec": round(len(sec_list) / wall_sec, 1) if wall_sec > 0 else 0,
+        "latency_ms": {"p50": round(percentile(sorted_list=sec_list, p=0.5) * 1000, 2),
+                       "p99": round(percentile(sorted_list=sec_list, p=0.99) * 1000, 2),
+                       "max": round((sec_list[-1] if sec_list else 0) * 1000, 2)},
+        "api_calls": {"bigquery": bq_injector.take_stats(), "firestore": fs_injector.take_stats()},
+        "rate_limiter": {key: round(limiter_stats[key] - limiter_stats_before[key], 3)
+                         for key in ["calls", "throttled", "gave_up", "rate_wait_sec", "backoff_sec"]},
+        "result": result,
+    }
+    print(f"{name:>24} {report['wall_sec']:>9.2f}s {report['entities']:>8} entities"
+          f" {report['throughput_per_sec']:>9.1f}/s p50={report['latency_ms']['p50']:.1f}ms"
+          f" p99={report['latency_ms']['p99']:.1f}ms", file=sys.stderr)
+    return report
+
+
+def run(args) -> dict:
+    config = make_config(args.set)
+    logger = logging.getLogger("load_harness")
+    logger.setLevel(args.log_level.upper())
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+
+    print(f"generate catalog of {args.tables} tables", file=sys.stderr)
+    catalog = Catalog(config.gcp_project, args.tables, args.tables_per_dataset, args.seed,
+                      median_fields=args.median_fields)
+    bq_injector = Injector(BIGQUERY_LATENCY_MS, args.latency_scale, args.error_rate, args.quota_per_sec, args.seed)
+    fs_injector = Injector(FIRESTORE_LATENCY_MS, args.latency_scale, seed=args.seed)
+    bigquery = Bigquery(config, logger, client=FakeBigqueryClient(catalog, bq_injector))
+    firestore = Firestore(config, logger, client=FakeFirestoreClient(fs_injector))
+    controller = Controller(config, logger, bigquery=bigquery, firestore=firestore)
+    timer = EntityTimer()
+    for name in ["_backup_table_desc", "_backup_dataset_desc", "_update_table_desc", "_plan_table_update"]:
+        timer.wrap(controller, name)
+    for name in ["update_dataset_desc", "plan_dataset_update", "apply_dataset_update", "apply_table_update"]:
+        timer.wrap(bigquery, name)
+    plan_path = os.path.join(tempfile.mkdtemp(), "restore_plan.jsonl")
+
+    def modify():
+        modified = catalog.touch(args.modified_ratio, change_description=False, tag="load") + \
+            catalog.touch(args.modified_ratio / 2, change_description=True, tag="edit")
+        return f"{modified} tables modified"
+
+    def drift():
+        return f"{catalog.touch(args.drift_ratio, change_description=True, tag='drift')} tables drifted"
+
+    step_list = [("backup_all_full", lambda: controller.backup_all(mode="full", time_budget_sec=0), True),
+                 ("modify", modify, False),
+                 ("backup_all_incremental", lambda: controller.backup_all(mode="incremental", time_budget_sec=0),
+                  True),
+                 ("drift", drift, False),
+                 ("restore_all", controller.restore_all, True),
+                 ("drift", drift, False),
+                 ("restore_plan", lambda: controller.restore_plan(plan_path), True),
+                 ("restore_apply", lambda: controller.restore_apply(plan_path), True)]
+    action_dict = {}
+    try:
+        for name, func, is_measured in step_list:
+            if not is_measured:
+                print(f"{name:>24} {func()}", file=sys.stderr)
+                continue
+            action_dict[name] = run_action(name, func, timer, bq_injector, fs_injector, bigquery.rate_limiter)
+    finally:
+        if os.path.exists(plan_path):
+            os.remove(plan_path)
+        os.rmdir(os.path.dirname(plan_path))
+    params = dict(vars(args), revision=git_revision(), num_of_tables=catalog.num_of_tables())
+    params.pop("out")
+    params.pop("compare")
+    return {"params": params, "actions": action_dict}
+
+
+def total_calls(stats_dict) -> int:
+    return sum(stats["calls"] for stats in stats_dict.values())
+
+
+def compare(report, baseline):
+    """
+    Print ratio of this report to baseline (< 1.0 means faster / fewer calls except throughput).
+    """
+    if baseline["params"]["num_of_tables"] != report["params"]["num_of_tables"] or \
+            baseline["params"]["seed"] != report["params"]["seed"]:
+        print("WARNING: catalogs of the reports are different", file=sys.stderr)
+    print(f"{'action':>24} {'wall':>8} {'throughput':>10} {'p50':>8} {'p99':>8} {'bq calls':>9} {'fs calls':>9}"
+          f"   (ratio to baseline {baseline['params']['revision']})")
+    for name, action in report["actions"].items():
+        base = baseline["actions"].get(name)
+        if base is None:
+            continue
+
+        def ratio(a, b):
+            return f"{a / b:.2f}" if b else "-"
+        print(f"{name:>24} {ratio(action['wall_sec'], base['wall_sec']):>8}"
+              f" {ratio(action['throughput_per_sec'], base['throughput_per_sec']):>10}"
+              f" {ratio(action['latency_ms']['p50'], base['latency_ms']['p50']):>8}"
+              f" {ratio(action['latency_ms']['p99'], base['latency_ms']['p99']):>8}"
+              f" {ratio(total_calls(action['api_calls']['bigquery']), total_calls(base['api_calls']['bigquery'])):>9}"
+              f" {ratio(total_calls(action['api_calls']['firestore']), total_calls(base['api_calls']['firestore'])):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=100000, help="number of tables in the catalog")
+    parser.add_argument("--tables-per-dataset", type=int, default=500)
+    parser.add_argument("--median-fields", type=int, default=20, help="median number of top level fields")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplied to all latencies. 0 for none")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of BigQuery calls failed with 500")
+    parser.add_argument("--quota-per-sec", type=int, default=0,
+                        help="BigQuery calls per second above which calls fail with rateLimitExceeded. 0 for none")
+    parser.add_argument("--modified-ratio", type=float, default=0.05,
+                        help="ratio of tables loaded before the incremental backup (half as many are edited)")
+    parser.add_argument("--drift-ratio", type=float, default=0.05,
+                        help="ratio of tables whose description is changed before restore")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override config (src/conf/config_sample.py). e.g. --set bigquery_rate_limit_per_sec=0")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--out", help="write the report JSON to this file")
+    parser.add_argument("--compare", help="report JSON of a previous run to compare with")
+    args = parser.parse_args()
+    report = run(args)
+    report_json = json.dumps(report, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import functools
+import json
 import logging
 import os
 import sys
@@ -13,11 +15,6 @@ from conf.config import Config
 
 config = Config()
 
-# load library
-from lib.controller import Controller
-from lib.firestore import Firestore
-from lib.slack import Slack
-
 # Logger setting
 log_format = logging.Formatter("%(asctime)s [%(levelname)8s] %(message)s")
 logger = logging.getLogger()
@@ -29,95 +26,232 @@ stdout_handler = logging.StreamHandler(sys.stdout)
 stdout_handler.setFormatter(log_format)
 logger.addHandler(stdout_handler)
 
-controller = Controller(config, logger)
-firestore = Firestore(config, logger)
-slack = Slack(config, logger)
+
+# Clients are made on first use and memoized, so that a command initializes only what it needs.
+
+@functools.lru_cache(maxsize=None)
+def get_metrics():
+    from lib.metrics import Metrics
+    return Metrics()
+
+
+@functools.lru_cache(maxsize=None)
+def get_firestore():
+    from lib.firestore import Firestore
+    return Firestore(config, logger, metrics=get_metrics()).for_project(selected_project())
+
+
+@functools.lru_cache(maxsize=None)
+def get_controller():
+    from lib.controller import Controller
+    return Controller(config, logger, firestore=get_firestore(), metrics=get_metrics(), project=selected_project())
+
+
+def selected_project():
+    """
+    BigQuery project given by --project. Default is gcp_project in config.
+    """
+    return click.get_current_context().find_root().obj.get("project") or config.gcp_project
+
+
+@functools.lru_cache(maxsize=None)
+def get_slack():
+    from lib.slack import Slack
+    return Slack(config, logger)
+
+
+def write_report(state, report_file, metrics_file):
+    """
+    Write the run report of the command at its end (also when it failed).
+    """
+    from lib.metrics import to_openmetrics
+    if get_metrics().action is None:
+        # no command was run (e.g. --help)
+        return
+    report = get_metrics().report(status=state["status"])
+    call_count_dict = {op: op_report["count"] for op, op_report in report["operations"].items()}
+    logger.info(f"[REPORT] {report['action']} {report['status']} elapsed={report['elapsed_sec']}s"
+                f" calls={call_count_dict}")
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=1)
+    if metrics_file is not None:
+        with open(metrics_file, "w") as f:
+            f.write(to_openmetrics(report))
+
+
+def write_profile(profiler, prefix):
+    profiler.stop()
+    pstats_path, trace_path = profiler.write(prefix)
+    logger.info(f"[PROFILE] CPU profile: {pstats_path} timeline: {trace_path}")
 
 
 @click.group(help='BigQuery Description Backuper')
+@click.option('--report-file', default=None, help="write the run report of the command to this file as JSON")
+@click.option('--metrics-file', default=None,
+              help="write metrics of the command to this file in OpenMetrics text format"
+                   " (e.g. for the textfile collector of node_exporter)")
+@click.option('--profile', 'profile_prefix', default=None, metavar="PREFIX",
+              help="write CPU profile of all threads to PREFIX.pstats, and timeline of BigQuery / FireStore calls"
+                   " to PREFIX.trace.json (Chrome trace event format)")
+@click.option('--project', default=None,
+              help="BigQuery project to backup/restore. default is gcp_project in config."
+                   " Descriptions of other projects are in collections suffixed by the project id, as \"backup all-projects\"")
 @click.pass_context
-def cli_main(ctx):
-    pass
+def cli_main(ctx, report_file, metrics_file, profile_prefix, project):
+    ctx.obj = {"status": "error", "project": project}
+    ctx.call_on_close(functools.partial(write_report, ctx.obj, report_file, metrics_file))
+    if profile_prefix is not None:
+        from lib.profiler import Profiler
+        profiler = Profiler(get_metrics())
+        profiler.start()
+        ctx.call_on_close(functools.partial(write_profile, profiler, profile_prefix))
+
+
+@cli_main.result_callback()
+@click.pass_context
+def finish(ctx, result, **kwargs):
+    # called only when the command succeeded
+    ctx.obj["status"] = "ok"
 
 
 @cli_main.group(help='Backup BigQuery Description to FireStore')
 @click.pass_context
 def backup(ctx):
-    pass
+    get_metrics().start(f"{ctx.info_name} {ctx.invoked_subcommand}")
 
 
 @cli_main.group(help='Restore from FireStore to BigQuery')
 @click.pass_context
 def restore(ctx):
-    pass
+    get_metrics().start(f"{ctx.info_name} {ctx.invoked_subcommand}")
 
 
 @cli_main.group(help='FireStore Data Snapshot')
 @click.pass_context
 def snapshot(ctx):
-    pass
+    get_metrics().start(f"{ctx.info_name} {ctx.invoked_subcommand}")
 
 
 @backup.command(help="Backup specified table and fields description")
 @click.option('--dataset', '-d', required=True)
 @click.option('--table', '-t', required=True)
 def table(table, dataset):
-    controller.backup_table(table_id=table, dataset_id=dataset)
+    get_controller().backup_table(table_id=table, dataset_id=dataset)
 
 
 @backup.command(help="Backup specified dataset description")
 @click.option('--dataset', '-d', required=True)
 def dataset(dataset):
-    controller.backup_dataset(dataset_id=dataset)
+    get_controller().backup_dataset(dataset_id=dataset)
 
 
 @backup.command(help="Backup all dataset and table(fields) descriptions in project")
-def all():
-    controller.backup_all()
+@click.option('--mode', '-m', type=click.Choice(["full", "incremental"]), default=None,
+              help="default is backup_mode in config")
+@click.option('--time-budget', 'time_budget_sec', type=int, default=None,
+              help="stop after this seconds and resume by the next run. default is backup_time_budget_sec in config")
+def all(mode, time_budget_sec):
+    get_controller().backup_all(mode=mode, time_budget_sec=time_budget_sec)
+
+
+@backup.command(help="Backup all projects selected by project_include_pattern / project_exclude_pattern")
+@click.option('--mode', '-m', type=click.Choice(["full", "incremental"]), default=None,
+              help="default is backup_mode in config")
+def all_projects(mode):
+    get_controller().backup_all_projects(mode=mode)
 
 
 @restore.command(help="Restore specified table and fields description")
 @click.option('--dataset', '-d', required=True)
 @click.option('--table', '-t', required=True)
 def table(table, dataset):
-    controller.restore_table(table_id=table, dataset_id=dataset)
+    get_controller().restore_table(table_id=table, dataset_id=dataset)
 
 
 @restore.command(help="Restore specified dataset description")
 @click.option('--dataset', '-d', required=True)
 def dataset(dataset):
-    controller.restore_dataset(dataset_id=dataset)
+    get_controller().restore_dataset(dataset_id=dataset)
 
 
 @restore.command(help="Restore all dataset and table(fields) description")
 def all():
-    controller.restore_all()
+    get_controller().restore_all()
+
+
+@restore.command(help="Diff all dataset and table(fields) description with the backup, and write updates to a plan file."
+                      " BigQuery is not updated")
+@click.option('--file', '-f', 'path', required=True, help="local plan file to write")
+def plan(path):
+    get_controller().restore_plan(path)
+
+
+@restore.command(help="Apply updates of a plan file made by \"restore plan\"."
+                      " Datasets and tables modified since the plan are rejected")
+@click.option('--file', '-f', 'path', required=True, help="local plan file made by \"restore plan\"")
+def apply(path):
+    get_controller().restore_apply(path)
 
 
 @snapshot.command(help="Make FireStore collection snapshot")
-def make():
-    firestore.make_db_snapshot()
+@click.option('--file', '-f', 'path', default=None, help="export to local compressed file instead of collection")
+@click.option('--mode', '-m', type=click.Choice(["full", "delta"]), default=None,
+              help="default is snapshot_mode in config")
+def make(path, mode):
+    if path is None:
+        get_firestore().make_db_snapshot(mode=mode)
+    else:
+        get_firestore().make_file_snapshot(path)
 
 
 @snapshot.command(help="List FireStore collection snapshots")
 def list():
-    for id in firestore.list_db_snapshot():
-        print(id)
+    for entry in get_firestore().list_db_snapshot():
+        if "created_at" not in entry:
+            # snapshot made before registry, recorded by migrate-registry
+            print(entry["id"])
+            continue
+        parent = f" parent={entry['parent']}" if entry["parent"] else ""
+        print(f"{entry['id']} {entry['type']:<5} docs={entry['num_of_docs']} bytes={entry['num_of_bytes']}"
+              f" created_at={entry['created_at'].isoformat()}{parent}"
+              f" collections={','.join(c['source'] for c in entry['collections'])}")
+
+
+@snapshot.command(help="Record FireStore collection snapshots made before the snapshot registry in the registry."
+                       " Run once after upgrading, if snapshots made by an old version are not listed")
+def migrate_registry():
+    get_firestore().migrate_snapshot_registry()
+
+
+def check_snapshot_option(snapshot_id, path):
+    if (snapshot_id is None) == (path is None):
+        raise click.UsageError("specify either --snapshot_id or --file")
 
 
 @snapshot.command(help="Recover table data on FireStore from specified snapshot")
 @click.option('--dataset', '-d', required=True)
 @click.option('--table', '-t', required=True)
-@click.option('--snapshot_id', '-s', required=True, help="format is YYYYMMDD")
-def recover_table(dataset, table, snapshot_id):
-    firestore.recover_table_from_snapshot(dataset, table, snapshot_id)
+@click.option('--snapshot_id', '-s', default=None, help="format is YYYYMMDD")
+@click.option('--file', '-f', 'path', default=None, help="local snapshot file made by \"snapshot make --file\"")
+def recover_table(dataset, table, snapshot_id, path):
+    check_snapshot_option(snapshot_id, path)
+    if path is None:
+        get_firestore().recover_table_from_snapshot(dataset, table, snapshot_id)
+    else:
+        get_firestore().recover_table_from_snapshot_file(dataset, table, path)
 
 
 @snapshot.command(help="Recover dataset data on FireStore from specified snapshot")
 @click.option('--dataset', '-d', required=True)
-@click.option('--snapshot_id', '-s', required=True, help="format is YYYYMMDD")
-def recover_dataset(dataset, snapshot_id):
-    firestore.recover_dataset_from_snapshot(dataset, snapshot_id)
+@click.option('--snapshot_id', '-s', default=None, help="format is YYYYMMDD")
+@click.option('--file', '-f', 'path', default=None, help="local snapshot file made by \"snapshot make --file\"")
+def recover_dataset(dataset, snapshot_id, path):
+    check_snapshot_option(snapshot_id, path)
+    if path is None:
+        get_firestore().recover_dataset_from_snapshot(dataset, snapshot_id)
+    else:
+        get_firestore().recover_dataset_from_snapshot_file(dataset, path)
 
 
 if __name__ == "__main__":
@@ -129,5 +263,5 @@ if __name__ == "__main__":
             import traceback
 
             except_str = traceback.format_exc()
-            slack.post_error("bqdesc_backupper Error\n" + except_str)
+            get_slack().post_error("bqdesc_backupper Error\n" + except_str)
         sys.exit(1)
@@ -34,10 +34,21 @@ class Config(object):
     # Collection to store table descriptions
     firestore_table_desc_collection_name = 'bqdesc-backupper-table-desc'
 
+    # Collection to store results of "backup_all_sharded" (one document per run)
+    firestore_backup_summary_collection_name = 'bqdesc-backupper-backup-summary'
+
     #------------------------
     # Target Filter
     #------------------------
 
+    # Each pattern is a regexp of id, or a label rule "labels.<key>:<value>" ("labels.<key>" matches any value).
+    #   A list of patterns can be given.
+    #   Selected if id matches any of include regexps, has all of include labels, and matches none of exclude patterns.
+    #   Include labels of datasets are passed to BigQuery, so datasets without them are not listed at all.
+    #   Label rules of tables can not be used with backup_bulk_metadata.
+    #
+    #dataset_include_pattern = [r'^(dwh_|raw_)', 'labels.backup:true']
+
     # If dataset_id match this regexp, it is processed.
     #   Default r'.*'    (=match all)
     #
@@ -59,6 +70,124 @@ class Config(object):
     #
     table_exclude_pattern = r'^$'
 
+    # Projects processed by "backup all-projects". Projects visible to the credentials are listed.
+    #   Label rules can not be used.
+    #
+    project_include_pattern = r'.*'
+    project_exclude_pattern = r'^$'
+
+
+    #------------------------
+    # Backup
+    #------------------------
+
+    # Mode of "backup all".
+    #   "full"        : get and write all tables.
+    #   "incremental" : get and write only tables modified since the last backup.
+    #                   Modification is detected by lastModifiedTime of tables. Run "full" periodically to reconcile.
+    backup_mode = "full"
+
+    # If True, "backup all" reads all tables in a dataset with one INFORMATION_SCHEMA query,
+    #   instead of one API request per table. backup_mode has no effect.
+    #   Backed up fields have only name, type, mode and description (no maxLength, policyTags, ...).
+    #   Change detection hashes only names, types and descriptions, so switching it does not rewrite unchanged backups.
+    backup_bulk_metadata = False
+
+    # Time budget of "backup all" in seconds. 0 means no limit.
+    #   When it runs out, no more gets are started, the position and the counts so far are saved to FireStore,
+    #   and the next "backup all" resumes from there. Gets in flight are waited for, so set it a little smaller
+    #   than the Cloud Functions timeout (e.g. 480 for 540 sec timeout).
+    backup_time_budget_sec = 0
+
+
+    #------------------------
+    # Restore
+    #------------------------
+
+    # If True, "restore all" prefetches current state of tables per dataset with one INFORMATION_SCHEMA query.
+    #   Tables which are same as backup are not requested one by one.
+    restore_prefetch_bulk_metadata = False
+
+
+    #------------------------
+    # Snapshot
+    #------------------------
+
+    # Mode of "snapshot make".
+    #   "full"  : copy all documents.
+    #   "delta" : copy only documents whose content hash differs from the previous snapshot, and tombstones of deleted ones.
+    #             Recovery resolves a document by walking back the chain of snapshots to the last full snapshot.
+    snapshot_mode = "full"
+
+    # In "delta" mode, a full snapshot (checkpoint) is made instead of a delta when the chain has this number of
+    #   snapshots. Recovery reads at most this number of snapshots.
+    snapshot_checkpoint_interval = 7
+
+
+    #------------------------
+    # Performance
+    #------------------------
+
+    # Number of worker threads of "backup all".
+    #   Get/put of each dataset and table descriptions run in parallel.
+    #   1 means serial processing.
+    backup_worker_num = 8
+
+    # Max number of BigQuery requests in flight of "restore all".
+    #   Datasets and tables are restored concurrently with asyncio.
+    #   1 means serial processing.
+    restore_max_in_flight = 16
+
+    # Max number of documents in one FireStore batch write of "backup all".
+    #   Max 500 (FireStore limit). 1 means one write request per document.
+    firestore_batch_size = 500
+
+    # Pending FireStore writes of "backup all" are committed this seconds after the first of them is queued,
+    #   even if the batch is not full (by a background thread, also while no more write is queued).
+    firestore_batch_flush_interval_sec = 5
+
+    # Number of FireStore documents read at a time by "restore all".
+    #   Documents are streamed page by page, so memory usage does not grow with number of backups.
+    firestore_read_page_size = 300
+
+    # Number of partitions copied in parallel by "snapshot make".
+    #   Documents are written with FireStore batch writes of firestore_batch_size.
+    snapshot_copy_partition_num = 8
+
+    # Number of projects processed concurrently by "backup all-projects".
+    #   All projects share one thread pool of backup_worker_num workers.
+    project_concurrency = 4
+
+    # Max number of BigQuery API calls started per second, shared by all threads. 0 means no limit.
+    bigquery_rate_limit_per_sec = 50
+
+    # Upper bound of BigQuery API calls in flight. When calls are throttled by BigQuery (403 rateLimitExceeded, 429),
+    #   the limit is halved, and it grows back by 1 as calls succeed.
+    bigquery_max_concurrency = 32
+
+    # Number of retries of a throttled BigQuery API call, with jittered exponential backoff or Retry-After.
+    bigquery_max_retry = 5
+
+
+    #------------------------
+    # Sharded Backup (Cloud Functions)
+    #------------------------
+
+    # URL of this Cloud Function. "backup_all_sharded" action calls it with "backup_shard" action for each shard.
+    #   The runtime service account needs roles/cloudfunctions.invoker on it.
+    cloud_functions_url = "https://REGION-PROJECT.cloudfunctions.net/FUNCTION_NAME"
+
+    # Number of shards of "backup_all_sharded". Datasets are partitioned by stable hash of dataset id.
+    backup_shard_count = 8
+
+    # Timeout of this Cloud Function. Same as the function timeout.
+    cloud_functions_timeout_sec = 540
+
+    # "backup_all_sharded" calls "backup_shard" with timeout of cloud_functions_timeout_sec minus this margin,
+    #   and each shard with time budget of the margin shorter than that (420 sec for 540 sec timeout),
+    #   so that shards record their results and the coordinator merges them before timeout.
+    backup_shard_timeout_margin_sec = 60
+
 
     #------------------------
     # Slack Integration
@@ -1,14 +1,19 @@
-from google.api_core.exceptions import NotFound, BadRequest
+from google.api_core.exceptions import NotFound, BadRequest, PreconditionFailed, Forbidden, TooManyRequests, \
+    InternalServerError, BadGateway, ServiceUnavailable
 from google.cloud import bigquery
 from enum import Enum
-import os
-import re
+import requests
 
+from lib.bulk_metadata import BulkMetadataReader
+from lib.gcp_auth import get_credentials
+from lib.metrics import Metrics, timed
+from lib.rate_limiter import RateLimiter
+from lib.selector import Selector
 from lib.table_desc import TableDesc
 from lib.dataset_desc import DatasetDesc
 
-MATCH_ALL = r'.*'
-MATCH_NONE = r'^$'
+# Number of retries when table/dataset was modified between get and update
+MAX_PRECONDITION_RETRY = 3
 
 class ResultType(Enum):
     SAME = "same"
@@ -16,6 +21,7 @@ class ResultType(Enum):
     DATASET_NOT_FOUND = "dataset not found"
     TABLE_NOT_FOUND = "table not found"
     TOO_MANY_DELETION = "too many deletion"
+    CHANGED_SINCE_PLAN = "changed since plan"
 
 class BqUpdateResult(object):
     def __init__(self,is_success,msg:ResultType,detail=""):
@@ -24,25 +30,115 @@ class BqUpdateResult(object):
         self.detail = detail
 
 
+def throttle_of(e):
+    """
+    :return: None if e is not a rate limit error. Otherwise seconds of Retry-After header (0 if no header).
+    """
+    if isinstance(e, TooManyRequests):
+        pass
+    elif isinstance(e, Forbidden) and any(err.get("reason") == "rateLimitExceeded" for err in e.errors):
+        pass
+    else:
+        return None
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return float(retry_after) if retry_after else 0
+    except ValueError:
+        # HTTP date form is not used by Google APIs
+        return 0
+
+
+# Reasons of errors which are retried inside a client call, same as DEFAULT_RETRY of the library except rateLimitExceeded.
+# Rate limit errors are left to RateLimiter, which backs off and lowers concurrency.
+# (If the library retried them, RateLimiter would never see them.)
+_RETRYABLE_REASONS = frozenset(["backendError", "internalError", "badGateway"])
+
+
+def _should_retry(e) -> bool:
+    if throttle_of(e) is not None:
+        return False
+    if isinstance(e, (InternalServerError, BadGateway, ServiceUnavailable, requests.exceptions.ConnectionError)):
+        return True
+    return any(err.get("reason") in _RETRYABLE_REASONS for err in getattr(e, "errors", None) or [])
+
+
+RETRY = bigquery.DEFAULT_RETRY.with_predicate(_should_retry)
+
+
 class Bigquery:
 
-    def __init__(self,config,logger):
+    def __init__(self,config,logger,project=None,credentials=None,rate_limiter:RateLimiter=None,client=None,
+                 metrics:Metrics=None):
+        """
+        :param project: BigQuery project to backup/restore. Default is config.gcp_project.
+        :param credentials: google.auth credentials. Default is the credentials shared in the process.
+        :param rate_limiter: RateLimiter of all API calls. If None, make new one by config.
+        :param metrics: Metrics which records calls of public methods. If None, make new one.
+        :param client: bigquery.Client to use instead of a new one (e.g. fake client of bench/load_harness.py)
+        """
         self.logger = logger
         self.config = config
-        self.project = config.gcp_project
-        os.environ["GOOGLE_CLOUD_PROJECT"] = self.project
-        if config.gcp_use_key_json:
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config.gcp_key_json
-        self.client = bigquery.Client(project = self.project)
+        self.project = project or config.gcp_project
+        if client is None:
+            self.credentials = credentials or get_credentials(config)
+            self.client = bigquery.Client(project = self.project, credentials=self.credentials)
+            # "backup all" / "restore all" workers share this client. Make the connection pool large enough for all of them.
+            pool_size = max(getattr(config, "backup_worker_num", 8), getattr(config, "restore_max_in_flight", 16), 10)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.client._http.mount("https://", adapter)
+        else:
+            self.credentials = credentials
+            self.client = client
+        self.bulk_metadata_reader = BulkMetadataReader(self.project, self._query)
+        # keys added after the first release are optional, so that config.py made from an old sample still works
+        rate_per_sec = getattr(config, "bigquery_rate_limit_per_sec", 50)
+        self.rate_limiter = rate_limiter or RateLimiter(
+            throttle_of, rate_per_sec=rate_per_sec, burst=max(1, int(rate_per_sec)),
+            max_concurrency=getattr(config, "bigquery_max_concurrency", 32),
+            max_retry=getattr(config, "bigquery_max_retry", 5))
+        self.metrics = metrics or Metrics()
+
+    def _call(self, op, func, *args, **kwargs):
+        """
+        Call BigQuery API through the rate limiter. Rate limit errors are retried with backoff.
+        """
+        return self.rate_limiter.call(op, func, *args, **kwargs)
+
+    def for_project(self, project) -> "Bigquery":
+        """
+        Bigquery of another project, which shares the credentials, rate limiter and metrics of this one.
+        """
+        if project == self.project:
+            return self
+        return Bigquery(self.config, self.logger, project=project, credentials=self.credentials,
+                        rate_limiter=self.rate_limiter, metrics=self.metrics)
+
+    def with_metrics(self, metrics) -> "Bigquery":
+        """
+        Bigquery which records calls to metrics (e.g. one Metrics per request).
+        The client, credentials and rate limiter of this one are shared.
+        """
+        if metrics is self.metrics:
+            return self
+        return Bigquery(self.config, self.logger, project=self.project, credentials=self.credentials,
+                        rate_limiter=self.rate_limiter, client=self.client, metrics=metrics)
+
+    def _query(self, sql):
+        # job_retry=None: a query job failed by rate limit is retried by RateLimiter, not re-run by the library
+        return self._call("query", lambda: self.client.query(sql, retry=RETRY, job_retry=None)
+                          .result(retry=RETRY))  # API Request Here
 
     #-------------------------------
     # Project
     #-------------------------------
 
-    def list_project_id(self, include_pattern=MATCH_ALL, exclude_pattern=MATCH_NONE):
+    @timed("bigquery.list_project_id")
+    def list_project_id(self, selector: Selector = None):
+        selector = selector or Selector()
         ret = []
-        for proj in self.client.list_projects():
-            if re.search(include_pattern, proj.project_id) and not re.search(exclude_pattern, proj.project_id):
+        for proj in self._call("list_projects", lambda: list(self.client.list_projects(retry=RETRY))):
+            if selector.match(proj.project_id):
                 ret.append(proj.project_id)
         return ret
 
@@ -50,42 +146,105 @@ class Bigquery:
     # Dataset
     #-------------------------------
 
+    @timed("bigquery.get_dataset_desc")
     def get_dataset_desc(self, dataset_id) -> DatasetDesc:
         dataset_ref = self.client.dataset(dataset_id)
-        dataset = self.client.get_dataset(dataset_ref)  # API Request Here
+        dataset = self._call("get_dataset", self.client.get_dataset, dataset_ref, retry=RETRY)  # API Request Here
         dataset_dict = dataset.to_api_repr()
         return DatasetDesc(in_dict=dataset_dict)
 
-    def update_dataset_desc(self, dataset_desc:DatasetDesc) -> BqUpdateResult:
+    @timed("bigquery.update_dataset_desc")
+    def update_dataset_desc(self, dataset_desc:DatasetDesc, now_dataset_desc:DatasetDesc=None) -> BqUpdateResult:
+        """
+        :param now_dataset_desc: current state of the dataset with etag, if it is already known. If None, get it.
+        The update is conditional on etag of the current state (If-Match).
+        If the dataset was modified in between, it is fetched again and retried.
+        """
         dataset_id = dataset_desc.dataset_id
         try:
-            existing_dataset_desc : DatasetDesc = self.get_dataset_desc(dataset_id=dataset_id)
-            if existing_dataset_desc.description == dataset_desc.description:
-                return BqUpdateResult(True,ResultType.SAME,detail="do nothing")
-            else:
-                ds = bigquery.Dataset(self.client.dataset(dataset_id))
-                ds.description = dataset_desc.description
-                self.client.update_dataset(ds, ['description'])
-                return BqUpdateResult(True,ResultType.UPDATE,f"{existing_dataset_desc.description} -> {dataset_desc.description}")
-        except NotFound as e:
-            if self.config.ignore_dataset_not_found_error_when_restore:
-                is_success = True
-            else:
-                is_success = False
-            return BqUpdateResult(is_success,ResultType.DATASET_NOT_FOUND)
-        except BadRequest as e:
-            if e.errors[0]["message"].find("Invalid dataset ID") > -1:
-                if self.config.ignore_dataset_not_found_error_when_restore:
-                    is_success = True
-                else:
-                    is_success = False
-                return BqUpdateResult(is_success,ResultType.DATASET_NOT_FOUND,detail=str(e))
+            for _ in range(MAX_PRECONDITION_RETRY + 1):
+                if now_dataset_desc is None:
+                    now_dataset_desc = self.get_dataset_desc(dataset_id=dataset_id)
+                result, update = self._make_dataset_update(dataset_desc, now_dataset_desc)
+                if update is None:
+                    return result
+                try:
+                    self._patch_dataset(update["dataset_id"], update["etag"], update["description"])
+                except PreconditionFailed:
+                    self.logger.info(f"dataset {dataset_id} was modified during update. retry.")
+                    now_dataset_desc = None
+                    continue
+                return result
+            raise Exception(f"dataset {dataset_id} was modified during update {MAX_PRECONDITION_RETRY + 1} times.")
+        except (NotFound, BadRequest) as e:
+            return self._dataset_not_found_result(e)
+
+    @timed("bigquery.plan_dataset_update")
+    def plan_dataset_update(self, dataset_desc:DatasetDesc) -> (BqUpdateResult, dict):
+        """
+        Same as update_dataset_desc, but the update is not made.
+        :return: result, and the update (keyword arguments of apply_dataset_update, JSON serializable).
+                 The update is None if there is nothing to update.
+        """
+        try:
+            now_dataset_desc = self.get_dataset_desc(dataset_id=dataset_desc.dataset_id)
+        except (NotFound, BadRequest) as e:
+            return self._dataset_not_found_result(e), None
+        return self._make_dataset_update(dataset_desc, now_dataset_desc)
+
+    @timed("bigquery.apply_dataset_update")
+    def apply_dataset_update(self, dataset_id, etag, description, diff="") -> BqUpdateResult:
+        """
+        Apply an update made by plan_dataset_update as it is, if the dataset is not modified since the plan (If-Match).
+        A dataset modified since the plan is rejected (not retried).
+        """
+        try:
+            self._patch_dataset(dataset_id, etag, description)
+        except PreconditionFailed:
+            return BqUpdateResult(False,ResultType.CHANGED_SINCE_PLAN,detail=f"etag {etag} of the plan is outdated")
+        except (NotFound, BadRequest) as e:
+            return self._dataset_not_found_result(e)
+        return BqUpdateResult(True,ResultType.UPDATE,diff)
+
+    def _make_dataset_update(self, dataset_desc:DatasetDesc, now_dataset_desc:DatasetDesc) -> (BqUpdateResult, dict):
+        if now_dataset_desc.description == dataset_desc.description:
+            return BqUpdateResult(True,ResultType.SAME,detail="do nothing"), None
+        diff = f"{now_dataset_desc.description} -> {dataset_desc.description}"
+        update = {"dataset_id": dataset_desc.dataset_id, "etag": now_dataset_desc.etag,
+                  "description": dataset_desc.description, "diff": diff}
+        return BqUpdateResult(True,ResultType.UPDATE,diff), update
+
+    def _patch_dataset(self, dataset_id, etag, description):
+        """
+        :raise PreconditionFailed: if etag is outdated
+        """
+        ds = bigquery.Dataset.from_api_repr({
+            "datasetReference": {"projectId": self.project, "datasetId": dataset_id},
+            "description": description,
+            "etag": etag})
+        self._call("update_dataset", self.client.update_dataset, ds, ['description'], retry=RETRY)
+
+    def _dataset_not_found_result(self, e) -> BqUpdateResult:
+        """
+        :raise e: if e is not an error of dataset not found
+        """
+        if isinstance(e, BadRequest) and e.errors[0]["message"].find("Invalid dataset ID") == -1:
             raise e
+        return BqUpdateResult(self.config.ignore_dataset_not_found_error_when_restore,ResultType.DATASET_NOT_FOUND,
+                              detail=str(e) if isinstance(e, BadRequest) else "")
 
-    def list_dataset_id(self, include_pattern=MATCH_ALL, exclude_pattern=MATCH_NONE):
+    @timed("bigquery.list_dataset_id")
+    def list_dataset_id(self, selector: Selector = None):
+        """
+        Include label rules of selector are passed to datasets.list filter,
+        so datasets without the labels are not listed at all.
+        """
+        selector = selector or Selector()
         ret = []
-        for dataset in self.client.list_datasets():
-            if re.search(include_pattern,dataset.dataset_id) and not re.search(exclude_pattern,dataset.dataset_id):
+        dataset_list = self._call("list_datasets",
+                                  lambda: list(self.client.list_datasets(filter=selector.label_filter(), retry=RETRY)))
+        for dataset in dataset_list:
+            if selector.match(dataset.dataset_id, dataset.labels):
                 ret.append(dataset.dataset_id)
         return ret
 
@@ -93,56 +252,164 @@ class Bigquery:
     # Table
     #-------------------------------
 
+    @timed("bigquery.get_table_desc")
     def get_table_desc(self, dataset_id, table_id) -> TableDesc:
         dataset_ref = self.client.dataset(dataset_id)
         table_ref = dataset_ref.table(table_id)
-        table = self.client.get_table(table_ref)  # API Request Here
+        table = self._call("get_table", self.client.get_table, table_ref, retry=RETRY)  # API Request Here
         table_dict = table.to_api_repr()
         return TableDesc(in_dict=table_dict)
 
-    def update_table_desc(self, new_table_desc:TableDesc)->BqUpdateResult:
+    @timed("bigquery.get_table_desc_dict_bulk")
+    def get_table_desc_dict_bulk(self, dataset_id, selector: Selector = None) -> dict:
+        """
+        Get descriptions of all tables in dataset with one INFORMATION_SCHEMA query.
+        Labels are not read, so label rules of selector are not supported.
+        :return: {table_id: TableDesc}
+        """
+        selector = selector or Selector()
+        if selector.has_label_rule():
+            raise Exception("label rules of tables can not be used with bulk metadata")
+        return {table_id: table_desc
+                for table_id, table_desc in self.bulk_metadata_reader.read_dataset(dataset_id).items()
+                if selector.match(table_id)}
+
+    @timed("bigquery.update_table_desc")
+    def update_table_desc(self, new_table_desc:TableDesc, now_table_desc:TableDesc=None)->BqUpdateResult:
+        """
+        :param now_table_desc: current state of the table if it is already known.
+                               If it is same as new_table_desc, no request is made.
+                               If it has etag (= it came from tables.get), the table is updated without fetching again.
+                               Otherwise (e.g. prefetched by BulkMetadataReader), the table is fetched to get full schema.
+        The update is conditional on etag of the current state (If-Match).
+        If the table was modified in between, it is fetched again and retried.
+        """
+        if now_table_desc is not None and new_table_desc.check_diff(now_table_desc)[0]:
+            return BqUpdateResult(True,ResultType.SAME,detail="do nothing")
+        if now_table_desc is not None and not now_table_desc.etag:
+            now_table_desc = None
+        dataset_id = new_table_desc.dataset_id
+        table_id = new_table_desc.table_id
         try:
-            dataset_id = new_table_desc.dataset_id
-            table_id = new_table_desc.table_id
-            now_table_desc = self.get_table_desc(dataset_id=dataset_id,table_id=table_id)
-        except NotFound as e:
-            if self.config.ignore_table_not_found_error_when_restore:
-                is_success = True
-            else:
-                is_success = False
-            return BqUpdateResult(is_success,ResultType.TABLE_NOT_FOUND,detail=str(e))
-        except BadRequest as e:
-            if e.errors[0]["message"].find("Invalid table ID") > -1:
-                if self.config.ignore_table_not_found_error_when_restore:
-                    is_success = True
-                else:
-                    is_success = False
-                return BqUpdateResult(is_success,ResultType.TABLE_NOT_FOUND,detail=str(e))
-            raise e
+            for _ in range(MAX_PRECONDITION_RETRY + 1):
+                if now_table_desc is None:
+                    now_table_desc = self.get_table_desc(dataset_id=dataset_id,table_id=table_id)
+                try:
+                    return self._update_table_desc_if_match(new_table_desc, now_table_desc)
+                except PreconditionFailed:
+                    self.logger.info(f"table {dataset_id}.{table_id} was modified during update. retry.")
+                    now_table_desc = None
+            raise Exception(f"table {dataset_id}.{table_id} was modified during update {MAX_PRECONDITION_RETRY + 1} times.")
+        except (NotFound, BadRequest) as e:
+            return self._table_not_found_result(e)
+
+    def _update_table_desc_if_match(self, new_table_desc:TableDesc, now_table_desc:TableDesc)->BqUpdateResult:
+        """
+        :raise PreconditionFailed: if etag of now_table_desc is outdated
+        """
+        result, update = self._make_table_update(new_table_desc, now_table_desc)
+        if update is not None:
+            self._patch_table(update["dataset_id"], update["table_id"], update["etag"], update["description"],
+                              update.get("fields"))
+        return result
+
+    @timed("bigquery.plan_table_update")
+    def plan_table_update(self, new_table_desc:TableDesc, now_table_desc:TableDesc=None) -> (BqUpdateResult, dict):
+        """
+        Same as update_table_desc, but the update is not made. See update_table_desc for now_table_desc.
+        :return: result, and the update (keyword arguments of apply_table_update, JSON serializable).
+                 The update is None if there is nothing to update.
+        """
+        if now_table_desc is not None and new_table_desc.check_diff(now_table_desc)[0]:
+            return BqUpdateResult(True,ResultType.SAME,detail="do nothing"), None
+        if now_table_desc is None or not now_table_desc.etag:
+            try:
+                now_table_desc = self.get_table_desc(dataset_id=new_table_desc.dataset_id,
+                                                     table_id=new_table_desc.table_id)
+            except (NotFound, BadRequest) as e:
+                return self._table_not_found_result(e), None
+        return self._make_table_update(new_table_desc, now_table_desc)
+
+    @timed("bigquery.apply_table_update")
+    def apply_table_update(self, dataset_id, table_id, etag, description, fields=None, diff="") -> BqUpdateResult:
+        """
+        Apply an update made by plan_table_update as it is (no diff), if the table is not modified since the plan
+        (If-Match). A table modified since the plan is rejected (not retried).
+        """
+        try:
+            self._patch_table(dataset_id, table_id, etag, description, fields)
+        except PreconditionFailed:
+            return BqUpdateResult(False,ResultType.CHANGED_SINCE_PLAN,detail=f"etag {etag} of the plan is outdated")
+        except (NotFound, BadRequest) as e:
+            return self._table_not_found_result(e)
+        return BqUpdateResult(True,ResultType.UPDATE,diff)
+
+    def _make_table_update(self, new_table_desc:TableDesc, now_table_desc:TableDesc) -> (BqUpdateResult, dict):
+        """
+        :param now_table_desc: current state from tables.get (with etag and full schema). Descriptions of it are
+                               overwritten by new_table_desc.
+        :return: result, and the update. fields (whole schema) is in the update only if any field description changes.
+        """
         is_same, diff_msg = new_table_desc.check_diff(now_table_desc)
         if is_same:
-            return BqUpdateResult(True,ResultType.SAME,detail="do nothing")
-        elif len(now_table_desc.field_list) >= 2 and len(new_table_desc.field_list) >= 2 and \
+            return BqUpdateResult(True,ResultType.SAME,detail="do nothing"), None
+        elif len(now_table_desc.field_index) >= 2 and len(new_table_desc.field_index) >= 2 and \
                 now_table_desc.num_of_field_desc() - new_table_desc.num_of_field_desc() >= 2  :
             msg = f"filld description: " + \
-                  f"existing={now_table_desc.num_of_field_desc()}/{len(now_table_desc.field_list)} " + \
-                  f"new={new_table_desc.num_of_field_desc()}/{len(new_table_desc.field_list)}."
-            return BqUpdateResult(False,ResultType.TOO_MANY_DELETION,msg)
-        else:
-            now_table_desc.update_description(other=new_table_desc)
-            generated_dict = now_table_desc.to_dict()
-            generated_dict["tableReference"] = {"projectId":self.project,"datasetId":dataset_id,"tableId":table_id}
-            new_table = bigquery.table.Table.from_api_repr(generated_dict)
-            self.client.update_table(new_table,["description","schema"])
-            return BqUpdateResult(True,ResultType.UPDATE,diff_msg)
+                  f"existing={now_table_desc.num_of_field_desc()}/{len(now_table_desc.field_index)} " + \
+                  f"new={new_table_desc.num_of_field_desc()}/{len(new_table_desc.field_index)}."
+            return BqUpdateResult(False,ResultType.TOO_MANY_DELETION,msg), None
+        field_desc_list = [f.description for f in now_table_desc.field_index.values()]
+        now_table_desc.update_description(other=new_table_desc)
+        update = {"dataset_id": now_table_desc.dataset_id, "table_id": now_table_desc.table_id,
+                  "etag": now_table_desc.etag, "description": now_table_desc.description, "diff": diff_msg}
+        if [f.description for f in now_table_desc.field_index.values()] != field_desc_list:
+            update["fields"] = [f.to_dict() for f in now_table_desc.field_list]
+        return BqUpdateResult(True,ResultType.UPDATE,diff_msg), update
+
+    def _patch_table(self, dataset_id, table_id, etag, description, fields=None):
+        """
+        :param fields: whole schema. If None, only table description is updated.
+        :raise PreconditionFailed: if etag is outdated
+        """
+        table_dict = {"tableReference": {"projectId": self.project, "datasetId": dataset_id, "tableId": table_id},
+                      "description": description,
+                      # update_table sends If-Match header with etag
+                      "etag": etag}
+        field_name_list = ["description"]
+        if fields is not None:
+            table_dict["schema"] = {"fields": fields}
+            field_name_list.append("schema")
+        new_table = bigquery.table.Table.from_api_repr(table_dict)
+        self._call("update_table", self.client.update_table, new_table, field_name_list, retry=RETRY)
+
+    def _table_not_found_result(self, e) -> BqUpdateResult:
+        """
+        :raise e: if e is not an error of table not found
+        """
+        if isinstance(e, BadRequest) and e.errors[0]["message"].find("Invalid table ID") == -1:
+            raise e
+        return BqUpdateResult(self.config.ignore_table_not_found_error_when_restore,ResultType.TABLE_NOT_FOUND,
+                              detail=str(e))
 
+    @timed("bigquery.list_table_last_modified_time")
+    def list_table_last_modified_time(self, dataset_id) -> dict:
+        """
+        Get last modified time of all tables in dataset with one query to __TABLES__ meta table.
+        :return: {table_id: lastModifiedTime (epoch millis string, same format as tables.get)}
+        """
+        query = f"SELECT table_id, last_modified_time FROM `{self.project}.{dataset_id}.__TABLES__`"
+        rows = self._query(query)
+        return {row.table_id: str(row.last_modified_time) for row in rows}
 
-    def list_table_id(self, dataset_id, include_pattern=MATCH_ALL, exclude_pattern=MATCH_NONE):
+    @timed("bigquery.list_table_id")
+    def list_table_id(self, dataset_id, selector: Selector = None):
+        selector = selector or Selector()
         dataset_ref = self.client.dataset(dataset_id)
-        tables = list(self.client.list_tables(dataset_ref))
+        tables = self._call("list_tables", lambda: list(self.client.list_tables(dataset_ref, retry=RETRY)))
         ret = []
         for table in tables:
-            if re.search(include_pattern, table.table_id) and not re.search(exclude_pattern, table.table_id):
+            if selector.match(table.table_id, table.labels):
                 ret.append(table.table_id)
         return ret
 
@@ -0,0 +1,209 @@
+import ast
+import re
+import threading
+from collections import OrderedDict
+
+from lib.table_desc import TableDesc
+
+# Standard SQL type name -> type name of tables.get API
+LEGACY_TYPE_MAP = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+}
+
+# One row per column of every table. Tables without columns have one row with NULL field_path.
+# COLUMNS has hidden pseudo columns (_PARTITIONTIME, _PARTITIONDATE of ingestion-time partitioned tables),
+# which tables.get does not return. They are selected with is_hidden and dropped by BulkMetadataReader.
+TABLE_DESC_QUERY = """
+WITH options AS (
+  SELECT table_schema, table_name, option_value AS table_description
+  FROM `{qualifier}.INFORMATION_SCHEMA.TABLE_OPTIONS`
+  WHERE option_name = 'description'
+), columns AS (
+  SELECT c.table_schema, c.table_name, c.ordinal_position, c.is_nullable, c.is_hidden,
+         p.field_path, p.data_type, p.description
+  FROM `{qualifier}.INFORMATION_SCHEMA.COLUMNS` c
+  JOIN `{qualifier}.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS` p USING (table_schema, table_name, column_name)
+)
+SELECT t.table_schema, t.table_name, o.table_description,
+       c.ordinal_position, c.is_nullable, c.is_hidden, c.field_path, c.data_type, c.description
+FROM `{qualifier}.INFORMATION_SCHEMA.TABLES` t
+LEFT JOIN options o USING (table_schema, table_name)
+LEFT JOIN columns c USING (table_schema, table_name)
+ORDER BY t.table_schema, t.table_name, c.ordinal_position, c.field_path
+"""
+
+
+class BulkMetadataReader(object):
+    """
+    Read descriptions of all tables in a dataset with one INFORMATION_SCHEMA query,
+    instead of one tables.get request per table.
+    TableDesc built by this reader has no etag and lastModifiedTime. Fields have only name, type, mode and
+    description (no maxLength, precision, scale, policyTags, ...). TableDesc.content_hash() does not depend on them,
+    so backups made by this reader and by tables.get have the same hash.
+    """
+
+    def __init__(self, project, query_func):
+        """
+        :param query_func: function which runs standard SQL and returns iterable of rows.
+                           Each row supports row["column_name"].
+        """
+        self.project = project
+        self.query_func = query_func
+
+    def read_dataset(self, dataset_id) -> dict:
+        """
+        :return: {table_id: TableDesc}
+        """
+        table_dict_dict = {}
+        column_row_list_dict = {}
+        for row in self.query_func(TABLE_DESC_QUERY.format(qualifier=f"{self.project}.{dataset_id}")):
+            table_id = row["table_name"]
+            if table_id not in table_dict_dict:
+                table_dict_dict[table_id] = {
+                    "description": decode_option_value(row["table_description"]),
+                    "schema": {"fields": []},
+                    "tableReference": {"projectId": self.project, "datasetId": dataset_id, "tableId": table_id}
+                }
+            if row["field_path"] is not None and row["is_hidden"] != "YES":
+                column_row_list_dict.setdefault(table_id, []).append(row)
+        for table_id, column_row_list in column_row_list_dict.items():
+            table_dict_dict[table_id]["schema"]["fields"] = make_field_dict_list(column_row_list)
+        return {table_id: TableDesc(in_dict=table_dict) for table_id, table_dict in table_dict_dict.items()}
+
+
+def make_field_dict_list(column_row_list) -> list:
+    """
+    Build nested "fields" of tables.get API from COLUMN_FIELD_PATHS rows of one table.
+    Columns are ordered by ordinal_position, and sub fields are ordered as in STRUCT<...> of the parent.
+    """
+    top_list = []
+    field_dict_by_path = {}
+    data_type_by_path = {}
+    # parents first
+    for row in sorted(column_row_list, key=lambda r: (r["field_path"].count("."), r["ordinal_position"])):
+        field_path = row["field_path"]
+        field_type, mode = to_api_type(row["data_type"])
+        if mode == "NULLABLE" and "." not in field_path and row["is_nullable"] == "NO":
+            mode = "REQUIRED"
+        field_dict = {"name": field_path.rsplit(".", 1)[-1], "type": field_type, "mode": mode}
+        if row["description"]:
+            field_dict["description"] = row["description"]
+        if field_type == "RECORD":
+            field_dict["fields"] = []
+        field_dict_by_path[field_path] = field_dict
+        data_type_by_path[field_path] = row["data_type"]
+        if "." not in field_path:
+            top_list.append(field_dict)
+        else:
+            parent = field_dict_by_path.get(field_path.rsplit(".", 1)[0])
+            if parent is not None:
+                parent.setdefault("fields", []).append(field_dict)
+    for field_path, field_dict in field_dict_by_path.items():
+        if len(field_dict.get("fields", [])) > 1:
+            order = {name: i for i, name in enumerate(struct_field_names(data_type_by_path[field_path]))}
+            field_dict["fields"].sort(key=lambda f: order.get(f["name"], len(order)))
+    return top_list
+
+
+def struct_field_names(data_type) -> list:
+    """
+    :return: names of direct sub fields. e.g. "ARRAY<STRUCT<a INT64, b STRUCT<c STRING>>>" -> ["a", "b"]
+    """
+    if data_type.startswith("ARRAY<"):
+        data_type = data_type[len("ARRAY<"):-1]
+    if not data_type.startswith("STRUCT<"):
+        return []
+    body = data_type[len("STRUCT<"):-1]
+    name_list = []
+    depth = 0
+    in_quote = False
+    is_head = True
+    for i, c in enumerate(body):
+        if c == "`":
+            in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif c in "<(":
+            depth += 1
+        elif c in ">)":
+            depth -= 1
+        elif c == "," and depth == 0:
+            is_head = True
+            continue
+        if is_head and c != " ":
+            # "name TYPE" or "`name` TYPE"
+            rest = body[i:]
+            if rest.startswith("`"):
+                name_list.append(rest[1:rest.index("`", 1)])
+            else:
+                name_list.append(rest.split(" ", 1)[0])
+            is_head = False
+    return name_list
+
+
+def to_api_type(data_type) -> (str, str):
+    """
+    Convert data_type of INFORMATION_SCHEMA to type and mode of tables.get API.
+    e.g. "ARRAY<STRUCT<a INT64>>" -> ("RECORD", "REPEATED"), "STRING(10)" -> ("STRING", "NULLABLE")
+    """
+    mode = "NULLABLE"
+    if data_type.startswith("ARRAY<"):
+        mode = "REPEATED"
+        data_type = data_type[len("ARRAY<"):-1]
+    base_type = re.match(r"[A-Z0-9_]*", data_type).group(0)
+    return LEGACY_TYPE_MAP.get(base_type, base_type), mode
+
+
+def decode_option_value(option_value) -> str:
+    """
+    option_value of TABLE_OPTIONS is a string literal like "my \\"table\\"". Decode it.
+    """
+    if option_value is None:
+        return ""
+    try:
+        value = ast.literal_eval(option_value)
+    except (ValueError, SyntaxError):
+        return option_value
+    return value if isinstance(value, str) else option_value
+
+
+class TableDescPrefetcher(object):
+    """
+    Cache of BulkMetadataReader.read_dataset() results, for looking up current state of tables one by one.
+    Keeps at most max_datasets datasets. Thread safe.
+    """
+
+    def __init__(self, reader: BulkMetadataReader, logger, max_datasets=16):
+        self.reader = reader
+        self.logger = logger
+        self.max_datasets = max_datasets
+        self.lock = threading.Lock()
+        self.dataset_lock_dict = {}
+        self.cache = OrderedDict()
+
+    def get(self, dataset_id, table_id) -> TableDesc:
+        """
+        :return: TableDesc, or None if it can not be prefetched.
+        """
+        with self.lock:
+            dataset_lock = self.dataset_lock_dict.setdefault(dataset_id, threading.Lock())
+        # read one dataset only once even if many threads ask it at the same time
+        with dataset_lock:
+            with self.lock:
+                if dataset_id in self.cache:
+                    self.cache.move_to_end(dataset_id)
+                    return self.cache[dataset_id].get(table_id)
+            try:
+                table_desc_dict = self.reader.read_dataset(dataset_id)
+            except Exception as e:
+                self.logger.warning(f"Can not prefetch tables of dataset {dataset_id}. {e}")
+                table_desc_dict = {}
+            with self.lock:
+                self.cache[dataset_id] = table_desc_dict
+                while len(self.cache) > self.max_datasets:
+                    evicted_dataset_id, _ = self.cache.popitem(last=False)
+                    self.dataset_lock_dict.pop(evicted_dataset_id, None)
+            return table_desc_dict.get(table_id)
@@ -1,15 +1,102 @@
+import asyncio
+import contextlib
+import functools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+
 from lib.bigquery import Bigquery, BqUpdateResult, ResultType
+from lib.bulk_metadata import TableDescPrefetcher
 from lib.dataset_desc import DatasetDesc
 from lib.firestore import Firestore
+from lib.function_invoker import FunctionInvoker
+from lib.metrics import Metrics
+from lib.restore_plan import RestorePlanReader, RestorePlanWriter
+from lib.selector import Selector, shard_of
+from lib.snapshot_file import KIND_DATASET, KIND_TABLE
 from lib.table_desc import TableDesc
 
+# kind of entity in restore logs
+RESTORE_LOG_KIND = {KIND_TABLE: "T", KIND_DATASET: "D"}
+
 
 class Controller:
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, bigquery: Bigquery = None, firestore: Firestore = None,
+                 metrics: Metrics = None, project=None):
+        """
+        :param bigquery: If None, Bigquery of project
+        :param firestore: If None, Firestore of project
+        :param metrics: Metrics of Bigquery and Firestore made by this. If None, make new one.
+        :param project: BigQuery project of bigquery and firestore. Default is config.gcp_project. See for_project.
+        """
         self.config = config
         self.logger = logger
-        self.bigquery = Bigquery(config=config, logger=logger)
-        self.firestore = Firestore(config=config, logger=logger)
+        self.project = project or config.gcp_project
+        # keys added after the first release are optional, so that config.py made from an old sample still works
+        self.backup_worker_num = getattr(config, "backup_worker_num", 8)
+        self.restore_max_in_flight = getattr(config, "restore_max_in_flight", 16)
+        self.metrics = metrics or Metrics()
+        # made on first use, so that an action initializes only the clients it needs
+        self._bigquery = bigquery
+        self._firestore = firestore
+        # Controller whose clients are shared by this one. See _derive
+        self._client_source = None
+        self._client_lock = threading.Lock()
+        # compile target filter once
+        self.dataset_selector = Selector(config.dataset_include_pattern, config.dataset_exclude_pattern)
+        self.table_selector = Selector(config.table_include_pattern, config.table_exclude_pattern)
+
+    @property
+    def bigquery(self) -> Bigquery:
+        with self._client_lock:
+            if self._bigquery is None:
+                if self._client_source is not None:
+                    self._bigquery = self._client_source.bigquery.for_project(self.project).with_metrics(self.metrics)
+                else:
+                    self._bigquery = Bigquery(config=self.config, logger=self.logger, project=self.project,
+                                              metrics=self.metrics)
+            return self._bigquery
+
+    @property
+    def firestore(self) -> Firestore:
+        with self._client_lock:
+            if self._firestore is None:
+                if self._client_source is not None:
+                    self._firestore = self._client_source.firestore.for_project(self.project) \
+                        .with_metrics(self.metrics)
+                else:
+                    self._firestore = Firestore(config=self.config, logger=self.logger, metrics=self.metrics) \
+                        .for_project(self.project)
+            return self._firestore
+
+    def for_project(self, project) -> "Controller":
+        """
+        Controller of another BigQuery project, with Bigquery.for_project and Firestore.for_project
+        (descriptions are in collections namespaced by project). Metrics are shared.
+        """
+        if project == self.project:
+            return self
+        return self._derive(project, self.metrics)
+
+    def with_metrics(self, metrics) -> "Controller":
+        """
+        Controller which records calls to metrics, e.g. one Metrics per request of a warm Cloud Functions instance,
+        so that concurrent requests do not reset or mix the counters of each other.
+        """
+        if metrics is self.metrics:
+            return self
+        return self._derive(self.project, metrics)
+
+    def _derive(self, project, metrics) -> "Controller":
+        """
+        Clients of the derived Controller are made on first use from the clients of this one,
+        which are kept by this one for next derived Controllers (e.g. credentials, rate limiter, connections).
+        """
+        controller = Controller(self.config, self.logger, metrics=metrics, project=project)
+        controller._client_source = self._client_source or self
+        return controller
 
     # -----------------------------------------
     # Backup
@@ -35,48 +122,100 @@ class Controller:
             self.firestore.put_dataset_desc(dataset_id=dataset_id, dataset_desc=dataset_desc)
             self.logger.info("ok")
 
-    def backup_all(self) -> str:
-        self.logger.info(f'[BACKUP] Backup BigQuery all descriptions to FireStore "{self.firestore.dataset_desc_col}"')
-        result_type_counter = {"ok": 0, "skip": 0, "exception": 0}
-        for dataset_id in self.bigquery.list_dataset_id(
-                include_pattern=self.config.dataset_include_pattern,
-                exclude_pattern=self.config.dataset_exclude_pattern):
-            # backup dataset description
-            try:
-                dataset_desc: DatasetDesc = self.bigquery.get_dataset_desc(dataset_id=dataset_id)
-                if (dataset_desc.is_no_description()):
-                    self.logger.info(f"[BACKUP] [D] [skip] [{dataset_id}] dataset has no description.")
-                    result_type_counter["skip"] += 1
+    def _backup_dataset_desc(self, dataset_id, writer, write_result_list, backup_hash=None) -> str:
+        dataset_desc: DatasetDesc = self.bigquery.get_dataset_desc(dataset_id=dataset_id)
+        if (dataset_desc.is_no_description()):
+            self.logger.info(f"[BACKUP] [D] [skip] [{dataset_id}] dataset has no description.")
+            return "skip"
+        if dataset_desc.content_hash() == backup_hash:
+            self.logger.info(f"[BACKUP] [D] [skip_unchanged] [{dataset_id}]")
+            return "skip_unchanged"
+        self.firestore.put_dataset_desc(
+            dataset_id=dataset_id, dataset_desc=dataset_desc, writer=writer,
+            on_done=functools.partial(self._on_backup_written, write_result_list, "D", dataset_id))
+        return "queued"
+
+    def _backup_table_desc(self, dataset_id, table_id, writer, write_result_list, backup_hash=None,
+                           table_desc: TableDesc = None, backup_last_modified_time=None, has_backup=False) -> str:
+        """
+        :param table_desc: If None, get it from BigQuery.
+        :param backup_last_modified_time: lastModifiedTime in the backup
+        :param has_backup: True if the table has a document in FireStore
+        """
+        if table_desc is None:
+            table_desc = self.bigquery.get_table_desc(dataset_id=dataset_id, table_id=table_id)
+        if (table_desc.is_no_description()):
+            if table_desc.last_modified_time and table_desc.last_modified_time != backup_last_modified_time:
+                # record lastModifiedTime, so that the next incremental backup does not fetch this table again.
+                # A backup made before the description was removed is kept as it is.
+                on_done = functools.partial(self._on_backup_state_written, f"{dataset_id}.{table_id}")
+                if has_backup:
+                    self.firestore.put_table_modified_time(dataset_id=dataset_id, table_id=table_id,
+                                                           table_desc=table_desc, writer=writer, on_done=on_done)
                 else:
-                    self.firestore.put_dataset_desc(dataset_id=dataset_id, dataset_desc=dataset_desc)
-                    self.logger.info(f"[BACKUP] [D] [ok] [{dataset_id}]")
-                    result_type_counter["ok"] += 1
-            except Exception as e:
-                self.logger.exception(e)
-                result_type_counter["exception"] += 1
-            # backup table description
+                    self.firestore.put_table_no_description(dataset_id=dataset_id, table_id=table_id,
+                                                            table_desc=table_desc, writer=writer, on_done=on_done)
+            self.logger.info(f"[BACKUP] [T] [skip] [{dataset_id}.{table_id}] table has no description.")
+            return "skip"
+        if table_desc.content_hash() == backup_hash:
+            if table_desc.last_modified_time and table_desc.last_modified_time != backup_last_modified_time:
+                # data was modified but descriptions were not. Update lastModifiedTime only, so that
+                # the next incremental backup does not fetch this table again.
+                self.firestore.put_table_modified_time(
+                    dataset_id=dataset_id, table_id=table_id, table_desc=table_desc, writer=writer,
+                    on_done=functools.partial(self._on_backup_state_written, f"{dataset_id}.{table_id}"))
+            self.logger.info(f"[BACKUP] [T] [skip_unchanged] [{dataset_id}.{table_id}]")
+            return "skip_unchanged"
+        self.firestore.put_table_desc(
+            dataset_id=dataset_id, table_id=table_id, table_desc=table_desc, writer=writer,
+            on_done=functools.partial(self._on_backup_written, write_result_list, "T", f"{dataset_id}.{table_id}"))
+        return "queued"
+
+    def _backup_table_desc_bulk(self, dataset_id, writer, write_result_list, table_backup_state_dict) -> [str]:
+        table_desc_dict = self.bigquery.get_table_desc_dict_bulk(dataset_id, selector=self.table_selector)
+        result_list = []
+        for table_id, table_desc in table_desc_dict.items():
             try:
-                for table_id in self.bigquery.list_table_id(
-                        dataset_id,
-                        include_pattern=self.config.table_include_pattern,
-                        exclude_pattern=self.config.table_exclude_pattern):
-                    try:
-                        table_desc: TableDesc = self.bigquery.get_table_desc(dataset_id=dataset_id, table_id=table_id)
-                        if (table_desc.is_no_description()):
-                            self.logger.info(f"[BACKUP] [T] [skip] [{dataset_id}.{table_id}] table has no description.")
-                            result_type_counter["skip"] += 1
-                        else:
-                            self.firestore.put_table_desc(dataset_id=dataset_id, table_id=table_id,
-                                                          table_desc=table_desc)
-                            self.logger.info(f"[BACKUP] [T] [ok] [{dataset_id}.{table_id}]")
-                            result_type_counter["ok"] += 1
-                    except Exception as e:
-                        self.logger.exception(e)
-                        result_type_counter["exception"] += 1
+                backup_hash = table_backup_state_dict.get(f"{dataset_id}.{table_id}", {}).get("content_hash")
+                result_list.append(self._backup_table_desc(dataset_id, table_id, writer, write_result_list,
+                                                           backup_hash=backup_hash, table_desc=table_desc))
             except Exception as e:
-                # In case of list error
                 self.logger.exception(e)
-                result_type_counter["exception"] += 1
+                result_list.append("exception")
+        return result_list
+
+    def _list_table_last_modified_time(self, dataset_id) -> dict:
+        try:
+            return self.bigquery.list_table_last_modified_time(dataset_id)
+        except Exception as e:
+            # fall back to full backup of this dataset
+            self.logger.warning(f"[BACKUP] [{dataset_id}] can not get last modified time of tables. {e}")
+            return {}
+
+    def _on_backup_written(self, write_result_list, kind, name, error):
+        if error is None:
+            self.logger.info(f"[BACKUP] [{kind}] [ok] [{name}]")
+            write_result_list.append("ok")
+        else:
+            self.logger.error(f"[BACKUP] [{kind}] [exception] [{name}] {error}", exc_info=error)
+            write_result_list.append("exception")
+
+    def _on_backup_state_written(self, name, error):
+        # counted as skip or skip_unchanged either way. If it failed, the table is only fetched again in the next run.
+        if error is not None:
+            self.logger.warning(f"[BACKUP] [T] [{name}] can not update lastModifiedTime of the backup. {error}")
+
+    def backup_all(self, mode=None, time_budget_sec=None) -> str:
+        """
+        :param time_budget_sec: If the backup does not finish in this seconds, it stops and is resumed by the next
+            call. Default is config.backup_time_budget_sec. 0 means no limit.
+        """
+        result_type_counter, is_finished = self._backup_all_resumable(mode, time_budget_sec=time_budget_sec)
+        self.logger.info(f"[BACKUP] BigQuery rate limiter: {self.bigquery.rate_limiter.stats()}")
+        if not is_finished:
+            msg = f"Backup All Suspended before deadline. It will be resumed by the next run. result={result_type_counter}"
+            self.logger.warning(f"[BACKUP] {msg}")
+            return msg
         if result_type_counter["exception"] > 0:
             self.logger.error(f"[BACKUP] Finish with some errors. result={result_type_counter}")
             raise Exception(f"Backup All Failed. {result_type_counter}")
@@ -84,6 +223,312 @@ class Controller:
             self.logger.info(f"[BACKUP] Finish with no error.  result={result_type_counter}")
             return str(result_type_counter)
 
+    def _backup_all_resumable(self, mode=None, executor: ThreadPoolExecutor = None, shard=None,
+                              time_budget_sec=None) -> (dict, bool):
+        """
+        Backup all, resuming from the checkpoint of the previous run if there is.
+        If time budget runs out, the position to resume from and the counters so far are saved as a checkpoint.
+        The checkpoint is deleted when all datasets are processed.
+        :return: number of each result type since the first run of this pass, and whether the pass is finished
+        """
+        mode = mode or getattr(self.config, "backup_mode", "full")
+        if mode not in ("full", "incremental"):
+            raise Exception(f"unknown backup mode: {mode}")
+        if time_budget_sec is None:
+            time_budget_sec = getattr(self.config, "backup_time_budget_sec", 0)
+        deadline = time.monotonic() + time_budget_sec if time_budget_sec else None
+        checkpoint_name = "all" if shard is None else f"shard-{shard[0]}-of-{shard[1]}"
+        checkpoint = self.firestore.get_backup_checkpoint(checkpoint_name)
+        if checkpoint is not None and checkpoint["mode"] != mode:
+            self.logger.info(f"[BACKUP] discard checkpoint of {checkpoint['mode']} mode")
+            checkpoint = None
+        if checkpoint is None:
+            cursor = None
+            result_type_counter = {"ok": 0, "skip": 0, "skip_unchanged": 0, "not_modified": 0, "exception": 0}
+        else:
+            cursor = checkpoint["cursor"]
+            result_type_counter = checkpoint["result"]
+            self.logger.info(f"[BACKUP] resume from {cursor} of checkpoint at {checkpoint['updated_at']}")
+        next_cursor = self._backup_all(mode, result_type_counter, executor, shard, cursor, deadline)
+        if next_cursor is None:
+            if checkpoint is not None:
+                self.firestore.delete_backup_checkpoint(checkpoint_name)
+            return result_type_counter, True
+        self.logger.info(f"[BACKUP] time budget {time_budget_sec} sec ran out. save checkpoint {next_cursor}")
+        self.firestore.put_backup_checkpoint(
+            {"mode": mode, "cursor": next_cursor, "result": result_type_counter}, checkpoint_name)
+        return result_type_counter, False
+
+    def _backup_all(self, mode, result_type_counter, executor: ThreadPoolExecutor = None, shard=None, cursor=None,
+                    deadline=None):
+        """
+        Backup all dataset and table descriptions.
+        In "incremental" mode, tables whose lastModifiedTime is same as the backup are not fetched.
+        "full" mode fetches all tables again.
+        Descriptions whose content hash is same as the backup are not written.
+        If config.backup_bulk_metadata is True, all tables in a dataset are read with one INFORMATION_SCHEMA query,
+        and mode has no effect.
+        Get of each dataset and table runs on a thread pool of config.backup_worker_num workers.
+        Bigquery and Firestore clients are shared among the workers.
+        Firestore writes are grouped into batches, and counted as ok/exception after commit.
+        Datasets and tables are processed in order of id, so that the position can be a cursor.
+        :param result_type_counter: number of each result type. counted up in place.
+        :param executor: If given, gets run on it instead of a new thread pool (shared by projects).
+        :param shard: (shard_index, shard_count). If given, only datasets of the shard are processed.
+        :param cursor: {"dataset_id", "table_id"} to start from. table_id None means the dataset description.
+            None means from the first dataset.
+        :param deadline: time.monotonic() value. When it has passed, no more gets are started.
+            Gets in flight are waited for. Gets are submitted only as fast as the workers take them
+            (see _submit_backup), so the run stops soon after the deadline.
+        :return: cursor to resume from, or None if all datasets are processed
+        """
+        self.logger.info(
+            f'[BACKUP] Backup BigQuery project "{self.bigquery.project}" all descriptions'
+            f' to FireStore "{self.firestore.dataset_desc_col}". mode={mode}')
+        dataset_id_list = self._list_backup_dataset_id(shard, cursor)
+        # load current backup state in bulk, not one read per table.
+        # A shard reads only the state of its own datasets, so that all shards together read it once.
+        state_dataset_id_list = dataset_id_list if shard is not None else None
+        dataset_backup_state_dict = self.firestore.get_all_dataset_doc_field_dict(["content_hash"],
+                                                                                  state_dataset_id_list)
+        table_backup_state_dict = self.firestore.get_all_table_doc_field_dict(["lastModifiedTime", "content_hash"],
+                                                                              state_dataset_id_list)
+        # list.append is thread safe
+        write_result_list = []
+        next_cursor = None
+        with self.firestore.batch_writer() as writer:
+            with contextlib.ExitStack() as stack:
+                if executor is None:
+                    # shared executor is shut down by its owner
+                    executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.backup_worker_num))
+                future_set = set()
+                for dataset_id in dataset_id_list:
+                    start_table_id = cursor["table_id"] if cursor and cursor["dataset_id"] == dataset_id else None
+                    # backup dataset description
+                    if start_table_id is None:
+                        if self._is_deadline_passed(deadline):
+                            next_cursor = {"dataset_id": dataset_id, "table_id": None}
+                            break
+                        self._submit_backup(executor, future_set, result_type_counter,
+                                            self._backup_dataset_desc, dataset_id, writer, write_result_list,
+                                            dataset_backup_state_dict.get(dataset_id, {}).get("content_hash"))
+                    # backup table description
+                    if getattr(self.config, "backup_bulk_metadata", False):
+                        self._submit_backup(executor, future_set, result_type_counter,
+                                            self._backup_table_desc_bulk, dataset_id, writer, write_result_list,
+                                            table_backup_state_dict)
+                        continue
+                    stop_table_id = self._submit_table_backup(
+                        dataset_id, mode, executor, future_set, writer, write_result_list, table_backup_state_dict,
+                        result_type_counter, start_table_id, deadline)
+                    if stop_table_id is not None:
+                        next_cursor = {"dataset_id": dataset_id, "table_id": stop_table_id}
+                        break
+                self._count_backup_future(as_completed(future_set), result_type_counter)
+        for result in write_result_list:
+            result_type_counter[result] += 1
+        return next_cursor
+
+    def _list_backup_dataset_id(self, shard=None, cursor=None) -> [str]:
+        dataset_id_list = sorted(self.bigquery.list_dataset_id(selector=self.dataset_selector))
+        if shard is not None:
+            dataset_id_list = [dataset_id for dataset_id in dataset_id_list
+                               if shard_of(dataset_id, shard[1]) == shard[0]]
+        if cursor is not None:
+            dataset_id_list = [dataset_id for dataset_id in dataset_id_list if dataset_id >= cursor["dataset_id"]]
+        return dataset_id_list
+
+    def _submit_table_backup(self, dataset_id, mode, executor, future_set, writer, write_result_list,
+                             table_backup_state_dict, result_type_counter, start_table_id=None, deadline=None):
+        """
+        Submit backup of tables in dataset from start_table_id in order of id.
+        :return: table_id to resume from if deadline has passed, otherwise None
+        """
+        try:
+            last_modified_time_dict = {}
+            if mode == "incremental":
+                last_modified_time_dict = self._list_table_last_modified_time(dataset_id)
+            for table_id in sorted(self.bigquery.list_table_id(dataset_id, selector=self.table_selector)):
+                if start_table_id is not None and table_id < start_table_id:
+                    continue
+                if self._is_deadline_passed(deadline):
+                    return table_id
+                has_backup = f"{dataset_id}.{table_id}" in table_backup_state_dict
+                backup_state = table_backup_state_dict.get(f"{dataset_id}.{table_id}", {})
+                last_modified_time = last_modified_time_dict.get(table_id)
+                if last_modified_time is not None and \
+                        last_modified_time == backup_state.get("lastModifiedTime"):
+                    self.logger.debug(f"[BACKUP] [T] [not_modified] [{dataset_id}.{table_id}]")
+                    result_type_counter["not_modified"] += 1
+                    continue
+                self._submit_backup(executor, future_set, result_type_counter,
+                                    self._backup_table_desc, dataset_id, table_id, writer,
+                                    write_result_list, backup_state.get("content_hash"), None,
+                                    backup_state.get("lastModifiedTime"), has_backup)
+        except Exception as e:
+            # In case of list error
+            self.logger.exception(e)
+            result_type_counter["exception"] += 1
+        return None
+
+    def _submit_backup(self, executor, future_set, result_type_counter, fn, *args):
+        """
+        Submit fn(*args) after waiting until less than config.backup_worker_num gets are in flight.
+        executor.submit returns at once, so without the wait all tables would be queued before the first deadline
+        check, and the run would not stop until all of them are done.
+        Finished futures are counted and removed from future_set.
+        """
+        while len(future_set) >= self.backup_worker_num:
+            done_set, _ = wait(future_set, return_when=FIRST_COMPLETED)
+            future_set -= done_set
+            self._count_backup_future(done_set, result_type_counter)
+        future_set.add(executor.submit(fn, *args))
+
+    def _count_backup_future(self, future_list, result_type_counter):
+        for future in future_list:
+            try:
+                result_list = future.result()
+                if isinstance(result_list, str):
+                    result_list = [result_list]
+                for result in result_list:
+                    if result != "queued":
+                        result_type_counter[result] += 1
+            except Exception as e:
+                self.logger.exception(e)
+                result_type_counter["exception"] += 1
+
+    @staticmethod
+    def _is_deadline_passed(deadline) -> bool:
+        return deadline is not None and time.monotonic() >= deadline
+
+    def backup_shard(self, shard_index, shard_count, run_id=None, mode=None, time_budget_sec=None) -> str:
+        """
+        Backup datasets in one shard. Datasets are partitioned by stable hash of dataset id.
+        Each shard has its own checkpoint. See backup_all for time_budget_sec.
+        :param run_id: If given, result is recorded in the backup summary document of run_id.
+        """
+        self.logger.info(f"[BACKUP] shard {shard_index}/{shard_count} run_id={run_id}")
+        try:
+            result_type_counter, is_finished = self._backup_all_resumable(
+                mode, shard=(shard_index, shard_count), time_budget_sec=time_budget_sec)
+        except Exception as e:
+            if run_id is not None:
+                self.firestore.put_backup_shard_result(run_id, shard_index, shard_count, None, error=str(e))
+            raise e
+        if not is_finished:
+            msg = f"Backup Shard {shard_index} Suspended before deadline. It will be resumed by the next run."
+            if run_id is not None:
+                self.firestore.put_backup_shard_result(run_id, shard_index, shard_count, result_type_counter,
+                                                       error=msg)
+            self.logger.warning(f"[BACKUP] {msg} result={result_type_counter}")
+            return msg
+        if run_id is not None:
+            self.firestore.put_backup_shard_result(run_id, shard_index, shard_count, result_type_counter)
+        if result_type_counter["exception"] > 0:
+            self.logger.error(f"[BACKUP] Finish shard {shard_index} with some errors. result={result_type_counter}")
+            raise Exception(f"Backup Shard {shard_index} Failed. {result_type_counter}")
+        self.logger.info(f"[BACKUP] Finish shard {shard_index} with no error. result={result_type_counter}")
+        return str(result_type_counter)
+
+    def backup_all_sharded(self, shard_count=None, mode=None) -> str:
+        """
+        Coordinator of sharded backup. Call this Cloud Function (config.cloud_functions_url) with "backup_shard"
+        action for each shard concurrently, and wait for all of them.
+        Results of shards are merged in the backup summary document, and the total, state and failed shards
+        are written to it at the end.
+        Timeouts are nested, so that the coordinator outlives the calls and each shard returns before its call
+        times out: the call times out config.backup_shard_timeout_margin_sec before the coordinator
+        (config.cloud_functions_timeout_sec), and the time budget of each shard is the margin shorter than the call.
+        :param shard_count: Default is config.backup_shard_count
+        """
+        start = time.monotonic()
+        shard_count = shard_count or getattr(self.config, "backup_shard_count", 8)
+        timeout_sec = getattr(self.config, "cloud_functions_timeout_sec", 540)
+        margin_sec = getattr(self.config, "backup_shard_timeout_margin_sec", 60)
+        invoke_timeout_sec = timeout_sec - margin_sec
+        shard_time_budget_sec = invoke_timeout_sec - margin_sec
+        if shard_time_budget_sec <= 0:
+            raise Exception(f"cloud_functions_timeout_sec ({timeout_sec}) must be larger"
+                            f" than 2 * backup_shard_timeout_margin_sec ({margin_sec})")
+        run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S-") + uuid.uuid4().hex[:8]
+        self.logger.info(f"[BACKUP] Backup all with {shard_count} shards. run_id={run_id}"
+                         f" shard time budget={shard_time_budget_sec} sec")
+        invoker = FunctionInvoker(getattr(self.config, "cloud_functions_url", None), self.logger,
+                                  timeout_sec=invoke_timeout_sec - (time.monotonic() - start))
+        with ThreadPoolExecutor(max_workers=shard_count) as executor:
+            future_list = [executor.submit(invoker.invoke, {"action": "backup_shard", "shard_index": shard_index,
+                                                            "shard_count": shard_count, "run_id": run_id,
+                                                            "mode": mode, "time_budget_sec": shard_time_budget_sec,
+                                                            "project": self.project})
+                           for shard_index in range(shard_count)]
+            for future in as_completed(future_list):
+                try:
+                    future.result()
+                except Exception as e:
+                    # e.g. timeout. The shard is reported as not finished below.
+                    self.logger.exception(e)
+        summary = self.firestore.get_backup_summary(run_id)
+        failed_shard_list = []
+        for shard_index in range(shard_count):
+            shard = summary["shards"].get(str(shard_index))
+            if shard is None or shard["error"] is not None or shard["result"]["exception"] > 0:
+                failed_shard_list.append(shard_index)
+        self.firestore.put_backup_summary_total(run_id, summary["total"], failed_shard_list)
+        if failed_shard_list:
+            self.logger.error(f"[BACKUP] Finish with some errors. failed shards={failed_shard_list}"
+                              f" result={summary['total']}")
+            raise Exception(f"Backup All Sharded Failed. run_id={run_id} failed shards={failed_shard_list}"
+                            f" {summary['total']}")
+        self.logger.info(f"[BACKUP] Finish with no error. run_id={run_id} result={summary['total']}")
+        return str(summary["total"])
+
+    def backup_all_projects(self, mode=None) -> str:
+        """
+        Backup all projects which are visible to the credentials and selected by
+        config.project_include_pattern / config.project_exclude_pattern.
+        config.project_concurrency projects are processed concurrently. Their gets run on one thread pool of
+        config.backup_worker_num workers, which caps BigQuery requests in flight of all projects.
+        BigQuery clients of the projects share one credentials.
+        Descriptions are stored in collections namespaced by project. See Firestore.for_project.
+        """
+        project_selector = Selector(getattr(self.config, "project_include_pattern", r'.*'),
+                                    getattr(self.config, "project_exclude_pattern", r'^$'))
+        project_id_list = self.bigquery.list_project_id(selector=project_selector)
+        self.logger.info(f"[BACKUP] Backup {len(project_id_list)} projects")
+        result_type_counter = {"ok": 0, "skip": 0, "skip_unchanged": 0, "not_modified": 0, "exception": 0}
+        failed_project_list = []
+        with ThreadPoolExecutor(max_workers=self.backup_worker_num) as executor:
+            with ThreadPoolExecutor(max_workers=getattr(self.config, "project_concurrency", 4)) as project_executor:
+                future_dict = {project_executor.submit(self._backup_project, project_id, mode, executor): project_id
+                               for project_id in project_id_list}
+                for future in as_completed(future_dict):
+                    project_id = future_dict[future]
+                    try:
+                        project_result_type_counter = future.result()
+                    except Exception as e:
+                        self.logger.exception(e)
+                        failed_project_list.append(project_id)
+                        continue
+                    self.logger.info(f"[BACKUP] [P] [{project_id}] result={project_result_type_counter}")
+                    if project_result_type_counter["exception"] > 0:
+                        failed_project_list.append(project_id)
+                    for result_type, num in project_result_type_counter.items():
+                        result_type_counter[result_type] += num
+        self.logger.info(f"[BACKUP] BigQuery rate limiter: {self.bigquery.rate_limiter.stats()}")
+        if failed_project_list:
+            self.logger.error(f"[BACKUP] Finish with some errors. failed projects={sorted(failed_project_list)}"
+                              f" result={result_type_counter}")
+            raise Exception(f"Backup All Projects Failed. failed projects={sorted(failed_project_list)}"
+                            f" {result_type_counter}")
+        self.logger.info(f"[BACKUP] Finish with no error. projects={len(project_id_list)} result={result_type_counter}")
+        return str(result_type_counter)
+
+    def _backup_project(self, project_id, mode, executor) -> dict:
+        controller = self.for_project(project_id)
+        # no time budget. all projects are processed to the end in this run.
+        result_type_counter, _ = controller._backup_all_resumable(mode, executor, time_budget_sec=0)
+        return result_type_counter
+
     # -----------------------------------------
     # RESTORE
     # -----------------------------------------
@@ -114,46 +559,249 @@ class Controller:
         self.logger.info(f"{bq_update_result.type.value}. {bq_update_result.detail}")
         return bq_update_result
 
-    def restore_all(self) -> str:
-        self.logger.info(
-            f"[RESTORE] Restore FireStore ({self.firestore.table_desc_col}) to BigQuery Table and FireStore ({self.firestore.dataset_desc_col}) to BigQuery Datasets")
+    def _count_restore_result(self, result_type_counter, kind, name, bq_update_result: BqUpdateResult) -> int:
+        """
+        Count up restore result and write log.
+        :return: number of errors (0 or 1)
+        """
+        msg = f"[RESTORE] [{kind}] [{bq_update_result.type.value}] [{name}] {bq_update_result.detail}"
+        result_type_counter[bq_update_result.type.value] += 1
+        if bq_update_result.is_success:
+            self.logger.info(msg)
+            return 0
+        else:
+            self.logger.warning(msg)
+            return 1
+
+    def _new_restore_result_counter(self) -> dict:
         result_type_counter = {"exception": 0}
         for _, result_type in ResultType.__members__.items():
             result_type_counter[result_type.value] = 0
+        return result_type_counter
+
+    def restore_all(self) -> str:
+        """
+        Restore all dataset and table descriptions.
+        If config.restore_max_in_flight is more than 1, datasets and tables are restored concurrently with asyncio.
+        If config.restore_prefetch_bulk_metadata is True, current state of tables are prefetched per dataset
+        with INFORMATION_SCHEMA query, and tables which are same as backup are not requested one by one.
+        """
+        self.logger.info(
+            f"[RESTORE] Restore FireStore ({self.firestore.table_desc_col}) to BigQuery Table and FireStore ({self.firestore.dataset_desc_col}) to BigQuery Datasets")
+        result_type_counter = self._new_restore_result_counter()
+
+        prefetcher = None
+        if getattr(self.config, "restore_prefetch_bulk_metadata", False):
+            prefetcher = TableDescPrefetcher(self.bigquery.bulk_metadata_reader, self.logger)
+
+        if self.restore_max_in_flight > 1:
+            error_count = asyncio.run(self._restore_all_async(result_type_counter, prefetcher))
+        else:
+            error_count = self._restore_all_serial(result_type_counter, prefetcher)
+        self.logger.info(f"[RESTORE] BigQuery rate limiter: {self.bigquery.rate_limiter.stats()}")
+
+        if error_count > 0:
+            self.logger.error(f"[RESTORE] Finish with some errors. Result = {result_type_counter}")
+            raise Exception(f"Restore All Failed. {result_type_counter}")
+        else:
+            self.logger.info(f"[RESTORE] Finish with no error. Result = {result_type_counter}")
+            return str(result_type_counter)
 
+    def _update_table_desc(self, table_desc: TableDesc, prefetcher: TableDescPrefetcher = None) -> BqUpdateResult:
+        now_table_desc = None
+        if prefetcher is not None:
+            now_table_desc = prefetcher.get(table_desc.dataset_id, table_desc.table_id)
+        return self.bigquery.update_table_desc(new_table_desc=table_desc, now_table_desc=now_table_desc)
+
+    def _restore_all_serial(self, result_type_counter, prefetcher=None) -> int:
         error_count = 0
-        for dataset_desc in self.firestore.get_all_dataset_desc_list():
+        for dataset_desc in self.firestore.iter_all_dataset_desc():
             try:
                 bq_update_result: BqUpdateResult = self.bigquery.update_dataset_desc(dataset_desc=dataset_desc)
-                msg = f"[RESTORE] [D] [{bq_update_result.type.value}] [{dataset_desc.dataset_id}] {bq_update_result.detail}"
-                result_type_counter[bq_update_result.type.value] += 1
-                if bq_update_result.is_success:
-                    self.logger.info(msg)
-                else:
-                    error_count += 1
-                    self.logger.warning(msg)
+                error_count += self._count_restore_result(result_type_counter, "D", dataset_desc.dataset_id,
+                                                          bq_update_result)
             except Exception as e:
                 self.logger.exception(e)
                 result_type_counter["exception"] += 1
                 error_count += 1
 
-        for table_desc in self.firestore.get_all_table_desc_list():
+        for table_desc in self.firestore.iter_all_table_desc():
             try:
-                bq_update_result: BqUpdateResult = self.bigquery.update_table_desc(new_table_desc=table_desc)
-                msg = f"[RESTORE] [D] [{bq_update_result.type.value}] [{table_desc.dataset_id}.{table_desc.table_id}] {bq_update_result.detail}"
-                result_type_counter[bq_update_result.type.value] += 1
-                if bq_update_result.is_success:
-                    self.logger.info(msg)
-                else:
-                    self.logger.warning(msg)
+                bq_update_result: BqUpdateResult = self._update_table_desc(table_desc, prefetcher)
+                error_count += self._count_restore_result(result_type_counter, "T",
+                                                          f"{table_desc.dataset_id}.{table_desc.table_id}",
+                                                          bq_update_result)
+            except Exception as e:
+                self.logger.exception(e)
+                result_type_counter["exception"] += 1
+                error_count += 1
+        return error_count
+
+    async def _restore_all_async(self, result_type_counter, prefetcher=None) -> int:
+        """
+        Stream dataset and table descriptions from Firestore concurrently and restore them
+        with at most config.restore_max_in_flight BigQuery requests in flight.
+        BigQuery client is blocking, so each request runs on a thread pool of the same size.
+        Counting is done on the event loop thread only.
+        One FireStore AsyncClient is used in the run, and closed at the end.
+        """
+        loop = asyncio.get_running_loop()
+        max_in_flight = self.restore_max_in_flight
+        semaphore = asyncio.Semaphore(max_in_flight)
+        pending = set()
+        error_count = 0
+
+        async def restore_one(kind, name, update_func):
+            nonlocal error_count
+            try:
+                bq_update_result: BqUpdateResult = await loop.run_in_executor(executor, update_func)
+                error_count += self._count_restore_result(result_type_counter, kind, name, bq_update_result)
+            except Exception as e:
+                self.logger.exception(e)
+                result_type_counter["exception"] += 1
+                error_count += 1
+            finally:
+                semaphore.release()
+
+        async def submit(kind, name, update_func):
+            # wait for a free slot before reading next document, so that memory is bounded by max_in_flight
+            await semaphore.acquire()
+            task = asyncio.ensure_future(restore_one(kind, name, update_func))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        async def restore_datasets():
+            async for dataset_desc in self.firestore.stream_all_dataset_desc_async(async_client):
+                await submit("D", dataset_desc.dataset_id,
+                             functools.partial(self.bigquery.update_dataset_desc, dataset_desc=dataset_desc))
+
+        async def restore_tables():
+            async for table_desc in self.firestore.stream_all_table_desc_async(async_client):
+                await submit("T", f"{table_desc.dataset_id}.{table_desc.table_id}",
+                             functools.partial(self._update_table_desc, table_desc, prefetcher))
+
+        async_client = self.firestore.new_async_client()
+        try:
+            with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+                try:
+                    await asyncio.gather(restore_datasets(), restore_tables())
+                finally:
+                    if pending:
+                        await asyncio.gather(*pending)
+        finally:
+            await self.firestore.close_async_client(async_client)
+        return error_count
+
+    # -----------------------------------------
+    # RESTORE PLAN / APPLY
+    # -----------------------------------------
+
+    def restore_plan(self, path) -> str:
+        """
+        Diff all dataset and table descriptions of the backup with BigQuery, and write only the updates to make
+        (with etag and diff of each entity) to the plan file at path. Nothing is updated on BigQuery.
+        Current state of tables are prefetched per dataset with INFORMATION_SCHEMA query, and only tables
+        which differ from the backup are fetched one by one (to get etag and full schema).
+        If some entities failed (e.g. too many deletion), the plan of the others is written and an exception is raised.
+        """
+        self.logger.info(
+            f"[RESTORE] Plan restore of FireStore ({self.firestore.table_desc_col}, {self.firestore.dataset_desc_col}) to BigQuery. plan={path}")
+        result_type_counter = self._new_restore_result_counter()
+        prefetcher = TableDescPrefetcher(self.bigquery.bulk_metadata_reader, self.logger)
+        error_count = 0
+
+        def iter_job():
+            for dataset_desc in self.firestore.iter_all_dataset_desc():
+                yield KIND_DATASET, dataset_desc.dataset_id, \
+                    functools.partial(self.bigquery.plan_dataset_update, dataset_desc)
+            for table_desc in self.firestore.iter_all_table_desc():
+                yield KIND_TABLE, f"{table_desc.dataset_id}.{table_desc.table_id}", \
+                    functools.partial(self._plan_table_update, table_desc, prefetcher)
+
+        with RestorePlanWriter(path, project=self.bigquery.project, table_desc_col=self.firestore.table_desc_col,
+                               dataset_desc_col=self.firestore.dataset_desc_col) as writer:
+            def on_done(kind, name, future):
+                nonlocal error_count
+                try:
+                    bq_update_result, update = future.result()
+                    error_count += self._count_restore_result(result_type_counter, RESTORE_LOG_KIND[kind], name,
+                                                              bq_update_result)
+                    if update is not None:
+                        writer.write(kind, update)
+                except Exception as e:
+                    self.logger.exception(e)
+                    result_type_counter["exception"] += 1
                     error_count += 1
+
+            self._run_restore_jobs(iter_job(), on_done)
+        summary = f"tables to update={writer.num_of_updates[KIND_TABLE]}" \
+                  f" datasets to update={writer.num_of_updates[KIND_DATASET]} result={result_type_counter}"
+        if error_count > 0:
+            self.logger.error(f"[RESTORE] Plan finished with some errors. {summary}")
+            raise Exception(f"Restore Plan Failed. {summary}")
+        self.logger.info(f"[RESTORE] Plan finished with no error. {summary}")
+        return summary
+
+    def _plan_table_update(self, table_desc: TableDesc, prefetcher: TableDescPrefetcher):
+        now_table_desc = prefetcher.get(table_desc.dataset_id, table_desc.table_id)
+        return self.bigquery.plan_table_update(new_table_desc=table_desc, now_table_desc=now_table_desc)
+
+    def restore_apply(self, path) -> str:
+        """
+        Apply the updates of a plan made by restore_plan as they are, without diffing again.
+        Each update is conditional on the etag at the plan. Entities modified since the plan are rejected
+        (counted as "changed since plan"), so make a new plan for them.
+        """
+        self.logger.info(f"[RESTORE] Apply restore plan {path} to BigQuery")
+        result_type_counter = self._new_restore_result_counter()
+        error_count = 0
+
+        def on_done(kind, name, future):
+            nonlocal error_count
+            try:
+                error_count += self._count_restore_result(result_type_counter, RESTORE_LOG_KIND[kind], name,
+                                                          future.result())
             except Exception as e:
                 self.logger.exception(e)
                 result_type_counter["exception"] += 1
                 error_count += 1
+
+        with RestorePlanReader(path) as reader:
+            if reader.header["project"] != self.bigquery.project:
+                raise Exception(f"{path} is a plan of project {reader.header['project']},"
+                                f" not of {self.bigquery.project}")
+
+            def iter_job():
+                for kind, update in reader.iter_updates():
+                    if kind == KIND_DATASET:
+                        yield kind, update["dataset_id"], functools.partial(self.bigquery.apply_dataset_update, **update)
+                    else:
+                        yield kind, f"{update['dataset_id']}.{update['table_id']}", \
+                            functools.partial(self.bigquery.apply_table_update, **update)
+
+            self._run_restore_jobs(iter_job(), on_done)
+        self.logger.info(f"[RESTORE] BigQuery rate limiter: {self.bigquery.rate_limiter.stats()}")
+
         if error_count > 0:
-            self.logger.error(f"[RESTORE] Finish with some errors. Result = {result_type_counter}")
-            raise Exception(f"Restore All Failed. {result_type_counter}")
-        else:
-            self.logger.info(f"[RESTORE] Finish with no error. Result = {result_type_counter}")
-            return str(result_type_counter)
+            self.logger.error(f"[RESTORE] Apply finished with some errors. Result = {result_type_counter}")
+            raise Exception(f"Restore Apply Failed. {result_type_counter}")
+        self.logger.info(f"[RESTORE] Apply finished with no error. Result = {result_type_counter}")
+        return str(result_type_counter)
+
+    def _run_restore_jobs(self, job_iter, on_done):
+        """
+        Run fn of each (kind, name, fn) of job_iter on a thread pool, with at most config.restore_max_in_flight
+        in flight. The next job is read only when a slot is free, so that memory is bounded.
+        on_done(kind, name, future) is called on the calling thread, so it needs no lock.
+        """
+        max_in_flight = self.restore_max_in_flight
+        future_dict = {}
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for kind, name, fn in job_iter:
+                while len(future_dict) >= max_in_flight:
+                    done_set, _ = wait(future_dict, return_when=FIRST_COMPLETED)
+                    for future in done_set:
+                        on_done(*future_dict.pop(future), future)
+                future_dict[executor.submit(fn)] = (kind, name)
+            for future in as_completed(list(future_dict)):
+                on_done(*future_dict.pop(future), future)
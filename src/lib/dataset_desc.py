@@ -1,8 +1,14 @@
+import hashlib
+import json
+
+
 class DatasetDesc(object):
     def __init__(self, in_dict):
         self.project_id = in_dict["datasetReference"]["projectId"]
         self.dataset_id = in_dict["datasetReference"]["datasetId"]
         self.description = in_dict.get("description", "")
+        # etag is not a part of description. It is not included in to_dict().
+        self.etag = in_dict.get("etag", "")
 
     def is_no_description(self):
         return self.description == ""
@@ -15,3 +21,10 @@ class DatasetDesc(object):
                 "datasetId": self.dataset_id
             }
         }
+
+    def content_hash(self) -> str:
+        """
+        Stable hash of to_dict(). Used to skip writing unchanged description.
+        """
+        dic_str = json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(dic_str.encode("utf-8")).hexdigest()
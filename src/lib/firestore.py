@@ -1,64 +1,296 @@
-import os
-from datetime import datetime, timezone
+import copy
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+from google.cloud import firestore
+from google.cloud.firestore import AsyncClient
 
 from lib.dataset_desc import DatasetDesc
+from lib.gcp_auth import get_credentials
+from lib.metrics import Metrics, timed
+from lib.snapshot_file import KIND_DATASET, KIND_TABLE, SnapshotFileReader, SnapshotFileWriter
 from lib.table_desc import TableDesc
 
+# Firestore limit of writes in one commit
+MAX_BATCH_SIZE = 500
+
+SNAPSHOT_TYPE_FULL = "full"
+SNAPSHOT_TYPE_DELTA = "delta"
+# field of the document in delta snapshot, which means the document was deleted after the parent snapshot
+TOMBSTONE_FIELD = "_tombstone"
+# field of the table document which records only lastModifiedTime of a table with no description.
+# Such documents are not backups. They are skipped by readers of table descriptions.
+NO_DESCRIPTION_FIELD = "_no_description"
+# collection of snapshot registry documents. document id is the table description collection name
+SNAPSHOT_REGISTRY_COL = "snapshot_registry"
+
 
 class Firestore(object):
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, credentials=None, client=None, metrics: Metrics = None):
+        """
+        :param credentials: google.auth credentials. Default is the credentials shared in the process.
+        :param client: firestore.Client to use instead of a new one (e.g. fake client of bench/load_harness.py).
+                       AsyncClient is made by client.async_client().
+        :param metrics: Metrics which records calls of public methods, page reads and batch commits.
+                        If None, make new one.
+        """
         self.logger = logger
+        self.config = config
         self.project = config.gcp_project
+        # BigQuery project of the descriptions. See for_project.
+        self.bq_project = config.gcp_project
         self.table_desc_col = config.firestore_table_desc_collection_name
         self.dataset_desc_col = config.firesotre_dataset_desc_collection_name
-        os.environ["GOOGLE_CLOUD_PROJECT"] = self.project
-        if config.gcp_use_key_json:
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config.gcp_key_json
+        # keys added after the first release are optional, so that config.py made from an old sample still works
+        self.backup_summary_col = getattr(config, "firestore_backup_summary_collection_name",
+                                          'bqdesc-backupper-backup-summary')
+        self.read_page_size = getattr(config, "firestore_read_page_size", 300)
+        if client is None:
+            self.credentials = credentials or get_credentials(config)
+            self.firestore_client = firestore.Client(project=self.project, credentials=self.credentials)
+        else:
+            self.credentials = credentials
+            self.firestore_client = client
+        self.is_client_given = client is not None
+        self.metrics = metrics or Metrics()
+        # one document which records all snapshots. not prefixed by table_desc_col, not to be taken for a snapshot
+        self.snapshot_registry_ref = self.firestore_client.collection(SNAPSHOT_REGISTRY_COL) \
+            .document(self.table_desc_col)
 
-        cred = credentials.ApplicationDefault()
-        if not firebase_admin._DEFAULT_APP_NAME in firebase_admin._apps:
-            # Avoid double initialize
-            firebase_admin.initialize_app(cred, {'projectId': self.project, })
-        self.firestore_client = firestore.client()
+    def for_project(self, bq_project) -> "Firestore":
+        """
+        Firestore which stores descriptions of another BigQuery project in the same database.
+        Collections are namespaced as "<collection>-<project>". config.gcp_project uses the collections as they are.
+        The FireStore client and metrics are shared.
+        """
+        if bq_project == self.bq_project:
+            return self
+        other = copy.copy(self)
+        other.bq_project = bq_project
+        other.table_desc_col = self.config.firestore_table_desc_collection_name
+        other.dataset_desc_col = self.config.firesotre_dataset_desc_collection_name
+        if bq_project != self.project:
+            other.table_desc_col += f"-{bq_project}"
+            other.dataset_desc_col += f"-{bq_project}"
+        other.snapshot_registry_ref = self.firestore_client.collection(SNAPSHOT_REGISTRY_COL) \
+            .document(other.table_desc_col)
+        return other
+
+    def with_metrics(self, metrics) -> "Firestore":
+        """
+        Firestore which records calls to metrics (e.g. one Metrics per request). The FireStore client is shared.
+        """
+        if metrics is self.metrics:
+            return self
+        other = copy.copy(self)
+        other.metrics = metrics
+        return other
+
+    def new_async_client(self) -> AsyncClient:
+        """
+        AsyncClient is bound to the event loop it is used in, so make one for each event loop
+        and close it with close_async_client() when the loop ends.
+        """
+        if self.is_client_given:
+            return self.firestore_client.async_client()
+        return AsyncClient(project=self.project, credentials=self.credentials)
+
+    async def close_async_client(self, async_client: AsyncClient):
+        """
+        AsyncClient has no close(). Close the gRPC channel of its API client, if it was made.
+        """
+        api = getattr(async_client, "_firestore_api_internal", None)
+        if api is not None:
+            await api.transport.close()
+
+    def batch_writer(self):
+        return FirestoreBatchWriter(self.firestore_client, self.logger,
+                                    batch_size=getattr(self.config, "firestore_batch_size", 500),
+                                    flush_interval_sec=getattr(self.config, "firestore_batch_flush_interval_sec", 5),
+                                    metrics=self.metrics)
+
+    def _stream_collection(self, col, page_size=None, read_time=None):
+        """
+        Yield document snapshots of collection ordered by document id.
+        Documents are read page_size at a time with cursor, so memory does not grow with collection size.
+        Each page is read before it is yielded, so that metrics of the read do not include time of the consumer.
+        :param read_time: If given, read documents as of this time.
+        """
+        page_size = page_size or self.read_page_size
+        query = self.firestore_client.collection(col).order_by("__name__").limit(page_size)
+        last_doc = None
+        while True:
+            page_query = query if last_doc is None else query.start_after(last_doc)
+            with self.metrics.span("firestore.read_page"):
+                doc_list = list(page_query.stream(read_time=read_time))
+            yield from doc_list
+            if len(doc_list) < page_size:
+                return
+            last_doc = doc_list[-1]
+
+    async def _stream_collection_async(self, async_client: AsyncClient, col, page_size=None):
+        """
+        Async version of _stream_collection()
+        :param async_client: made by new_async_client() in the running event loop
+        """
+        page_size = page_size or self.read_page_size
+        query = async_client.collection(col).order_by("__name__").limit(page_size)
+        last_doc = None
+        while True:
+            page_query = query if last_doc is None else query.start_after(last_doc)
+            with self.metrics.span("firestore.read_page"):
+                doc_list = [doc async for doc in page_query.stream()]
+            for doc in doc_list:
+                yield doc
+            if len(doc_list) < page_size:
+                return
+            last_doc = doc_list[-1]
+
+    def _get_all_doc_field_dict(self, col, field_path_list) -> dict:
+        query = self.firestore_client.collection(col).select(field_path_list)
+        return {u.id: u.to_dict() for u in query.stream()}
+
+    def _get_doc_field_dict_by_prefix(self, col, field_path_list, prefix_list) -> dict:
+        """
+        Same as _get_all_doc_field_dict, but only documents whose id starts with any of prefix_list.
+        One query of document id range per prefix, so only the matching documents are read (and billed).
+        """
+        col_ref = self.firestore_client.collection(col)
+        ret = {}
+        for prefix in prefix_list:
+            # U+10FFFF is the largest code point, so the range covers all ids starting with prefix
+            query = col_ref.select(field_path_list) \
+                .where(filter=firestore.FieldFilter("__name__", ">=", col_ref.document(prefix))) \
+                .where(filter=firestore.FieldFilter("__name__", "<", col_ref.document(prefix + "\U0010ffff")))
+            ret.update({u.id: u.to_dict() for u in query.stream()})
+        return ret
+
+    def _set(self, doc_ref, dic, writer=None, on_done=None):
+        if writer is None:
+            doc_ref.set(dic)
+        else:
+            writer.set(doc_ref, dic, on_done)
 
     # ------------------
     # Table
     # ------------------
 
-    def put_table_desc(self, dataset_id, table_id, table_desc: TableDesc):
+    @timed("firestore.put_table_desc")
+    def put_table_desc(self, dataset_id, table_id, table_desc: TableDesc, writer=None, on_done=None):
+        """
+        :param writer: FirestoreBatchWriter. If given, the write is queued to it and on_done(error) is called after commit.
+        """
         doc_ref = self.firestore_client.collection(self.table_desc_col).document(f"{dataset_id}.{table_id}")
         dic = table_desc.to_dict()
         # to make timezone aware datetime instance, pass timzeone.utc
         dic["created_at"] = datetime.now(timezone.utc)
-        doc_ref.set(dic)
+        # used by incremental backup to detect tables modified since the last backup
+        dic["etag"] = table_desc.etag
+        dic["lastModifiedTime"] = table_desc.last_modified_time
+        # used by backup to skip writing unchanged description
+        dic["content_hash"] = table_desc.content_hash()
+        self._set(doc_ref, dic, writer, on_done)
 
+    @timed("firestore.put_table_modified_time")
+    def put_table_modified_time(self, dataset_id, table_id, table_desc: TableDesc, writer=None, on_done=None):
+        """
+        Update only etag and lastModifiedTime of the backup, when the description itself is unchanged.
+        See put_table_desc for writer.
+        """
+        doc_ref = self.firestore_client.collection(self.table_desc_col).document(f"{dataset_id}.{table_id}")
+        dic = {"etag": table_desc.etag, "lastModifiedTime": table_desc.last_modified_time}
+        if writer is None:
+            doc_ref.update(dic)
+        else:
+            writer.update(doc_ref, dic, on_done)
+
+    @timed("firestore.put_table_no_description")
+    def put_table_no_description(self, dataset_id, table_id, table_desc: TableDesc, writer=None, on_done=None):
+        """
+        Record lastModifiedTime of a table with no description and no backup, so that incremental backup
+        does not fetch it again until it is modified. See put_table_desc for writer.
+        """
+        doc_ref = self.firestore_client.collection(self.table_desc_col).document(f"{dataset_id}.{table_id}")
+        dic = {"tableReference": table_desc.to_dict()["tableReference"],
+               NO_DESCRIPTION_FIELD: True,
+               "created_at": datetime.now(timezone.utc),
+               "etag": table_desc.etag,
+               "lastModifiedTime": table_desc.last_modified_time}
+        self._set(doc_ref, dic, writer, on_done)
+
+    @timed("firestore.get_all_table_doc_field_dict")
+    def get_all_table_doc_field_dict(self, field_path_list, dataset_id_list=None) -> dict:
+        """
+        Read only specified fields of all table documents with one query.
+        :param dataset_id_list: If given, only tables of these datasets are read, with one query per dataset.
+        :return: {document_id: {field: value}}
+        """
+        if dataset_id_list is not None:
+            return self._get_doc_field_dict_by_prefix(self.table_desc_col, field_path_list,
+                                                      [f"{dataset_id}." for dataset_id in dataset_id_list])
+        return self._get_all_doc_field_dict(self.table_desc_col, field_path_list)
+
+    @timed("firestore.get_table_desc")
     def get_table_desc(self, dataset_id, table_id) -> TableDesc:
         doc_ref = self.firestore_client.collection(self.table_desc_col).document(f"{dataset_id}.{table_id}")
         doc_snp = doc_ref.get()
-        if doc_snp.exists:
+        if doc_snp.exists and not doc_snp.to_dict().get(NO_DESCRIPTION_FIELD):
             return TableDesc(in_dict=doc_snp.to_dict())
         else:
             raise Exception(
                 f"Does not exist. collection = {self.dataset_desc_col} document_id = {dataset_id}.{table_id}")
 
     def get_all_table_desc_list(self) -> [TableDesc]:
-        doc_ref = self.firestore_client.collection(self.table_desc_col)
-        return [TableDesc(in_dict=u.to_dict()) for u in doc_ref.get()]
+        return list(self.iter_all_table_desc())
+
+    def iter_all_table_desc(self, page_size=None):
+        """
+        Generator of all TableDesc. Documents are read page by page.
+        """
+        for u in self._stream_collection(self.table_desc_col, page_size):
+            dic = u.to_dict()
+            if not dic.get(NO_DESCRIPTION_FIELD):
+                yield TableDesc(in_dict=dic)
+
+    async def stream_all_table_desc_async(self, async_client: AsyncClient, page_size=None):
+        async for u in self._stream_collection_async(async_client, self.table_desc_col, page_size):
+            dic = u.to_dict()
+            if not dic.get(NO_DESCRIPTION_FIELD):
+                yield TableDesc(in_dict=dic)
 
     # ------------------
     # Dataset
     # ------------------
 
-    def put_dataset_desc(self, dataset_id, dataset_desc: DatasetDesc):
+    @timed("firestore.put_dataset_desc")
+    def put_dataset_desc(self, dataset_id, dataset_desc: DatasetDesc, writer=None, on_done=None):
+        """
+        :param writer: FirestoreBatchWriter. If given, the write is queued to it and on_done(error) is called after commit.
+        """
         doc_ref = self.firestore_client.collection(self.dataset_desc_col).document(f"{dataset_id}")
         dic = dataset_desc.to_dict()
         dic["created_at"] = datetime.now(timezone.utc)
-        doc_ref.set(dic)
+        dic["content_hash"] = dataset_desc.content_hash()
+        self._set(doc_ref, dic, writer, on_done)
 
+    @timed("firestore.get_all_dataset_doc_field_dict")
+    def get_all_dataset_doc_field_dict(self, field_path_list, dataset_id_list=None) -> dict:
+        """
+        Read only specified fields of all dataset documents with one query.
+        :param dataset_id_list: If given, only documents of these datasets are read.
+        :return: {document_id: {field: value}}
+        """
+        if dataset_id_list is not None:
+            col_ref = self.firestore_client.collection(self.dataset_desc_col)
+            doc_ref_list = [col_ref.document(dataset_id) for dataset_id in dataset_id_list]
+            doc_snp_list = self.firestore_client.get_all(doc_ref_list, field_paths=field_path_list)
+            return {u.id: u.to_dict() for u in doc_snp_list if u.exists}
+        return self._get_all_doc_field_dict(self.dataset_desc_col, field_path_list)
+
+    @timed("firestore.get_dataset_desc")
     def get_dataset_desc(self, dataset_id) -> DatasetDesc:
         doc_ref = self.firestore_client.collection(self.dataset_desc_col).document(f"{dataset_id}")
         doc_snp = doc_ref.get()
@@ -68,64 +300,522 @@ class Firestore(object):
             raise Exception(f"Does not exist. collection = {self.dataset_desc_col} document_id = {dataset_id}")
 
     def get_all_dataset_desc_list(self) -> [DatasetDesc]:
-        doc_ref = self.firestore_client.collection(self.dataset_desc_col)
-        return [DatasetDesc(in_dict=u.to_dict()) for u in doc_ref.get()]
+        return list(self.iter_all_dataset_desc())
+
+    def iter_all_dataset_desc(self, page_size=None):
+        """
+        Generator of all DatasetDesc. Documents are read page by page.
+        """
+        for u in self._stream_collection(self.dataset_desc_col, page_size):
+            yield DatasetDesc(in_dict=u.to_dict())
+
+    async def stream_all_dataset_desc_async(self, async_client: AsyncClient, page_size=None):
+        async for u in self._stream_collection_async(async_client, self.dataset_desc_col, page_size):
+            yield DatasetDesc(in_dict=u.to_dict())
+
+    # ------------------
+    # Backup Summary
+    # ------------------
+
+    @timed("firestore.put_backup_shard_result")
+    def put_backup_shard_result(self, run_id, shard_index, shard_count, result_type_counter, error=None):
+        """
+        Record result of one shard in the summary document of run_id.
+        Each shard writes only its own entry, so a retried shard overwrites its previous result.
+        """
+        doc_ref = self.firestore_client.collection(self.backup_summary_col).document(run_id)
+        doc_ref.set({"shard_count": shard_count,
+                     "shards": {str(shard_index): {"result": result_type_counter, "error": error,
+                                                   "finished_at": datetime.now(timezone.utc)}}},
+                    merge=True)
+
+    @timed("firestore.put_backup_summary_total")
+    def put_backup_summary_total(self, run_id, total, failed_shard_list):
+        """
+        Record merged result of all shards in the summary document of run_id, when the coordinator finishes.
+        state is "succeeded" if no shard failed, otherwise "failed".
+        """
+        doc_ref = self.firestore_client.collection(self.backup_summary_col).document(run_id)
+        doc_ref.set({"total": total, "state": "failed" if failed_shard_list else "succeeded",
+                     "failed_shards": failed_shard_list, "finished_at": datetime.now(timezone.utc)},
+                    merge=True)
+
+    @timed("firestore.get_backup_summary")
+    def get_backup_summary(self, run_id) -> dict:
+        """
+        :return: {"shard_count", "shards": {shard_index: {"result", "error", "finished_at"}}, "total": {result type: num}}
+            "total" is merged from results of shards recorded so far.
+            "state", "failed_shards" and "finished_at" are there after the coordinator finished.
+        """
+        doc_snp = self.firestore_client.collection(self.backup_summary_col).document(run_id).get()
+        summary = doc_snp.to_dict() if doc_snp.exists else {"shard_count": 0, "shards": {}}
+        total = {}
+        for shard in summary["shards"].values():
+            for result_type, num in (shard["result"] or {}).items():
+                total[result_type] = total.get(result_type, 0) + num
+        summary["total"] = total
+        return summary
+
+    def _backup_checkpoint_ref(self, name):
+        # namespaced by collection, as backups of projects share the summary collection
+        return self.firestore_client.collection(self.backup_summary_col) \
+            .document(f"checkpoint-{self.table_desc_col}-{name}")
+
+    @timed("firestore.get_backup_checkpoint")
+    def get_backup_checkpoint(self, name) -> dict:
+        """
+        :return: {"mode", "cursor", "result", "updated_at"} or None if there is no checkpoint
+        """
+        doc_snp = self._backup_checkpoint_ref(name).get()
+        return doc_snp.to_dict() if doc_snp.exists else None
+
+    @timed("firestore.put_backup_checkpoint")
+    def put_backup_checkpoint(self, checkpoint, name):
+        self._backup_checkpoint_ref(name).set(dict(checkpoint, updated_at=datetime.now(timezone.utc)))
+
+    @timed("firestore.delete_backup_checkpoint")
+    def delete_backup_checkpoint(self, name):
+        self._backup_checkpoint_ref(name).delete()
 
     # ------------------
     # DB SnapShot
     # ------------------
 
-    def _copy_collection(self, src_col, dst_col):
-        doc_ref = self.firestore_client.collection(src_col)
-        src_list = doc_ref.get()
-        for src_doc_snapshot in src_list:
-            doc_ref = self.firestore_client.collection(dst_col).document(src_doc_snapshot.id)
-            doc_ref.set(src_doc_snapshot.to_dict())
-
-    def _copy_doc(self, src_col, dst_col, document_id):
-        src_doc_ref = self.firestore_client.collection(src_col).document(document_id)
-        src_doc = src_doc_ref.get()._data
-        if src_doc == None:
-            raise Exception(f"FireStore collection={src_col} document_id={document_id} is not found")
-        else:
-            dst_doc_ref = self.firestore_client.collection(dst_col).document(document_id)
-            dst_doc_ref.set(src_doc)
+    def _copy_collection(self, src_col, dst_col) -> (int, int):
+        """
+        Copy all documents as of one read_time (point-in-time copy).
+        The source collection is split into partitions, which are streamed and copied concurrently with batch writes.
+        Memory is bounded by batch size.
+        :return: number of copied documents and their estimated storage size in bytes
+        """
+        start = time.monotonic()
+        # a little in the past, not to be ahead of the server clock
+        read_time = datetime.now(timezone.utc) - timedelta(seconds=1)
+        # Partition query is supported only by collection group. Source collections are top-level collections.
+        partition_list = list(self.firestore_client.collection_group(src_col).get_partitions(
+            getattr(self.config, "snapshot_copy_partition_num", 8), read_time=read_time))
+        dst_col_ref = self.firestore_client.collection(dst_col)
+        # list.append is thread safe
+        error_list = []
+
+        def on_done(error):
+            if error is not None:
+                error_list.append(error)
+
+        def copy_partition(partition) -> (int, int):
+            num_of_docs = num_of_bytes = 0
+            for src_doc_snapshot in partition.query().stream(read_time=read_time):
+                if src_doc_snapshot.reference.parent.parent is not None:
+                    # sub collection which has the same name in another document
+                    continue
+                dic = src_doc_snapshot.to_dict()
+                writer.set(dst_col_ref.document(src_doc_snapshot.id), dic, on_done)
+                num_of_docs += 1
+                num_of_bytes += estimate_doc_size(dst_col, src_doc_snapshot.id, dic)
+            return num_of_docs, num_of_bytes
+
+        with self.batch_writer() as writer:
+            with ThreadPoolExecutor(max_workers=max(1, len(partition_list))) as executor:
+                result_list = list(executor.map(copy_partition, partition_list))
+        num_of_docs = sum(n for n, _ in result_list)
+        if error_list:
+            raise Exception(f"Fail to copy {len(error_list)} documents. {src_col} -> {dst_col}. {error_list[0]}")
+        sec = time.monotonic() - start
+        self.logger.info(f"copied {num_of_docs} documents in {sec:.1f} sec ({num_of_docs / max(sec, 0.001):.1f} docs/sec)"
+                         f" with {len(partition_list)} partitions")
+        return num_of_docs, sum(b for _, b in result_list)
+
+    def _copy_collection_delta(self, src_col, dst_col, desc_class, parent_snapshot_id, registry) -> (int, int):
+        """
+        Copy documents as of one read_time, only if content hash differs from the one in parent snapshot chain.
+        Documents which are in parent snapshot chain but not in source collection are written as tombstones.
+        :param desc_class: TableDesc or DatasetDesc, to compute content hash of documents which do not have it
+        :param registry: {snapshot_id: entry} read from snapshot registry
+        :return: number of written documents and their estimated storage size in bytes
+        """
+        start = time.monotonic()
+        read_time = datetime.now(timezone.utc) - timedelta(seconds=1)
+        prev_hash_dict = self._resolve_snapshot_hash_dict(src_col, parent_snapshot_id, registry)
+        dst_col_ref = self.firestore_client.collection(dst_col)
+        error_list = []
+
+        def on_done(error):
+            if error is not None:
+                error_list.append(error)
+
+        num_of_docs = num_of_bytes = 0
+        with self.batch_writer() as writer:
+            for src_doc_snapshot in self._stream_collection(src_col, read_time=read_time):
+                dic = src_doc_snapshot.to_dict()
+                # documents backed up by old version do not have content_hash
+                content_hash = dic.get("content_hash") or desc_class(in_dict=dic).content_hash()
+                if prev_hash_dict.pop(src_doc_snapshot.id, None) != content_hash:
+                    dic["content_hash"] = content_hash
+                    writer.set(dst_col_ref.document(src_doc_snapshot.id), dic, on_done)
+                    num_of_docs += 1
+                    num_of_bytes += estimate_doc_size(dst_col, src_doc_snapshot.id, dic)
+            # remaining documents were deleted after parent snapshot
+            for document_id in prev_hash_dict:
+                writer.set(dst_col_ref.document(document_id), {TOMBSTONE_FIELD: True}, on_done)
+                num_of_bytes += estimate_doc_size(dst_col, document_id, {TOMBSTONE_FIELD: True})
+        if error_list:
+            raise Exception(f"Fail to copy {len(error_list)} documents. {src_col} -> {dst_col}. {error_list[0]}")
+        self.logger.info(f"copied {num_of_docs} changed documents and {len(prev_hash_dict)} tombstones"
+                         f" in {time.monotonic() - start:.1f} sec")
+        return num_of_docs + len(prev_hash_dict), num_of_bytes
+
+    def _resolve_snapshot_hash_dict(self, col, snapshot_id, registry) -> dict:
+        """
+        :return: {document_id: content_hash} of documents in snapshot, resolved from the full snapshot to snapshot_id
+        """
+        hash_dict = {}
+        for chain_snapshot_id in reversed(list(self._iter_snapshot_chain(snapshot_id, registry))):
+            field_dict = self._get_all_doc_field_dict(f"{col}-{chain_snapshot_id}", ["content_hash", TOMBSTONE_FIELD])
+            for document_id, dic in field_dict.items():
+                if dic.get(TOMBSTONE_FIELD):
+                    hash_dict.pop(document_id, None)
+                else:
+                    hash_dict[document_id] = dic.get("content_hash")
+        return hash_dict
+
+    def _get_snapshot_registry(self) -> dict:
+        """
+        Registry document is {"snapshots": {snapshot_id: entry}}. See make_db_snapshot for entry.
+        If the registry document does not exist yet, it is made by migrate_snapshot_registry() (only once).
+        :return: {snapshot_id: entry}
+        """
+        doc_snp = self.snapshot_registry_ref.get()
+        if not doc_snp.exists:
+            return self.migrate_snapshot_registry()
+        return doc_snp.to_dict().get("snapshots", {})
+
+    @timed("firestore.migrate_snapshot_registry")
+    def migrate_snapshot_registry(self) -> dict:
+        """
+        Record snapshot collections made before the registry ("<table_desc_col>-YYYYMMDD") in the registry
+        as full snapshots. It scans names of all collections, so it is run once: when the registry document
+        does not exist, or by "snapshot migrate-registry" if snapshots were made by an old version after that.
+        :return: {snapshot_id: entry} of the registry after migration
+        """
+        doc_snp = self.snapshot_registry_ref.get()
+        registry = doc_snp.to_dict().get("snapshots", {}) if doc_snp.exists else {}
+        snapshot_pattern = re.compile("^" + re.escape(self.table_desc_col + "-") + r"(\d{8})$")
+        legacy_registry = {}
+        for col in self.firestore_client.collections():
+            m = snapshot_pattern.match(col.id)
+            if m and m.group(1) not in registry:
+                legacy_registry[m.group(1)] = {"id": m.group(1), "type": SNAPSHOT_TYPE_FULL, "parent": None,
+                                               "chain_length": 1}
+        self.logger.info(f"Record {len(legacy_registry)} snapshots made before the registry:"
+                         f" {sorted(legacy_registry.keys())}")
+        if legacy_registry:
+            self.snapshot_registry_ref.set({"snapshots": legacy_registry}, merge=True)
+        elif not doc_snp.exists:
+            # the registry document tells that migration was done
+            self.snapshot_registry_ref.set({"snapshots": {}})
+        registry.update(legacy_registry)
+        return registry
+
+    @staticmethod
+    def _iter_snapshot_chain(snapshot_id, registry):
+        """
+        Yield snapshot ids from snapshot_id back to the full snapshot which the chain starts from.
+        Snapshot not in registry (made by old version) is a full snapshot.
+        """
+        while snapshot_id is not None:
+            yield snapshot_id
+            entry = registry.get(snapshot_id)
+            snapshot_id = entry["parent"] if entry is not None and entry["type"] == SNAPSHOT_TYPE_DELTA else None
+
+    def _clear_collection(self, col):
+        with self.batch_writer() as writer:
+            for doc in self._stream_collection(col):
+                writer.delete(doc.reference)
 
-    def make_db_snapshot(self):
-        self.logger.info(f"Make FileStore snapshot collection")
+    @timed("firestore.make_db_snapshot")
+    def make_db_snapshot(self, mode=None):
+        """
+        Copy description collections to snapshot collections, and record the snapshot in registry document.
+        :param mode: "full" or "delta". Default is config.snapshot_mode.
+        """
+        mode = mode or getattr(self.config, "snapshot_mode", "full")
+        if mode not in [SNAPSHOT_TYPE_FULL, SNAPSHOT_TYPE_DELTA]:
+            raise Exception(f"Unknown snapshot mode {mode}")
         ymd = datetime.now().strftime("%Y%m%d")
-        for src_col, dst_col in [(self.table_desc_col, self.table_desc_col + "-" + ymd),
-                                 (self.dataset_desc_col, self.dataset_desc_col + "-" + ymd)]:
+        registry = self._get_snapshot_registry()
+        entry = {"id": ymd, "type": SNAPSHOT_TYPE_FULL, "parent": None, "chain_length": 1}
+        if mode == SNAPSHOT_TYPE_DELTA:
+            previous_id_list = [snapshot_id for snapshot_id in registry.keys() if snapshot_id < ymd]
+            if not previous_id_list:
+                self.logger.info("No previous snapshot. Make full snapshot")
+            elif registry[max(previous_id_list)]["chain_length"] >= getattr(self.config, "snapshot_checkpoint_interval", 7):
+                self.logger.info(f"Chain of snapshot {max(previous_id_list)} reached checkpoint interval."
+                                 f" Make full snapshot")
+            else:
+                parent_id = max(previous_id_list)
+                entry.update(type=SNAPSHOT_TYPE_DELTA, parent=parent_id,
+                             chain_length=registry[parent_id]["chain_length"] + 1)
+        self.logger.info(f"Make FileStore {entry['type']} snapshot collection")
+        entry["collections"] = []
+        for src_col, desc_class in [(self.table_desc_col, TableDesc), (self.dataset_desc_col, DatasetDesc)]:
+            dst_col = src_col + "-" + ymd
+            if ymd in registry:
+                # documents of previous run in the same day are not overwritten by delta
+                self.logger.info(f"clear {dst_col} made before")
+                self._clear_collection(dst_col)
             self.logger.info(f"copy {src_col} -> {dst_col}")
-            self._copy_collection(src_col=src_col, dst_col=dst_col)
+            if entry["type"] == SNAPSHOT_TYPE_DELTA:
+                num_of_docs, num_of_bytes = self._copy_collection_delta(src_col, dst_col, desc_class,
+                                                                        entry["parent"], registry)
+            else:
+                num_of_docs, num_of_bytes = self._copy_collection(src_col=src_col, dst_col=dst_col)
+            entry["collections"].append({"source": src_col, "snapshot": dst_col,
+                                         "num_of_docs": num_of_docs, "num_of_bytes": num_of_bytes})
+        entry["num_of_docs"] = sum(c["num_of_docs"] for c in entry["collections"])
+        entry["num_of_bytes"] = sum(c["num_of_bytes"] for c in entry["collections"])
+        entry["created_at"] = datetime.now(timezone.utc)
+        # merge not to overwrite other entries. one entry is a few hundred bytes, far below 1MiB document limit
+        self.snapshot_registry_ref.set({"snapshots": {ymd: entry}}, merge=True)
         return ymd
 
-    def list_db_snapshot(self):
-        snapshot_list = []
-        snapshot_prefix = self.table_desc_col + "-"
-        for col in self.firestore_client.collections():
-            if col.id.find(snapshot_prefix) > -1:
-                snapshot_list.append(col.id.replace(snapshot_prefix, ""))
-        return snapshot_list
+    @timed("firestore.make_file_snapshot")
+    def make_file_snapshot(self, path):
+        """
+        Export all table and dataset descriptions as of one read_time to a local compressed snapshot file.
+        See lib.snapshot_file for the format.
+        """
+        self.logger.info(f"Make FireStore snapshot file {path}")
+        read_time = datetime.now(timezone.utc) - timedelta(seconds=1)
+        with SnapshotFileWriter(path) as writer:
+            for kind, src_col in [(KIND_TABLE, self.table_desc_col), (KIND_DATASET, self.dataset_desc_col)]:
+                for doc in self._stream_collection(src_col, read_time=read_time):
+                    writer.write(kind, doc.id, doc.to_dict())
+                self.logger.info(f"export {src_col} -> {path} ({writer.num_of_docs(kind)} documents)")
+        return path
 
+    @timed("firestore.list_db_snapshot")
+    def list_db_snapshot(self) -> [dict]:
+        """
+        :return: registry entries of snapshots ordered by id. Read from the registry document only.
+            Entries of snapshots made before the registry (see migrate_snapshot_registry) have no created_at.
+        """
+        registry = self._get_snapshot_registry()
+        return [registry[snapshot_id] for snapshot_id in sorted(registry.keys())]
+
+    @timed("firestore.recover_table_from_snapshot")
     def recover_table_from_snapshot(self, dataset_id, table_id, snap_shot_ymd):
         """
         Copy table description in snapshot collection to production collection
         """
         self.logger.info(
             f"Recover table data on FireStore from snapshot. table={dataset_id}.{table_id}, snapshot_id={snap_shot_ymd}")
-        src_col = self.table_desc_col + "-" + snap_shot_ymd
-        dst_col = self.table_desc_col
-        self.logger.info(f"copy {src_col}:{dataset_id}.{table_id} -> {dst_col}:{dataset_id}.{table_id} ")
-        self._copy_doc(src_col=src_col, dst_col=dst_col, document_id=f"{dataset_id}.{table_id}")
+        self._recover_doc_from_snapshot(self.table_desc_col, snap_shot_ymd, f"{dataset_id}.{table_id}")
 
+    @timed("firestore.recover_dataset_from_snapshot")
     def recover_dataset_from_snapshot(self, dataset_id, snap_shot_ymd):
         """
         Copy dataset description in snapshot collection to production collection
         """
         self.logger.info(
             f"Recover dataset data on FireStore from snapshot. dataset={dataset_id}, snapshot_id={snap_shot_ymd}")
-        src_col = self.dataset_desc_col + "-" + snap_shot_ymd
-        dst_col = self.dataset_desc_col
-        self.logger.info(f"copy {src_col}:{dataset_id} -> {dst_col}:{dataset_id} ")
-        self._copy_doc(src_col=src_col, dst_col=dst_col, document_id=f"{dataset_id}")
+        self._recover_doc_from_snapshot(self.dataset_desc_col, snap_shot_ymd, f"{dataset_id}")
+
+    def _recover_doc_from_snapshot(self, col, snapshot_id, document_id):
+        """
+        Copy document in snapshot to production collection.
+        For delta snapshot, the document is resolved by walking back the chain of snapshots.
+        """
+        for chain_snapshot_id in self._iter_snapshot_chain(snapshot_id, self._get_snapshot_registry()):
+            src_col = col + "-" + chain_snapshot_id
+            doc_snp = self.firestore_client.collection(src_col).document(document_id).get()
+            if not doc_snp.exists:
+                continue
+            doc = doc_snp.to_dict()
+            if doc.get(TOMBSTONE_FIELD):
+                # deleted before the snapshot
+                break
+            self.logger.info(f"copy {src_col}:{document_id} -> {col}:{document_id} ")
+            self.firestore_client.collection(col).document(document_id).set(doc)
+            return
+        raise Exception(f"FireStore snapshot={snapshot_id} collection={col} document_id={document_id} is not found")
+
+    @timed("firestore.recover_table_from_snapshot_file")
+    def recover_table_from_snapshot_file(self, dataset_id, table_id, path):
+        """
+        Copy table description in local snapshot file to production collection
+        """
+        self.logger.info(
+            f"Recover table data on FireStore from snapshot file. table={dataset_id}.{table_id}, file={path}")
+        self._recover_doc_from_snapshot_file(KIND_TABLE, self.table_desc_col, f"{dataset_id}.{table_id}", path)
+
+    @timed("firestore.recover_dataset_from_snapshot_file")
+    def recover_dataset_from_snapshot_file(self, dataset_id, path):
+        """
+        Copy dataset description in local snapshot file to production collection
+        """
+        self.logger.info(f"Recover dataset data on FireStore from snapshot file. dataset={dataset_id}, file={path}")
+        self._recover_doc_from_snapshot_file(KIND_DATASET, self.dataset_desc_col, f"{dataset_id}", path)
+
+    def _recover_doc_from_snapshot_file(self, kind, dst_col, document_id, path):
+        self.logger.info(f"copy {path}:{document_id} -> {dst_col}:{document_id} ")
+        with SnapshotFileReader(path) as reader:
+            try:
+                doc = reader.get(kind, document_id)
+            except KeyError:
+                raise Exception(f"snapshot file={path} document_id={document_id} is not found")
+        self.firestore_client.collection(dst_col).document(document_id).set(doc)
+
+
+class FirestoreBatchWriter(object):
+    """
+    Group document writes into WriteBatch.
+    Pending writes are committed when batch_size writes are queued or flush_interval_sec has passed
+    since the first pending write. Thread safe.
+    Used as a context manager, a background thread commits pending writes on flush_interval_sec
+    even if no more write is queued, and the rest are committed on exit.
+    Result of each document is notified by on_done(error) after commit. error is None on success.
+    """
+
+    def __init__(self, firestore_client, logger, batch_size=MAX_BATCH_SIZE, flush_interval_sec=5.0,
+                 metrics: Metrics = None):
+        """
+        :param metrics: Metrics which records commits. If None, make new one.
+        """
+        self.firestore_client = firestore_client
+        self.logger = logger
+        self.metrics = metrics or Metrics()
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.flush_interval_sec = flush_interval_sec
+        self.lock = threading.Lock()
+        self.pending = []
+        self.first_pending_at = None
+        self.closing = threading.Event()
+        self.flusher = None
+
+    def __enter__(self):
+        self.closing.clear()
+        self.flusher = threading.Thread(target=self._flush_periodically, name="firestore-batch-flusher", daemon=True)
+        self.flusher.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.closing.set()
+        self.flusher.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        wait_sec = self.flush_interval_sec
+        while not self.closing.wait(wait_sec):
+            with self.lock:
+                if not self.pending:
+                    wait_sec = self.flush_interval_sec
+                    continue
+                wait_sec = self.first_pending_at + self.flush_interval_sec - time.monotonic()
+                if wait_sec > 0:
+                    continue
+                write_list = self._take_pending()
+                wait_sec = self.flush_interval_sec
+            try:
+                self._commit(write_list)
+            except Exception as e:
+                self.logger.exception(e)
+
+    def set(self, doc_ref, dic, on_done=None):
+        self._queue("set", doc_ref, dic, on_done)
+
+    def update(self, doc_ref, dic, on_done=None):
+        """
+        Update only the fields in dic. The document must exist.
+        """
+        self._queue("update", doc_ref, dic, on_done)
+
+    def delete(self, doc_ref, on_done=None):
+        self._queue("delete", doc_ref, None, on_done)
+
+    def _queue(self, op, doc_ref, dic, on_done):
+        """
+        :param op: "set", "update" or "delete"
+        """
+        with self.lock:
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending.append((op, doc_ref, dic, on_done))
+            if len(self.pending) >= self.batch_size or \
+                    time.monotonic() - self.first_pending_at >= self.flush_interval_sec:
+                write_list = self._take_pending()
+            else:
+                write_list = []
+        # commit outside of the lock so that other threads can keep queueing
+        if write_list:
+            self._commit(write_list)
+
+    def flush(self):
+        with self.lock:
+            write_list = self._take_pending()
+        if write_list:
+            self._commit(write_list)
+
+    def _take_pending(self):
+        write_list = self.pending
+        self.pending = []
+        self.first_pending_at = None
+        return write_list
+
+    def _commit(self, write_list):
+        batch = self.firestore_client.batch()
+        for op, doc_ref, dic, _ in write_list:
+            _add_to_batch(batch, op, doc_ref, dic)
+        try:
+            with self.metrics.span("firestore.batch_commit"):
+                batch.commit()
+        except Exception as e:
+            # WriteBatch is atomic. Write one by one to find out which documents failed.
+            self.logger.warning(f"Batch write of {len(write_list)} documents failed. Retry one by one. {e}")
+            for op, doc_ref, dic, on_done in write_list:
+                try:
+                    single_batch = self.firestore_client.batch()
+                    _add_to_batch(single_batch, op, doc_ref, dic)
+                    with self.metrics.span("firestore.batch_commit"):
+                        single_batch.commit()
+                    error = None
+                except Exception as e:
+                    error = e
+                if on_done is not None:
+                    on_done(error)
+            return
+        for _, _, _, on_done in write_list:
+            if on_done is not None:
+                on_done(None)
+
+
+def _add_to_batch(batch, op, doc_ref, dic):
+    if op == "set":
+        batch.set(doc_ref, dic)
+    elif op == "update":
+        batch.update(doc_ref, dic)
+    else:
+        batch.delete(doc_ref)
+
+
+def estimate_doc_size(col, document_id, dic) -> int:
+    """
+    Storage size of a top-level FireStore document, by the rules in
+    https://cloud.google.com/firestore/docs/storage-size
+    """
+    name_size = len(col.encode("utf-8")) + 1 + len(document_id.encode("utf-8")) + 1 + 16
+    return name_size + _field_value_size(dic) + 32
+
+
+def _field_value_size(value) -> int:
+    if isinstance(value, dict):
+        return sum(len(k.encode("utf-8")) + 1 + _field_value_size(v) for k, v in value.items())
+    if isinstance(value, list):
+        return sum(_field_value_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if value is None or isinstance(value, bool):
+        return 1
+    # number, timestamp
+    return 8
@@ -0,0 +1,26 @@
+import google.auth.transport.requests
+import google.oauth2.id_token
+import requests
+
+
+class FunctionInvoker(object):
+    """
+    Call HTTP triggered Cloud Functions with ID token of the runtime service account.
+    """
+
+    def __init__(self, url, logger, timeout_sec):
+        self.url = url
+        self.logger = logger
+        self.timeout_sec = timeout_sec
+
+    def invoke(self, payload) -> (int, str):
+        """
+        :return: HTTP status code and response text
+        """
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), self.url)
+        response = requests.post(self.url, json=payload, headers={"Authorization": f"Bearer {token}"},
+                                 timeout=self.timeout_sec)
+        if response.status_code != 200:
+            self.logger.error(f"Fail to invoke {self.url}. payload={payload}"
+                              f" status={response.status_code} text={response.text}")
+        return response.status_code, response.text
@@ -0,0 +1,24 @@
+import os
+import threading
+
+import google.auth
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+_lock = threading.Lock()
+_credentials = None
+
+
+def get_credentials(config):
+    """
+    Credentials shared by all clients (BigQuery, FireStore) in the process. Made on first call.
+    Sharing one credentials object means one token refresh for all clients.
+    """
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            os.environ["GOOGLE_CLOUD_PROJECT"] = config.gcp_project
+            if config.gcp_use_key_json:
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config.gcp_key_json
+            _credentials, _ = google.auth.default(scopes=SCOPES)
+        return _credentials
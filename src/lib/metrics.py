@@ -0,0 +1,232 @@
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from datetime import datetime, timezone
+
+# upper bounds of latency histogram buckets (seconds). The last bucket is +Inf.
+LATENCY_BUCKET_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+OPENMETRICS_PREFIX = "bqdesc"
+
+
+class Histogram(object):
+    """
+    Latency histogram of fixed buckets. Not thread safe (guarded by Metrics).
+    """
+
+    def __init__(self):
+        self.bucket_count_list = [0] * (len(LATENCY_BUCKET_SEC) + 1)
+        self.count = 0
+        self.error_count = 0
+        self.sum_sec = 0.0
+        self.max_sec = 0.0
+
+    def observe(self, sec, is_error=False):
+        index = 0
+        while index < len(LATENCY_BUCKET_SEC) and sec > LATENCY_BUCKET_SEC[index]:
+            index += 1
+        self.bucket_count_list[index] += 1
+        self.count += 1
+        self.error_count += is_error
+        self.sum_sec += sec
+        self.max_sec = max(self.max_sec, sec)
+
+    def quantile(self, q) -> float:
+        """
+        Estimate by linear interpolation in the bucket. The +Inf bucket is interpolated up to max_sec.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.bucket_count_list):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = LATENCY_BUCKET_SEC[index - 1] if index > 0 else 0.0
+                upper = LATENCY_BUCKET_SEC[index] if index < len(LATENCY_BUCKET_SEC) else self.max_sec
+                return min(self.max_sec, lower + (upper - lower) * (rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+        return self.max_sec
+
+    def to_dict(self, with_buckets) -> dict:
+        ret = {"count": self.count, "errors": self.error_count, "sum_sec": round(self.sum_sec, 6),
+               "max_sec": round(self.max_sec, 6)}
+        if with_buckets:
+            ret.update({"p50_sec": round(self.quantile(0.5), 6), "p90_sec": round(self.quantile(0.9), 6),
+                        "p99_sec": round(self.quantile(0.99), 6),
+                        "buckets": [[le, n] for le, n in zip(list(LATENCY_BUCKET_SEC) + ["+Inf"],
+                                                             self.bucket_count_list)]})
+        return ret
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of BigQuery / FireStore calls, per operation and per dataset.
+    Shared by all threads of an action. Call start() at the beginning of each action and report() at the end.
+
+    Calls are recorded by span() or methods decorated with timed().
+    Each span is also notified to span listeners (e.g. Profiler, which makes a timeline of them).
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        :param clock: replaceable for tests
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        # replaced (not mutated) on change, so that span() reads it without the lock
+        self.span_listener_list = []
+        self.start()
+
+    def start(self, action=None):
+        """
+        Reset all counters for a new action.
+        """
+        with self.lock:
+            self.action = action
+            self.started_at = datetime.now(timezone.utc)
+            self.started_clock = self.clock()
+            # op -> Histogram
+            self.op_dict = {}
+            # dataset_id -> op -> Histogram
+            self.dataset_dict = {}
+            # op -> exception class name -> count
+            self.error_type_dict = {}
+
+    def add_span_listener(self, listener):
+        """
+        :param listener: called as listener(op, start, end, dataset_id, table_id, error) by the thread of the span.
+            start and end are of the clock.
+        """
+        with self.lock:
+            self.span_listener_list = self.span_listener_list + [listener]
+
+    def remove_span_listener(self, listener):
+        with self.lock:
+            self.span_listener_list = [l for l in self.span_listener_list if l != listener]
+
+    @contextlib.contextmanager
+    def span(self, op, dataset_id=None, table_id=None):
+        """
+        Record latency of the block as one call of op. An exception of the block is counted as an error of op.
+        :param table_id: not aggregated. Only passed to span listeners.
+        """
+        start = self.clock()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            end = self.clock()
+            self.observe(op, end - start, dataset_id, error)
+            for listener in self.span_listener_list:
+                listener(op, start, end, dataset_id, table_id, error)
+
+    def observe(self, op, sec, dataset_id=None, error=None):
+        with self.lock:
+            self._histogram_of(self.op_dict, op).observe(sec, error is not None)
+            if dataset_id is not None:
+                self._histogram_of(self.dataset_dict.setdefault(dataset_id, {}), op).observe(sec, error is not None)
+            if error is not None:
+                error_type_dict = self.error_type_dict.setdefault(op, {})
+                error_type = type(error).__name__
+                error_type_dict[error_type] = error_type_dict.get(error_type, 0) + 1
+
+    @staticmethod
+    def _histogram_of(dic, op) -> Histogram:
+        histogram = dic.get(op)
+        if histogram is None:
+            histogram = dic[op] = Histogram()
+        return histogram
+
+    def report(self, **extra) -> dict:
+        """
+        :param extra: added to the report as they are (e.g. status and message of the action)
+        :return: JSON serializable report of the action so far.
+            Operations have full histograms. Datasets have counts and latency sum/max only, not to be too large.
+        """
+        with self.lock:
+            return dict({
+                "action": self.action,
+                "started_at": self.started_at.isoformat(),
+                "elapsed_sec": round(self.clock() - self.started_clock, 6),
+                "operations": {op: dict(histogram.to_dict(with_buckets=True),
+                                        error_types=dict(self.error_type_dict.get(op, {})))
+                               for op, histogram in sorted(self.op_dict.items())},
+                "datasets": {dataset_id: {op: histogram.to_dict(with_buckets=False)
+                                          for op, histogram in sorted(op_dict.items())}
+                             for dataset_id, op_dict in sorted(self.dataset_dict.items())},
+            }, **extra)
+
+
+def timed(op):
+    """
+    Decorator of methods of a class with self.metrics. Each call is recorded as op by Metrics.span().
+    Dataset (and table) of the call is taken from dataset_id (and table_id) argument,
+    or from the first argument which has dataset_id attribute (TableDesc / DatasetDesc).
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            dataset_id, table_id = _entity_of(signature.bind_partial(self, *args, **kwargs).arguments)
+            with self.metrics.span(op, dataset_id, table_id):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _entity_of(arguments) -> (str, str):
+    """
+    :return: (dataset_id, table_id) of the call. None if unknown.
+    """
+    if "dataset_id" in arguments:
+        return arguments["dataset_id"], arguments.get("table_id")
+    for name, value in arguments.items():
+        if name != "self" and hasattr(value, "dataset_id"):
+            return value.dataset_id, getattr(value, "table_id", None)
+    return None, None
+
+
+def to_openmetrics(report) -> str:
+    """
+    OpenMetrics text exposition of report() (e.g. for the textfile collector of node_exporter).
+    Latency histograms are per operation. Per dataset, calls, errors and latency sum are counters.
+    """
+    line_list = []
+
+    def add(name, label_dict, value):
+        labels = ",".join(f'{key}="{_escape_label(label)}"' for key, label in label_dict.items())
+        line_list.append(f"{OPENMETRICS_PREFIX}_{name}{{{labels}}} {value}")
+
+    action_label = {"action": report["action"] or ""}
+    line_list.append(f"# TYPE {OPENMETRICS_PREFIX}_call_latency_seconds histogram")
+    line_list.append(f"# UNIT {OPENMETRICS_PREFIX}_call_latency_seconds seconds")
+    for op, op_report in report["operations"].items():
+        cumulative = 0
+        for le, count in op_report["buckets"]:
+            cumulative += count
+            add("call_latency_seconds_bucket", dict(action_label, op=op, le=le), cumulative)
+        add("call_latency_seconds_count", dict(action_label, op=op), op_report["count"])
+        add("call_latency_seconds_sum", dict(action_label, op=op), op_report["sum_sec"])
+    for name, key in [("dataset_calls", "count"), ("dataset_call_errors", "errors"),
+                      ("dataset_call_seconds", "sum_sec")]:
+        line_list.append(f"# TYPE {OPENMETRICS_PREFIX}_{name} counter")
+        for dataset_id, op_dict in report["datasets"].items():
+            for op, op_report in op_dict.items():
+                add(f"{name}_total", dict(action_label, op=op, dataset=dataset_id), op_report[key])
+    line_list.append(f"# TYPE {OPENMETRICS_PREFIX}_action_duration_seconds gauge")
+    add("action_duration_seconds", action_label, report["elapsed_sec"])
+    line_list.append("# EOF")
+    return "\n".join(line_list) + "\n"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
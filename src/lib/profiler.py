@@ -0,0 +1,112 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+
+from lib.metrics import Metrics
+
+
+class Profiler(object):
+    """
+    CPU profile (cProfile) of all threads, and timeline of BigQuery / FireStore calls recorded by Metrics spans.
+
+    write(prefix) writes
+        <prefix>.pstats      : profile of all threads merged. Read with pstats or snakeviz.
+        <prefix>.trace.json  : Chrome trace event format. Open with chrome://tracing or https://ui.perfetto.dev
+                               One row per thread. Each call is a slice with dataset and table in args.
+
+    Threads started after start() are profiled (worker threads of "backup all" / "restore all" are started
+    by the action). Up to Python 3.11, cProfile profiles only the thread which enabled it, so a profiler is enabled
+    in each new thread by threading.setprofile(). From Python 3.12, one profiler covers all threads.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.profile_list = []
+        # (op, start, end, thread id, dataset_id, table_id, is_error). Tuples, to keep the timeline of
+        # hundreds of thousands of calls small.
+        self.span_list = []
+        self.thread_name_dict = {}
+        self.started_clock = None
+
+    def start(self):
+        self.started_clock = self.metrics.clock()
+        self.metrics.add_span_listener(self._on_span)
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._enable_in_new_thread)
+        self._enable_profile()
+
+    def stop(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        self.metrics.remove_span_listener(self._on_span)
+        # worker threads of the action have ended, so their profiles have no more events
+        with self.lock:
+            for profile in self.profile_list:
+                profile.disable()
+
+    def _enable_in_new_thread(self, frame, event, arg):
+        # called by the first event of a new thread. Replaced by cProfile from here.
+        sys.setprofile(None)
+        self._enable_profile()
+
+    def _enable_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profile_list.append(profile)
+        profile.enable()
+
+    def _on_span(self, op, start, end, dataset_id, table_id, error):
+        thread = threading.current_thread()
+        # list.append is atomic
+        self.span_list.append((op, start, end, thread.ident, dataset_id, table_id, error is not None))
+        if thread.ident not in self.thread_name_dict:
+            self.thread_name_dict[thread.ident] = thread.name
+
+    def write(self, prefix) -> (str, str):
+        """
+        :return: paths of the pstats file and the trace file
+        """
+        pstats_path = prefix + ".pstats"
+        trace_path = prefix + ".trace.json"
+        with self.lock:
+            profile_list = list(self.profile_list)
+        stats = None
+        for profile in profile_list:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(pstats_path)
+        self._write_trace(trace_path)
+        return pstats_path, trace_path
+
+    def _write_trace(self, path):
+        """
+        Events are written one by one, not to build a large list of dicts.
+        """
+        pid = os.getpid()
+        with open(path, "w") as f:
+            f.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+            is_first = True
+            for tid, name in sorted(self.thread_name_dict.items()):
+                event = {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                f.write(("" if is_first else ",\n") + json.dumps(event))
+                is_first = False
+            for op, start, end, tid, dataset_id, table_id, is_error in self.span_list:
+                args = {key: value for key, value in [("dataset", dataset_id), ("table", table_id)] if value}
+                if is_error:
+                    args["error"] = True
+                event = {"name": op, "cat": op.split(".")[0], "ph": "X", "pid": pid, "tid": tid,
+                         "ts": round((start - self.started_clock) * 1e6, 3), "dur": round((end - start) * 1e6, 3),
+                         "args": args}
+                f.write(("" if is_first else ",\n") + json.dumps(event))
+                is_first = False
+            f.write("\n]}\n")
@@ -0,0 +1,126 @@
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Client-side rate limiter shared by API calls of all threads.
+
+    - Token bucket: calls are started at rate_per_sec on average, with bursts up to burst calls.
+    - AIMD concurrency: the number of calls in flight is limited. The limit grows by 1 after as many successes
+      as the limit (additive increase), and is halved when a call is throttled (multiplicative decrease).
+    - Backoff: a throttled call is retried after jittered exponential backoff ("full jitter"),
+      or after the time the server asked for (Retry-After), up to max_retry times.
+
+    Whether an error is throttling is told by throttle_of(exception), which returns None if it is not,
+    or seconds to wait hinted by the server (0 if no hint).
+    """
+
+    def __init__(self, throttle_of, rate_per_sec=0, burst=1, max_concurrency=16, min_concurrency=1, max_retry=5,
+                 base_backoff_sec=1.0, max_backoff_sec=60.0, clock=time.monotonic, sleep=time.sleep,
+                 rand=random.random):
+        """
+        :param rate_per_sec: 0 means no rate limit (concurrency limit and backoff still work)
+        :param clock, sleep, rand: replaceable for tests
+        """
+        self.throttle_of = throttle_of
+        self.rate_per_sec = rate_per_sec
+        self.burst = max(1, burst)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retry = max_retry
+        self.base_backoff_sec = base_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.tokens = float(self.burst)
+        self.last_refill_at = clock()
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.num_of_success_since_increase = 0
+        self.stats_dict = {"calls": 0, "throttled": 0, "gave_up": 0, "rate_wait_sec": 0.0, "backoff_sec": 0.0,
+                           "min_concurrency_limit": max_concurrency, "throttled_by_op": {}}
+
+    def call(self, op, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) under the limits.
+        :param op: name of the operation, for stats
+        :raise: exception of func. Throttling error is raised after max_retry retries.
+        """
+        for attempt in range(self.max_retry + 1):
+            self._acquire()
+            try:
+                ret = func(*args, **kwargs)
+            except Exception as e:
+                retry_after = self.throttle_of(e)
+                self._release(throttled=retry_after is not None, op=op)
+                if retry_after is None:
+                    raise e
+                if attempt == self.max_retry:
+                    with self.lock:
+                        self.stats_dict["gave_up"] += 1
+                    raise e
+                backoff_sec = self._backoff_sec(attempt, retry_after)
+                with self.lock:
+                    self.stats_dict["backoff_sec"] += backoff_sec
+                self.sleep(backoff_sec)
+                continue
+            self._release(throttled=False, op=op)
+            return ret
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats_dict, concurrency_limit=self.concurrency_limit,
+                        throttled_by_op=dict(self.stats_dict["throttled_by_op"]))
+
+    def _backoff_sec(self, attempt, retry_after) -> float:
+        if retry_after > 0:
+            # a little jitter not to retry all at once
+            return retry_after + self.rand() * self.base_backoff_sec
+        return self.rand() * min(self.max_backoff_sec, self.base_backoff_sec * (2 ** attempt))
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= self.concurrency_limit:
+                self.condition.wait()
+            self.in_flight += 1
+            self.stats_dict["calls"] += 1
+        if self.rate_per_sec > 0:
+            self._take_token()
+
+    def _take_token(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill_at) * self.rate_per_sec)
+                self.last_refill_at = now
+                # tolerance of float error of refill
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    return
+                wait_sec = (1 - self.tokens) / self.rate_per_sec
+                self.stats_dict["rate_wait_sec"] += wait_sec
+            self.sleep(wait_sec)
+
+    def _release(self, throttled, op):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.stats_dict["throttled"] += 1
+                self.stats_dict["throttled_by_op"][op] = self.stats_dict["throttled_by_op"].get(op, 0) + 1
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit // 2)
+                self.stats_dict["min_concurrency_limit"] = min(self.stats_dict["min_concurrency_limit"],
+                                                               self.concurrency_limit)
+                self.num_of_success_since_increase = 0
+            else:
+                self.num_of_success_since_increase += 1
+                if self.num_of_success_since_increase >= self.concurrency_limit and \
+                        self.concurrency_limit < self.max_concurrency:
+                    self.concurrency_limit += 1
+                    self.num_of_success_since_increase = 0
+            self.condition.notify_all()
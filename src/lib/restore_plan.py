@@ -0,0 +1,96 @@
+import json
+import os
+from datetime import datetime, timezone
+
+from lib.snapshot_file import KIND_DATASET, KIND_TABLE
+
+PLAN_VERSION = 1
+
+
+class RestorePlanWriter(object):
+    """
+    Write a restore plan made by "restore plan".
+
+    File format (JSON lines):
+        header {"version", "project", "created_at", ...}, then one line per entity to update {"kind", "update"}.
+        update is keyword arguments of Bigquery.apply_table_update / apply_dataset_update
+        (with etag of the entity at the plan, and diff for review).
+    Only entities to update are written, so the plan is small if the backup and BigQuery are mostly in sync.
+    The file is written to a temporary path and renamed on close. If the writer is aborted
+    (or exits with an exception), the temporary file is deleted and path is not touched.
+    """
+
+    def __init__(self, path, project, **header):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        self.num_of_updates = {KIND_TABLE: 0, KIND_DATASET: 0}
+        self._write_line(dict(header, version=PLAN_VERSION, project=project,
+                              created_at=datetime.now(timezone.utc).isoformat()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, kind, update):
+        self._write_line({"kind": kind, "update": update})
+        self.num_of_updates[kind] += 1
+
+    def _write_line(self, dic):
+        self.file.write(json.dumps(dic, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discard the partial output.
+        """
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class RestorePlanReader(object):
+    """
+    Reader of a restore plan written by RestorePlanWriter. Updates are read one by one, not all at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, encoding="utf-8")
+        line = self.file.readline()
+        try:
+            self.header = json.loads(line)
+        except ValueError:
+            self.header = None
+        if not isinstance(self.header, dict) or self.header.get("version") != PLAN_VERSION:
+            self.file.close()
+            raise Exception(f"{path} is not a restore plan of version {PLAN_VERSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def iter_updates(self):
+        """
+        Yield (kind, update) in the order of the plan.
+        """
+        for line in self.file:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry["kind"], entry["update"]
+
+    def close(self):
+        self.file.close()
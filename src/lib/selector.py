@@ -0,0 +1,89 @@
+import re
+import zlib
+
+MATCH_ALL = r'.*'
+MATCH_NONE = r'^$'
+
+LABEL_RULE_PREFIX = "labels."
+
+
+class Selector(object):
+    """
+    Include/exclude rules of project, dataset or table ids, compiled once.
+
+    A rule is a regexp of id, or a label rule "labels.<key>:<value>" ("labels.<key>" matches any value).
+    Rules are given as one string or a list of strings.
+    An item is selected if
+        - it matches any of include regexps (if there is no include regexp, any id), and
+        - it has all of include labels, and
+        - it matches none of exclude regexps and exclude labels.
+    Include labels are the same form and semantics (AND) as "filter" of BigQuery datasets.list,
+    so they can be pushed down to the server with label_filter().
+    """
+
+    def __init__(self, include=MATCH_ALL, exclude=MATCH_NONE):
+        self.include_pattern_list, self.include_label_list = _compile_rule_list(include)
+        self.exclude_pattern_list, self.exclude_label_list = _compile_rule_list(exclude)
+
+    def has_label_rule(self) -> bool:
+        return bool(self.include_label_list or self.exclude_label_list)
+
+    def label_filter(self):
+        """
+        :return: filter string of BigQuery datasets.list for include labels, or None if there is no include label
+        """
+        if not self.include_label_list:
+            return None
+        return " ".join(_label_rule_str(key, value) for key, value in self.include_label_list)
+
+    def match(self, item_id, labels=None) -> bool:
+        """
+        :param labels: labels of the item. None is same as no labels.
+        """
+        labels = labels or {}
+        if self.include_pattern_list and not any(p.search(item_id) for p in self.include_pattern_list):
+            return False
+        if not all(_has_label(labels, key, value) for key, value in self.include_label_list):
+            return False
+        if any(p.search(item_id) for p in self.exclude_pattern_list):
+            return False
+        if any(_has_label(labels, key, value) for key, value in self.exclude_label_list):
+            return False
+        return True
+
+
+def shard_of(item_id, shard_count) -> int:
+    """
+    Stable shard index of item_id in [0, shard_count). Same for any process and Python version
+    (built-in hash() of str is randomized per process).
+    """
+    return zlib.crc32(item_id.encode("utf-8")) % shard_count
+
+
+def _compile_rule_list(rule_list):
+    """
+    :return: ([compiled regexp], [(label key, label value or None)])
+    """
+    if isinstance(rule_list, str):
+        rule_list = [rule_list]
+    pattern_list = []
+    label_list = []
+    for rule in rule_list:
+        if rule.startswith(LABEL_RULE_PREFIX):
+            key, sep, value = rule[len(LABEL_RULE_PREFIX):].partition(":")
+            if not key:
+                raise Exception(f"invalid label rule: {rule}")
+            label_list.append((key, value if sep else None))
+        else:
+            pattern_list.append(re.compile(rule))
+    return pattern_list, label_list
+
+
+def _has_label(labels, key, value) -> bool:
+    if key not in labels:
+        return False
+    return value is None or labels[key] == value
+
+
+def _label_rule_str(key, value) -> str:
+    return LABEL_RULE_PREFIX + key if value is None else f"{LABEL_RULE_PREFIX}{key}:{value}"
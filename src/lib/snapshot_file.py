@@ -0,0 +1,152 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime
+
+MAGIC = b"BQDSNAP1"
+# length prefix of each record (4 bytes, big endian)
+LENGTH_FORMAT = ">I"
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+KIND_TABLE = "table"
+KIND_DATASET = "dataset"
+
+
+def index_path_of(path):
+    return path + ".idx"
+
+
+class SnapshotFileWriter(object):
+    """
+    Write FireStore documents to a local snapshot file.
+
+    File format:
+        MAGIC, then records of (4 bytes length, zlib compressed JSON {"kind", "id", "doc"})
+    Sidecar index (<path>.idx, JSON):
+        {"version": 1, "table": {"dataset.table": [offset, length]}, "dataset": {"dataset": [offset, length]}}
+    Each record is compressed separately, so that a single record can be decoded without reading the whole file.
+    Both files are written to temporary paths and renamed on close. If the writer is aborted
+    (or exits with an exception), the temporary file is deleted and path is not touched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = {KIND_TABLE: {}, KIND_DATASET: {}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, kind, doc_id, doc_dict):
+        record = {"kind": kind, "id": doc_id, "doc": doc_dict}
+        data = zlib.compress(json.dumps(record, default=_encode_datetime, ensure_ascii=False).encode("utf-8"))
+        self.file.write(struct.pack(LENGTH_FORMAT, len(data)))
+        self.file.write(data)
+        self.index[kind][doc_id] = [self.offset + LENGTH_SIZE, len(data)]
+        self.offset += LENGTH_SIZE + len(data)
+
+    def num_of_docs(self, kind) -> int:
+        return len(self.index[kind])
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        tmp_index_path = index_path_of(self.tmp_path)
+        with open(tmp_index_path, "w") as f:
+            json.dump(dict(self.index, version=1), f)
+        # index last, so that an index is always of a complete file
+        os.replace(self.tmp_path, self.path)
+        os.replace(tmp_index_path, index_path_of(self.path))
+
+    def abort(self):
+        """
+        Discard the partial output.
+        """
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class SnapshotFileReader(object):
+    """
+    Random access reader of a snapshot file written by SnapshotFileWriter.
+    A record is located by the sidecar index and decoded from mmap, without reading the whole file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(index_path_of(path)) as f:
+            self.index = json.load(f)
+        self.file = open(path, "rb")
+        self.mmap = None
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise Exception(f"snapshot file {path} is empty")
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mmap[:len(MAGIC)] != MAGIC:
+                raise Exception(f"{path} is not a snapshot file")
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, kind, doc_id) -> dict:
+        """
+        :raise KeyError: if the document is not in the snapshot
+        """
+        offset, length = self.index[kind][doc_id]
+        return self._decode(self.mmap[offset:offset + length])["doc"]
+
+    def id_list(self, kind) -> list:
+        return list(self.index[kind].keys())
+
+    def iter_records(self):
+        """
+        Yield (kind, id, doc) of all records in file order, using length prefixes (index is not used).
+        """
+        offset = len(MAGIC)
+        while offset < len(self.mmap):
+            length, = struct.unpack(LENGTH_FORMAT, self.mmap[offset:offset + LENGTH_SIZE])
+            offset += LENGTH_SIZE
+            record = self._decode(self.mmap[offset:offset + length])
+            offset += length
+            yield record["kind"], record["id"], record["doc"]
+
+    def close(self):
+        if self.mmap is not None and not self.mmap.closed:
+            self.mmap.close()
+        self.file.close()
+
+    @staticmethod
+    def _decode(data) -> dict:
+        return json.loads(zlib.decompress(data).decode("utf-8"), object_hook=_decode_datetime)
+
+
+def _encode_datetime(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def _decode_datetime(dic):
+    if len(dic) == 1 and "__datetime__" in dic:
+        return datetime.fromisoformat(dic["__datetime__"])
+    return dic
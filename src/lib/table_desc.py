@@ -1,13 +1,23 @@
+import hashlib
+import json
+
+
 class TableDesc(object):
     def __init__(self, in_dict):
         self.project_id = in_dict["tableReference"]["projectId"]
         self.dataset_id = in_dict["tableReference"]["datasetId"]
         self.table_id = in_dict["tableReference"]["tableId"]
         self.description = in_dict.get("description", "")
+        # etag and lastModifiedTime are not a part of description. They are not included in to_dict().
+        self.etag = in_dict.get("etag", "")
+        self.last_modified_time = in_dict.get("lastModifiedTime", "")
         if "schema" in in_dict and "fields" in in_dict["schema"]:
             self.field_list = [Field(f) for f in in_dict["schema"]["fields"]]
         else:
             self.field_list = []
+        # dotted field path (e.g. "a.b.c") -> Field, including sub fields of RECORD.
+        # For O(1) lookup on wide and deeply nested schemas.
+        self.field_index = make_field_index(self.field_list)
 
     def is_no_description(self):
         return self.description == "" and self.num_of_field_desc() == 0
@@ -28,6 +38,25 @@ class TableDesc(object):
             }
         }
 
+    def content_hash(self) -> str:
+        """
+        Stable hash of descriptions, and names and types of fields. Used to skip writing unchanged description.
+        Other attributes of fields (mode, maxLength, policyTags, ...) are not hashed, because BulkMetadataReader
+        does not read them from INFORMATION_SCHEMA. So the hash is same whether the table is read by tables.get or
+        in bulk.
+        """
+        dic = {
+            "description": self.description,
+            "fields": [f.to_hash_dict() for f in self.field_list],
+            "tableReference": {
+                "projectId": self.project_id,
+                "datasetId": self.dataset_id,
+                "tableId": self.table_id,
+            }
+        }
+        dic_str = json.dumps(dic, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(dic_str.encode("utf-8")).hexdigest()
+
     def check_diff(self, other) -> (bool, str):
         """
         check table description difference. And check filed description defference if both exist.
@@ -40,50 +69,78 @@ class TableDesc(object):
         if self.description != other.description:
             is_same = False
             diff_reason_list.append(f"table description is different {other.description} != {self.description}.")
-        if len(self.field_list) != len(other.field_list):
+        if len(self.field_index) != len(other.field_index):
             is_same = False
-            diff_reason_list.append(f"number of fields is different {len(self.field_list)} != {len(other.field_list)}")
-        for self_field in self.field_list:
-            for other_field in other.field_list:
-                if self_field.name == other_field.name:
-                    if self_field.description != other_field.description:
-                        is_same = False
-                        diff_reason_list.append(
-                            f"field({self_field.name}) description is defferent {other_field.description} != {self_field.description}.")
+            diff_reason_list.append(f"number of fields is different {len(self.field_index)} != {len(other.field_index)}")
+        for path, self_field in self.field_index.items():
+            other_field = other.field_index.get(path)
+            if other_field is not None and self_field.description != other_field.description:
+                is_same = False
+                diff_reason_list.append(
+                    f"field({path}) description is defferent {other_field.description} != {self_field.description}.")
         return is_same, ",".join(diff_reason_list)
 
     def num_of_field_desc(self) -> int:
-        sum = 0
-        for field in self.field_list:
-            if field.description != "":
-                sum += 1
-        return sum
+        return sum(1 for field in self.field_index.values() if field.description != "")
 
     def has_fields_description(self, filed_name):
-        for field in self.field_list:
-            if field.name == filed_name:
-                return True
-        return False
+        return filed_name in self.field_index
 
     def _update_field_description(self, filed_name, description):
-        for field in self.field_list:
-            if field.name == filed_name:
-                field.description = description
+        field = self.field_index.get(filed_name)
+        if field is not None:
+            field.description = description
 
     def update_description(self, other):
         self.description = other.description
-        for other_field in other.field_list:
-            if self.has_fields_description(other_field.name):
-                self._update_field_description(other_field.name, other_field.description)
+        for path, other_field in other.field_index.items():
+            self._update_field_description(path, other_field.description)
+
+
+def make_field_index(field_list) -> dict:
+    """
+    :return: {dotted field path: Field} in schema order (depth first)
+    """
+    field_index = {}
+    # iterate without recursion. each entry is (parent path + ".", Field)
+    stack = [("", f) for f in reversed(field_list)]
+    while stack:
+        prefix, field = stack.pop()
+        path = prefix + field.name
+        field_index[path] = field
+        stack.extend((path + ".", f) for f in reversed(field.field_list))
+    return field_index
 
 
 class Field(object):
+    # keys handled by Field itself. Other keys (mode, policyTags, maxLength, ...) are kept as they are.
+    KNOWN_KEYS = ("name", "type", "description", "fields")
+
     def __init__(self, in_dict):
         self.name = in_dict["name"]
         self.description = in_dict.get("description", "")
         self.type = in_dict["type"]
+        # sub fields of RECORD
+        self.has_sub_fields = "fields" in in_dict
+        self.field_list = [Field(f) for f in in_dict.get("fields", [])]
+        self.other_dict = {k: v for k, v in in_dict.items() if k not in self.KNOWN_KEYS}
 
     def to_dict(self):
-        return {"name": self.name,
-                "type": self.type,
-                "description": self.description}
+        dic = {"name": self.name,
+               "type": self.type,
+               "description": self.description}
+        dic.update(self.other_dict)
+        if self.has_sub_fields:
+            dic["fields"] = [f.to_dict() for f in self.field_list]
+        return dic
+
+    def to_hash_dict(self):
+        """
+        Part of to_dict() which TableDesc.content_hash() depends on.
+        """
+        dic = {"name": self.name,
+               "type": self.type,
+               "description": self.description}
+        if self.has_sub_fields:
+            dic["fields"] = [f.to_hash_dict() for f in self.field_list]
+        return dic
@@ -1,3 +1,5 @@
+import functools
+import json
 import logging
 import os
 import sys
@@ -11,27 +13,45 @@ from conf.config import Config
 
 config = Config()
 
-# load library
-from lib.controller import Controller
-from lib.firestore import Firestore
-from lib.bigquery import BqUpdateResult
-from lib.slack import Slack
+RESPONSE_HEADERS = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
 
-RESPONSE_HEADERS = {'Access-Control-Allow-Origin': '*'}
 
-# Logger setting
-from google.cloud import logging as cloud_logging
-from google.cloud.logging.handlers import CloudLoggingHandler
+# Clients are made on first use and memoized, so that a cold start initializes only what the action needs.
+# Libraries are imported there too, as importing them takes a large part of the cold start.
 
-client = cloud_logging.Client()
-handler = CloudLoggingHandler(client)
-logger = logging.getLogger('cloudLogger')
-logger.setLevel(logging.INFO)
-logger.addHandler(handler)
+@functools.lru_cache(maxsize=None)
+def get_logger():
+    from google.cloud import logging as cloud_logging
+    from google.cloud.logging.handlers import CloudLoggingHandler
+    from lib.gcp_auth import get_credentials
+    client = cloud_logging.Client(project=config.gcp_project, credentials=get_credentials(config))
+    handler = CloudLoggingHandler(client)
+    logger = logging.getLogger('cloudLogger')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
 
-controller = Controller(config, logger)
-firestore = Firestore(config, logger)
-slack = Slack(config, logger)
+
+@functools.lru_cache(maxsize=None)
+def get_controller():
+    from lib.controller import Controller
+    # Clients are made when an action uses them, and kept for next requests.
+    # Each request uses a Controller derived by with_metrics, which records calls to the Metrics of the request.
+    return Controller(config, get_logger())
+
+
+@functools.lru_cache(maxsize=None)
+def get_slack():
+    from lib.slack import Slack
+    return Slack(config, get_logger())
+
+
+def make_response(metrics, status, message, status_code):
+    """
+    Response body is JSON {"message", "report"}. report is the run report of the action (see Metrics.report).
+    """
+    report = metrics.report(status=status, message=message)
+    return (json.dumps({"message": message, "report": report}), status_code, RESPONSE_HEADERS)
 
 
 def cloud_functions_main(request):
@@ -39,9 +59,18 @@ def cloud_functions_main(request):
     this function is invoked by Cloud Functions
     """
 
+    from lib.metrics import Metrics
     param = request.get_json()
+    # one Metrics per request, not shared with other requests running on a warm instance at the same time
+    metrics = Metrics()
     try:
+        metrics.start(param["action"])
         msg = "ok"
+        controller = get_controller().with_metrics(metrics)
+        # BigQuery project to backup/restore. Descriptions of a project other than gcp_project in config are
+        # in collections namespaced by project (see Firestore.for_project), as written by backup_all_projects.
+        if param.get("project") is not None:
+            controller = controller.for_project(param["project"])
         if param["action"] == "backup_table":
             table = param["table"]
             dataset = param["dataset"]
@@ -50,7 +79,15 @@ def cloud_functions_main(request):
             dataset = param["dataset"]
             controller.backup_dataset(dataset_id=dataset)
         elif param["action"] == "backup_all":
-            msg = controller.backup_all()
+            msg = controller.backup_all(mode=param.get("mode"), time_budget_sec=param.get("time_budget_sec"))
+        elif param["action"] == "backup_all_sharded":
+            msg = controller.backup_all_sharded(shard_count=param.get("shard_count"), mode=param.get("mode"))
+        elif param["action"] == "backup_shard":
+            msg = controller.backup_shard(shard_index=param["shard_index"], shard_count=param["shard_count"],
+                                          run_id=param.get("run_id"), mode=param.get("mode"),
+                                          time_budget_sec=param.get("time_budget_sec"))
+        elif param["action"] == "backup_all_projects":
+            msg = controller.backup_all_projects(mode=param.get("mode"))
         elif param["action"] == "restore_table":
             table = param["table"]
             dataset = param["dataset"]
@@ -61,23 +98,23 @@ def cloud_functions_main(request):
         elif param["action"] == "restore_all":
             msg = controller.restore_all()
         elif param["action"] == "snapshot_make":
-            firestore.make_db_snapshot()
+            controller.firestore.make_db_snapshot(mode=param.get("mode"))
         elif param["action"] == "snapshot_recover_table":
             table = param["table"]
             dataset = param["dataset"]
             snapshot_id = param["snapshot"]
-            firestore.recover_table_from_snapshot(dataset, table, snapshot_id)
+            controller.firestore.recover_table_from_snapshot(dataset, table, snapshot_id)
         elif param["action"] == "snapshot_recover_dataset":
             dataset = param["dataset"]
             snapshot_id = param["snapshot"]
-            firestore.recover_dataset_from_snapshot(dataset, snapshot_id)
+            controller.firestore.recover_dataset_from_snapshot(dataset, snapshot_id)
         else:
             raise Exception("unknown action: " + param["action"])
-        return (msg, 200, RESPONSE_HEADERS)
+        return make_response(metrics, "ok", msg, 200)
     except Exception as e:
-        logger.exception(e)
+        get_logger().exception(e)
         if config.enable_slack_notify:
             import traceback
             except_str = traceback.format_exc()
-            slack.post_error("bqdesc_backupper Error\n" + except_str)
-        return (f"Exception : {e}", 500, RESPONSE_HEADERS)
+            get_slack().post_error("bqdesc_backupper Error\n" + except_str)
+        return make_response(metrics, "error", f"Exception : {e}", 500)
@@ -1,9 +1,12 @@
 import datetime
 import unittest
 
+import requests
+from google.api_core.exceptions import Forbidden, TooManyRequests, InternalServerError
+
 from init import config, logger, ignore_warnings
 
-from lib.bigquery import Bigquery, ResultType
+from lib.bigquery import Bigquery, ResultType, throttle_of, _should_retry
 from lib.dataset_desc import DatasetDesc
 from lib.table_desc import TableDesc
 
@@ -94,6 +97,25 @@ class TestBigquery(unittest.TestCase):
         self.assertEqual('new col1 description' + rand, ret_table_desc.field_list[0].description)
         self.assertEqual('new col2 description' + rand, ret_table_desc.field_list[1].description)
 
+    @ignore_warnings
+    def test_update_table_desc__with_outdated_etag(self):
+        rand = "{0}".format(datetime.datetime.now())
+        # etag becomes outdated by the following update
+        outdated_table_desc = self.bq.get_table_desc(TEST_DS, TEST_TABLE)
+        new_table_dict = {
+            'description': 'new table description' + rand,
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': 'new col1 description' + rand}]},
+            'tableReference': self.table_reference,
+        }
+        self.bq.update_table_desc(TableDesc(in_dict=new_table_dict))
+        new_table_dict['description'] = 'new table description 2' + rand
+        bq_update_result = self.bq.update_table_desc(TableDesc(in_dict=new_table_dict),
+                                                     now_table_desc=outdated_table_desc)
+        self.assertEqual(ResultType.UPDATE, bq_update_result.type)
+        ret_table_desc = self.bq.get_table_desc(TEST_DS, TEST_TABLE)
+        self.assertEqual('new table description 2' + rand, ret_table_desc.description)
+        self.assertEqual('new col1 description' + rand, ret_table_desc.field_list[0].description)
+
     @ignore_warnings
     def test_update_table_desc__one_description_is_empty_string(self):
         """
@@ -286,6 +308,45 @@ class TestBigquery(unittest.TestCase):
         finally:
             config.ignore_table_not_found_error_when_restore = org_value
 
+    @ignore_warnings
+    def test_plan_and_apply_table_update(self):
+        rand = "{0}".format(datetime.datetime.now())
+        new_table_dict = {
+            'description': 'new table description' + rand,
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': 'new col1 description' + rand}]},
+            'tableReference': self.table_reference,
+        }
+        plan_result, update = self.bq.plan_table_update(TableDesc(in_dict=new_table_dict))
+        self.assertEqual(ResultType.UPDATE, plan_result.type)
+        self.assertIn("fields", update)
+        # nothing is updated by the plan
+        self.assertNotEqual('new table description' + rand, self.bq.get_table_desc(TEST_DS, TEST_TABLE).description)
+        bq_update_result = self.bq.apply_table_update(**update)
+        self.assertEqual(ResultType.UPDATE, bq_update_result.type)
+        ret_table_desc = self.bq.get_table_desc(TEST_DS, TEST_TABLE)
+        self.assertEqual('new table description' + rand, ret_table_desc.description)
+        self.assertEqual('new col1 description' + rand, ret_table_desc.field_list[0].description)
+        plan_result, update = self.bq.plan_table_update(TableDesc(in_dict=new_table_dict))
+        self.assertEqual(ResultType.SAME, plan_result.type)
+        self.assertIsNone(update)
+
+    @ignore_warnings
+    def test_apply_table_update__changed_since_plan(self):
+        rand = "{0}".format(datetime.datetime.now())
+        new_table_dict = {
+            'description': 'new table description' + rand,
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': 'new col1 description' + rand}]},
+            'tableReference': self.table_reference,
+        }
+        _, update = self.bq.plan_table_update(TableDesc(in_dict=new_table_dict))
+        # the table is modified after the plan
+        new_table_dict['description'] = 'new table description 2' + rand
+        self.bq.update_table_desc(TableDesc(in_dict=new_table_dict))
+        bq_update_result = self.bq.apply_table_update(**update)
+        self.assertEqual(ResultType.CHANGED_SINCE_PLAN, bq_update_result.type)
+        self.assertEqual(False, bq_update_result.is_success)
+        self.assertEqual('new table description 2' + rand, self.bq.get_table_desc(TEST_DS, TEST_TABLE).description)
+
     @ignore_warnings
     def test_list_table_id(self):
         ret = self.bq.list_table_id(TEST_DS)
@@ -322,6 +383,17 @@ class TestBigquery(unittest.TestCase):
         self.assertEqual(ResultType.SAME, update_result.type)
 
 
+    @ignore_warnings
+    def test_plan_and_apply_dataset_update(self):
+        ymd_str = "{0}".format(datetime.datetime.now())
+        dataset_desc = DatasetDesc(in_dict={"description": ymd_str, "datasetReference": self.dataset_reference})
+        plan_result, update = self.bq.plan_dataset_update(dataset_desc)
+        self.assertEqual(ResultType.UPDATE, plan_result.type)
+        self.assertEqual(ResultType.UPDATE, self.bq.apply_dataset_update(**update).type)
+        self.assertEqual(ymd_str, self.bq.get_dataset_desc(TEST_DS).description)
+        # etag of the plan is outdated by the update
+        self.assertEqual(ResultType.CHANGED_SINCE_PLAN, self.bq.apply_dataset_update(**update).type)
+
     @ignore_warnings
     def test_update_dataset_not_exist_dataset(self):
         ymd_str = "{0}".format(datetime.datetime.now())
@@ -361,5 +433,38 @@ class TestBigquery(unittest.TestCase):
         self.assertTrue(len(ret) > 0)
 
 
+class TestThrottleOf(unittest.TestCase):
+    def _response(self, retry_after):
+        response = requests.Response()
+        response.headers["Retry-After"] = retry_after
+        return response
+
+    def test_rate_limit_exceeded(self):
+        e = Forbidden("rate limit", errors=[{"reason": "rateLimitExceeded"}])
+        self.assertEqual(0, throttle_of(e))
+        self.assertFalse(_should_retry(e))
+
+    def test_other_forbidden(self):
+        e = Forbidden("denied", errors=[{"reason": "accessDenied"}])
+        self.assertIsNone(throttle_of(e))
+        self.assertFalse(_should_retry(e))
+
+    def test_too_many_requests(self):
+        e = TooManyRequests("too many", errors=[{"reason": "rateLimitExceeded"}])
+        self.assertEqual(0, throttle_of(e))
+        self.assertFalse(_should_retry(e))
+
+    def test_retry_after(self):
+        e = TooManyRequests("too many", response=self._response("7"))
+        self.assertEqual(7.0, throttle_of(e))
+        e = Forbidden("rate limit", errors=[{"reason": "rateLimitExceeded"}], response=self._response("2"))
+        self.assertEqual(2.0, throttle_of(e))
+
+    def test_server_error_is_retried_by_client(self):
+        e = InternalServerError("backend", errors=[{"reason": "backendError"}])
+        self.assertIsNone(throttle_of(e))
+        self.assertTrue(_should_retry(e))
+
+
 if __name__ == '__main__':
     unittest.main(warnings='ignore')
@@ -0,0 +1,127 @@
+import logging
+import unittest
+
+from lib.bulk_metadata import BulkMetadataReader, TableDescPrefetcher, decode_option_value, struct_field_names, \
+    to_api_type
+from lib.table_desc import TableDesc
+
+
+def make_row(table_schema, table_name, table_description=None, ordinal_position=None, is_nullable="YES",
+             field_path=None, data_type=None, description=None, is_hidden="NO"):
+    return {"table_schema": table_schema, "table_name": table_name, "table_description": table_description,
+            "ordinal_position": ordinal_position, "is_nullable": is_nullable, "is_hidden": is_hidden,
+            "field_path": field_path, "data_type": data_type, "description": description}
+
+
+CANNED_ROWS = [
+    make_row("ds1", "t1", '"table \\"1\\""', 1, "NO", "col1", "INT64", "col1 desc"),
+    make_row("ds1", "t1", '"table \\"1\\""', 2, "YES", "col2.b", "STRUCT<c INT64>", None),
+    make_row("ds1", "t1", '"table \\"1\\""', 2, "YES", "col2", "ARRAY<STRUCT<b STRUCT<c INT64>, a STRING>>", None),
+    make_row("ds1", "t1", '"table \\"1\\""', 2, "YES", "col2.b.c", "INT64", "sub sub field"),
+    make_row("ds1", "t1", '"table \\"1\\""', 2, "YES", "col2.a", "STRING", "sub field"),
+    make_row("ds1", "t2", None, 1, "YES", "col1", "STRING(10)", None),
+    make_row("ds1", "t3"),
+    make_row("ds2", "t1", '"other dataset"', 1, "YES", "col1", "BOOL", None),
+]
+
+
+class StandInQuery(object):
+    """
+    Stand-in of BigQuery query. Returns canned rows and records executed queries.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.query_list = []
+
+    def __call__(self, sql):
+        self.query_list.append(sql)
+        return iter(self.rows)
+
+
+class TestBulkMetadata(unittest.TestCase):
+
+    def test_read_dataset(self):
+        query = StandInQuery([r for r in CANNED_ROWS if r["table_schema"] == "ds1"])
+        reader = BulkMetadataReader("proj", query)
+        ret = reader.read_dataset("ds1")
+        self.assertIn("`proj.ds1.INFORMATION_SCHEMA.TABLES`", query.query_list[0])
+        t1 = ret["t1"]
+        self.assertEqual({"projectId": "proj", "datasetId": "ds1", "tableId": "t1"}, t1.to_dict()["tableReference"])
+        self.assertEqual('table "1"', t1.description)
+        self.assertEqual(["col1", "col2"], t1.field_name_list())
+        self.assertEqual("INTEGER", t1.field_list[0].type)
+        self.assertEqual("col1 desc", t1.field_list[0].description)
+        self.assertEqual("RECORD", t1.field_list[1].type)
+        self.assertEqual("", t1.field_list[1].description)
+        self.assertEqual("REPEATED", t1.field_list[1].to_dict()["mode"])
+        self.assertEqual(["col1", "col2", "col2.b", "col2.b.c", "col2.a"], list(t1.field_index.keys()))
+        self.assertEqual("sub field", t1.field_index["col2.a"].description)
+        self.assertEqual("sub sub field", t1.field_index["col2.b.c"].description)
+        self.assertEqual("STRING", ret["t2"].field_list[0].type)
+        self.assertTrue(ret["t3"].is_no_description())
+        self.assertEqual([], ret["t3"].field_list)
+
+    def test_hidden_pseudo_column(self):
+        # ingestion-time partitioned table. tables.get does not return _PARTITIONTIME and _PARTITIONDATE.
+        query = StandInQuery([
+            make_row("ds1", "t1", '"partitioned"', 1, "YES", "col1", "STRING", "col1 desc"),
+            make_row("ds1", "t1", '"partitioned"', 2, "YES", "_PARTITIONTIME", "TIMESTAMP", None, is_hidden="YES"),
+            make_row("ds1", "t1", '"partitioned"', 3, "YES", "_PARTITIONDATE", "DATE", None, is_hidden="YES"),
+        ])
+        t1 = BulkMetadataReader("proj", query).read_dataset("ds1")["t1"]
+        self.assertEqual(["col1"], t1.field_name_list())
+        self.assertEqual(["col1"], list(t1.field_index.keys()))
+
+    def test_same_content_hash_as_tables_get(self):
+        query = StandInQuery([
+            make_row("ds1", "t1", '"t1 desc"', 1, "NO", "col1", "STRING(10)", "col1 desc"),
+            make_row("ds1", "t1", '"t1 desc"', 2, "YES", "col2", "STRUCT<a NUMERIC(10, 2)>", None),
+            make_row("ds1", "t1", '"t1 desc"', 2, "YES", "col2.a", "NUMERIC(10, 2)", "sub field"),
+        ])
+        t1 = BulkMetadataReader("proj", query).read_dataset("ds1")["t1"]
+        # tables.get returns attributes which INFORMATION_SCHEMA does not have
+        table_dict = {
+            "description": "t1 desc",
+            "schema": {"fields": [
+                {"name": "col1", "type": "STRING", "mode": "REQUIRED", "description": "col1 desc", "maxLength": "10",
+                 "policyTags": {"names": ["projects/proj/locations/us/taxonomies/1/policyTags/2"]}},
+                {"name": "col2", "type": "RECORD", "mode": "NULLABLE", "fields": [
+                    {"name": "a", "type": "NUMERIC", "mode": "REQUIRED", "description": "sub field",
+                     "precision": "10", "scale": "2"}]}]},
+            "tableReference": {"projectId": "proj", "datasetId": "ds1", "tableId": "t1"},
+            "etag": "abc==", "lastModifiedTime": "1577804400000"}
+        self.assertEqual(TableDesc(table_dict).content_hash(), t1.content_hash())
+
+    def test_to_api_type(self):
+        self.assertEqual(("INTEGER", "NULLABLE"), to_api_type("INT64"))
+        self.assertEqual(("FLOAT", "REPEATED"), to_api_type("ARRAY<FLOAT64>"))
+        self.assertEqual(("RECORD", "NULLABLE"), to_api_type("STRUCT<a INT64, b ARRAY<STRING>>"))
+        self.assertEqual(("NUMERIC", "NULLABLE"), to_api_type("NUMERIC(10, 2)"))
+        self.assertEqual(("TIMESTAMP", "NULLABLE"), to_api_type("TIMESTAMP"))
+
+    def test_struct_field_names(self):
+        self.assertEqual([], struct_field_names("STRING"))
+        self.assertEqual(["a", "b"], struct_field_names("ARRAY<STRUCT<a INT64, b STRUCT<c STRING, d NUMERIC(10, 2)>>>"))
+        self.assertEqual(["a b", "c"], struct_field_names("STRUCT<`a b` INT64, c STRING>"))
+
+    def test_decode_option_value(self):
+        self.assertEqual("", decode_option_value(None))
+        self.assertEqual('a "b"\nc', decode_option_value('"a \\"b\\"\\nc"'))
+        self.assertEqual("not quoted", decode_option_value("not quoted"))
+
+    def test_prefetcher(self):
+        query = StandInQuery([r for r in CANNED_ROWS if r["table_schema"] == "ds1"])
+        prefetcher = TableDescPrefetcher(BulkMetadataReader("proj", query), logging.getLogger(), max_datasets=1)
+        self.assertEqual('table "1"', prefetcher.get("ds1", "t1").description)
+        self.assertIsNotNone(prefetcher.get("ds1", "t2"))
+        self.assertIsNone(prefetcher.get("ds1", "not_exist"))
+        self.assertEqual(1, len(query.query_list))
+        # evict ds1 by reading another dataset
+        prefetcher.get("ds2", "t1")
+        prefetcher.get("ds1", "t1")
+        self.assertEqual(3, len(query.query_list))
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -1,12 +1,24 @@
+import ast
+import asyncio
+import contextlib
+import copy
 import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 from init import config, logger, ignore_warnings
 
-from lib.bigquery import Bigquery
+import lib.controller as controller_module
+from lib.bigquery import Bigquery, BqUpdateResult, ResultType
 from lib.controller import Controller
 from lib.dataset_desc import DatasetDesc
 from lib.firestore import Firestore
+from lib.metrics import Metrics
+from lib.restore_plan import RestorePlanReader
 from lib.table_desc import TableDesc
 
 TEST_DS = "test_bqdesc_buckuper"
@@ -101,5 +113,551 @@ class TestController(unittest.TestCase):
     #    self.controller.restore_all()
 
 
+class StandInBigquery(object):
+    """
+    BigQuery of num_of_dataset datasets with num_of_table tables each. Each get takes get_sec.
+    """
+
+    def __init__(self, num_of_dataset, num_of_table, get_sec, no_description_table_id_set=frozenset()):
+        self.project = "stand-in"
+        self.num_of_table = num_of_table
+        self.dataset_id_list = [f"ds{i:02d}" for i in range(num_of_dataset)]
+        self.get_sec = get_sec
+        self.no_description_table_id_set = no_description_table_id_set
+        self.lock = threading.Lock()
+        self.got_table_list = []
+
+    def list_dataset_id(self, selector=None):
+        return list(self.dataset_id_list)
+
+    def list_table_id(self, dataset_id, selector=None):
+        return [f"t{i:03d}" for i in range(self.num_of_table)]
+
+    def get_dataset_desc(self, dataset_id) -> DatasetDesc:
+        time.sleep(self.get_sec)
+        return DatasetDesc(in_dict={"description": f"{dataset_id} desc",
+                                    "datasetReference": {"projectId": self.project, "datasetId": dataset_id}})
+
+    def list_table_last_modified_time(self, dataset_id) -> dict:
+        return {table_id: "2000" for table_id in self.list_table_id(dataset_id)}
+
+    def get_table_desc(self, dataset_id, table_id) -> TableDesc:
+        time.sleep(self.get_sec)
+        with self.lock:
+            self.got_table_list.append(f"{dataset_id}.{table_id}")
+        if table_id in self.no_description_table_id_set:
+            return TableDesc(in_dict={
+                "schema": {"fields": [{"name": TEST_COL1, "type": "STRING"}]},
+                "tableReference": {"projectId": self.project, "datasetId": dataset_id, "tableId": table_id},
+                "lastModifiedTime": "2000"})
+        return TableDesc(in_dict={
+            "description": f"{table_id} desc",
+            "schema": {"fields": [{"name": TEST_COL1, "description": "a", "type": "STRING"}]},
+            "tableReference": {"projectId": self.project, "datasetId": dataset_id, "tableId": table_id},
+            "lastModifiedTime": "2000"})
+
+
+class StandInFirestore(object):
+    """
+    Records written documents and the backup checkpoint in memory. Batch writes are committed at once.
+    """
+
+    def __init__(self):
+        self.dataset_desc_col = "dataset"
+        self.table_desc_col = "table"
+        self.lock = threading.Lock()
+        self.written_list = []
+        self.modified_time_list = []
+        self.no_description_list = []
+        self.table_state_dict = {}
+        self.checkpoint = None
+        self.summary_dict = {}
+
+    @contextlib.contextmanager
+    def batch_writer(self):
+        yield None
+
+    def get_all_dataset_doc_field_dict(self, field_path_list, dataset_id_list=None) -> dict:
+        return {}
+
+    def get_all_table_doc_field_dict(self, field_path_list, dataset_id_list=None) -> dict:
+        return self.table_state_dict
+
+    def put_dataset_desc(self, dataset_id, dataset_desc, writer=None, on_done=None):
+        self._put(dataset_id, on_done)
+
+    def put_table_desc(self, dataset_id, table_id, table_desc, writer=None, on_done=None):
+        self._put(f"{dataset_id}.{table_id}", on_done)
+
+    def put_table_modified_time(self, dataset_id, table_id, table_desc, writer=None, on_done=None):
+        with self.lock:
+            self.modified_time_list.append((f"{dataset_id}.{table_id}", table_desc.last_modified_time))
+        on_done(None)
+
+    def put_table_no_description(self, dataset_id, table_id, table_desc, writer=None, on_done=None):
+        with self.lock:
+            self.no_description_list.append((f"{dataset_id}.{table_id}", table_desc.last_modified_time))
+        on_done(None)
+
+    def _put(self, name, on_done):
+        with self.lock:
+            self.written_list.append(name)
+        on_done(None)
+
+    def get_backup_checkpoint(self, name):
+        return self.checkpoint
+
+    def put_backup_checkpoint(self, checkpoint, name):
+        self.checkpoint = dict(checkpoint, updated_at=datetime.datetime.now())
+
+    def delete_backup_checkpoint(self, name):
+        self.checkpoint = None
+
+    def for_project(self, bq_project):
+        return self
+
+    def with_metrics(self, metrics):
+        other = copy.copy(self)
+        other.metrics = metrics
+        return other
+
+    def put_backup_shard_result(self, run_id, shard_index, shard_count, result_type_counter, error=None):
+        with self.lock:
+            summary = self.summary_dict.setdefault(run_id, {"shard_count": shard_count, "shards": {}})
+            summary["shards"][str(shard_index)] = {"result": result_type_counter, "error": error}
+
+    def get_backup_summary(self, run_id):
+        summary = dict(self.summary_dict.get(run_id, {"shard_count": 0, "shards": {}}))
+        summary["total"] = {}
+        for shard in summary["shards"].values():
+            for result_type, num in (shard["result"] or {}).items():
+                summary["total"][result_type] = summary["total"].get(result_type, 0) + num
+        return summary
+
+    def put_backup_summary_total(self, run_id, total, failed_shard_list):
+        self.summary_dict.setdefault(run_id, {"shard_count": 0, "shards": {}}).update(
+            {"total": total, "state": "failed" if failed_shard_list else "succeeded", "failed_shards": failed_shard_list})
+
+
+class StandInFunctionInvoker(object):
+    """
+    Runs "backup_shard" of the controller in the calling thread, instead of calling Cloud Functions.
+    Records timeout of the invoker and the payloads.
+    """
+    controller = None
+    timeout_sec_list = []
+    payload_list = []
+
+    def __init__(self, url, logger, timeout_sec):
+        self.timeout_sec_list.append(timeout_sec)
+
+    def invoke(self, payload):
+        self.payload_list.append(payload)
+        param = dict(payload)
+        del param["action"]
+        return 200, self.controller.for_project(param.pop("project")).backup_shard(**param)
+
+
+class TestBackupAllWithStandIn(unittest.TestCase):
+    class Config(config):
+        backup_worker_num = 4
+        backup_bulk_metadata = False
+        backup_time_budget_sec = 0
+
+    def test_suspend_and_resume(self):
+        bq = StandInBigquery(num_of_dataset=5, num_of_table=100, get_sec=0.02)
+        firestore = StandInFirestore()
+        controller = Controller(config=self.Config, logger=logger, bigquery=bq, firestore=firestore)
+
+        started_at = time.monotonic()
+        result_type_counter, is_finished = controller._backup_all_resumable("full", time_budget_sec=1)
+        elapsed_sec = time.monotonic() - started_at
+        self.assertFalse(is_finished)
+        # gets in flight (one per worker) are waited for after the deadline, no more
+        self.assertLess(elapsed_sec, 1.5)
+        self.assertIsNotNone(firestore.checkpoint)
+        self.assertEqual(len(firestore.written_list), result_type_counter["ok"])
+        self.assertEqual(result_type_counter, firestore.checkpoint["result"])
+
+        while not is_finished:
+            result_type_counter, is_finished = controller._backup_all_resumable("full", time_budget_sec=1)
+        self.assertIsNone(firestore.checkpoint)
+        # every dataset and table is written exactly once over the runs
+        self.assertEqual(5 + 5 * 100, len(firestore.written_list))
+        self.assertEqual(5 + 5 * 100, len(set(firestore.written_list)))
+        self.assertEqual(5 + 5 * 100, result_type_counter["ok"])
+
+    def test_no_time_budget(self):
+        bq = StandInBigquery(num_of_dataset=2, num_of_table=10, get_sec=0)
+        firestore = StandInFirestore()
+        controller = Controller(config=self.Config, logger=logger, bigquery=bq, firestore=firestore)
+        result_type_counter, is_finished = controller._backup_all_resumable("full")
+        self.assertTrue(is_finished)
+        self.assertIsNone(firestore.checkpoint)
+        self.assertEqual(2 + 2 * 10, result_type_counter["ok"])
+
+    def test_unchanged_description_updates_last_modified_time(self):
+        bq = StandInBigquery(num_of_dataset=1, num_of_table=2, get_sec=0)
+        content_hash = bq.get_table_desc("ds00", "t000").content_hash()
+        firestore = StandInFirestore()
+        # t000: data was modified since the backup. t001: not modified
+        firestore.table_state_dict = {"ds00.t000": {"content_hash": content_hash, "lastModifiedTime": "1000"},
+                                      "ds00.t001": {"content_hash": bq.get_table_desc("ds00", "t001").content_hash(),
+                                                    "lastModifiedTime": "2000"}}
+        controller = Controller(config=self.Config, logger=logger, bigquery=bq, firestore=firestore)
+        result_type_counter, _ = controller._backup_all_resumable("full")
+        self.assertEqual(2, result_type_counter["skip_unchanged"])
+        self.assertEqual(["ds00"], firestore.written_list)
+        self.assertEqual([("ds00.t000", "2000")], firestore.modified_time_list)
+
+    def test_table_with_no_description(self):
+        bq = StandInBigquery(num_of_dataset=1, num_of_table=3, get_sec=0, no_description_table_id_set={"t001", "t002"})
+        firestore = StandInFirestore()
+        # t002: its description was removed after the backup
+        firestore.table_state_dict = {"ds00.t002": {"content_hash": "backup of t002", "lastModifiedTime": "1000"}}
+        controller = Controller(config=self.Config, logger=logger, bigquery=bq, firestore=firestore)
+        result_type_counter, _ = controller._backup_all_resumable("incremental")
+        self.assertEqual(2, result_type_counter["skip"])
+        # lastModifiedTime is recorded without a backup, and the backup of t002 is kept
+        self.assertEqual([("ds00.t001", "2000")], firestore.no_description_list)
+        self.assertEqual([("ds00.t002", "2000")], firestore.modified_time_list)
+        self.assertEqual(["ds00", "ds00.t000"], sorted(firestore.written_list))
+
+        # the next incremental backup does not get tables which are not modified
+        firestore.table_state_dict = {"ds00.t000": {"content_hash": "backup of t000", "lastModifiedTime": "2000"},
+                                      "ds00.t001": {"lastModifiedTime": "2000"},
+                                      "ds00.t002": {"content_hash": "backup of t002", "lastModifiedTime": "2000"}}
+        bq.got_table_list = []
+        result_type_counter, _ = controller._backup_all_resumable("incremental")
+        self.assertEqual(3, result_type_counter["not_modified"])
+        self.assertEqual([], bq.got_table_list)
+
+
+class TestBackupAllShardedWithStandIn(unittest.TestCase):
+    class Config(config):
+        backup_worker_num = 4
+        backup_bulk_metadata = False
+        backup_time_budget_sec = 0
+        cloud_functions_timeout_sec = 540
+        backup_shard_timeout_margin_sec = 60
+
+    def setUp(self):
+        self.firestore = StandInFirestore()
+        self.controller = Controller(config=self.Config, logger=logger, firestore=self.firestore,
+                                     bigquery=StandInBigquery(num_of_dataset=4, num_of_table=5, get_sec=0))
+        StandInFunctionInvoker.controller = self.controller
+        StandInFunctionInvoker.timeout_sec_list = []
+        StandInFunctionInvoker.payload_list = []
+        function_invoker = controller_module.FunctionInvoker
+        controller_module.FunctionInvoker = StandInFunctionInvoker
+        self.addCleanup(setattr, controller_module, "FunctionInvoker", function_invoker)
+
+    def test_backup_all_sharded(self):
+        self.controller.backup_all_sharded(shard_count=3, mode="full")
+        # the call times out before the coordinator, and each shard has time budget shorter than the call
+        timeout_sec = StandInFunctionInvoker.timeout_sec_list[0]
+        self.assertLessEqual(timeout_sec, 480)
+        self.assertGreater(timeout_sec, 470)
+        self.assertEqual([420] * 3, [payload["time_budget_sec"] for payload in StandInFunctionInvoker.payload_list])
+        # shards backup the project of the coordinator
+        self.assertEqual([config.gcp_project] * 3, [payload["project"] for payload in StandInFunctionInvoker.payload_list])
+        summary, = self.firestore.summary_dict.values()
+        self.assertEqual("succeeded", summary["state"])
+        self.assertEqual([], summary["failed_shards"])
+        self.assertEqual(4 + 4 * 5, summary["total"]["ok"])
+
+    def test_failed_shard(self):
+        invoke = StandInFunctionInvoker.invoke
+
+        def fail_shard_1(invoker, payload):
+            if payload["shard_index"] == 1:
+                raise Exception("timeout")
+            return invoke(invoker, payload)
+
+        StandInFunctionInvoker.invoke = fail_shard_1
+        self.addCleanup(setattr, StandInFunctionInvoker, "invoke", invoke)
+        with self.assertRaises(Exception):
+            self.controller.backup_all_sharded(shard_count=3, mode="full")
+        summary, = self.firestore.summary_dict.values()
+        self.assertEqual("failed", summary["state"])
+        self.assertEqual([1], summary["failed_shards"])
+        self.assertLess(summary["total"]["ok"], 4 + 4 * 5)
+
+    def test_too_short_timeout(self):
+        class Config(self.Config):
+            cloud_functions_timeout_sec = 120
+
+        controller = Controller(config=Config, logger=logger, firestore=self.firestore, bigquery=StandInBigquery(num_of_dataset=1, num_of_table=1, get_sec=0))
+        with self.assertRaises(Exception):
+            controller.backup_all_sharded(shard_count=3)
+        self.assertEqual([], StandInFunctionInvoker.payload_list)
+
+
+class StandInRestoreBigquery(object):
+    """
+    BigQuery with descriptions and etags of datasets and tables in memory. An update changes the etag.
+    Nothing is prefetched in bulk, as if INFORMATION_SCHEMA is not available.
+    """
+
+    class BulkMetadataReader(object):
+        def read_dataset(self, dataset_id):
+            return {}
+
+    class RateLimiter(object):
+        def stats(self):
+            return {}
+
+    def __init__(self, description_dict):
+        self.project = "stand-in"
+        self.bulk_metadata_reader = self.BulkMetadataReader()
+        self.rate_limiter = self.RateLimiter()
+        self.lock = threading.Lock()
+        # "ds" or "ds.table" -> [description, etag]
+        self.state_dict = {name: [description, "0"] for name, description in description_dict.items()}
+        self.num_of_apply = 0
+        # update_*_desc of this dataset or table raises
+        self.fail_name = None
+
+    def modify(self, name, description):
+        with self.lock:
+            self.state_dict[name] = [description, str(int(self.state_dict[name][1]) + 1)]
+
+    def _plan(self, name, description, update):
+        if name not in self.state_dict:
+            return BqUpdateResult(False, ResultType.TABLE_NOT_FOUND), None
+        now_description, etag = self.state_dict[name]
+        if now_description == description:
+            return BqUpdateResult(True, ResultType.SAME), None
+        diff = f"{now_description} -> {description}"
+        return BqUpdateResult(True, ResultType.UPDATE, diff), dict(update, etag=etag, description=description,
+                                                                    diff=diff)
+
+    def _apply(self, name, etag, description, diff):
+        with self.lock:
+            self.num_of_apply += 1
+            if self.state_dict[name][1] != etag:
+                return BqUpdateResult(False, ResultType.CHANGED_SINCE_PLAN)
+        self.modify(name, description)
+        return BqUpdateResult(True, ResultType.UPDATE, diff)
+
+    def plan_dataset_update(self, dataset_desc):
+        return self._plan(dataset_desc.dataset_id, dataset_desc.description, {"dataset_id": dataset_desc.dataset_id})
+
+    def plan_table_update(self, new_table_desc, now_table_desc=None):
+        return self._plan(f"{new_table_desc.dataset_id}.{new_table_desc.table_id}", new_table_desc.description,
+                          {"dataset_id": new_table_desc.dataset_id, "table_id": new_table_desc.table_id})
+
+    def update_dataset_desc(self, dataset_desc):
+        return self._update(dataset_desc.dataset_id, dataset_desc.description)
+
+    def update_table_desc(self, new_table_desc, now_table_desc=None):
+        return self._update(f"{new_table_desc.dataset_id}.{new_table_desc.table_id}", new_table_desc.description)
+
+    def _update(self, name, description):
+        if name == self.fail_name:
+            raise Exception(f"update of {name} failed")
+        bq_update_result, update = self._plan(name, description, {})
+        if update is not None:
+            self.modify(name, description)
+        return bq_update_result
+
+    def apply_dataset_update(self, dataset_id, etag, description, diff=""):
+        return self._apply(dataset_id, etag, description, diff)
+
+    def apply_table_update(self, dataset_id, table_id, etag, description, fields=None, diff=""):
+        return self._apply(f"{dataset_id}.{table_id}", etag, description, diff)
+
+
+class StandInRestoreFirestore(object):
+    """
+    Backup of datasets and tables of the given descriptions.
+    """
+
+    def __init__(self, description_dict):
+        self.dataset_desc_col = "dataset"
+        self.table_desc_col = "table"
+        self.description_dict = description_dict
+        self.async_client_list = []
+        self.closed_async_client_list = []
+
+    def new_async_client(self):
+        async_client = object()
+        self.async_client_list.append(async_client)
+        return async_client
+
+    async def close_async_client(self, async_client):
+        self.closed_async_client_list.append(async_client)
+
+    async def stream_all_dataset_desc_async(self, async_client):
+        for dataset_desc in self.iter_all_dataset_desc():
+            await asyncio.sleep(0)
+            yield dataset_desc
+
+    async def stream_all_table_desc_async(self, async_client):
+        for table_desc in self.iter_all_table_desc():
+            await asyncio.sleep(0)
+            yield table_desc
+
+    def iter_all_dataset_desc(self):
+        for name, description in sorted(self.description_dict.items()):
+            if "." not in name:
+                yield DatasetDesc(in_dict={"description": description,
+                                           "datasetReference": {"projectId": "stand-in", "datasetId": name}})
+
+    def iter_all_table_desc(self):
+        for name, description in sorted(self.description_dict.items()):
+            if "." in name:
+                dataset_id, table_id = name.split(".")
+                yield TableDesc(in_dict={
+                    "description": description, "schema": {"fields": []},
+                    "tableReference": {"projectId": "stand-in", "datasetId": dataset_id, "tableId": table_id}})
+
+
+class TestRestoreWithStandIn(unittest.TestCase):
+    class Config(config):
+        restore_max_in_flight = 4
+        restore_prefetch_bulk_metadata = False
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "plan.jsonl")
+        backup_dict = {"ds0": "ds0 desc", "ds1": "ds1 desc"}
+        backup_dict.update({f"ds0.t{i:03d}": f"t{i:03d} desc" for i in range(100)})
+        self.firestore = StandInRestoreFirestore(backup_dict)
+        # ds1 and 10 tables differ from the backup
+        now_dict = dict(backup_dict, ds1="old")
+        now_dict.update({f"ds0.t{i:03d}": "old" for i in range(0, 100, 10)})
+        self.bq = StandInRestoreBigquery(now_dict)
+        self.controller = Controller(config=self.Config, logger=logger, bigquery=self.bq, firestore=self.firestore)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_restore_all_async(self):
+        result_type_counter = ast.literal_eval(self.controller.restore_all())
+        self.assertEqual(11, result_type_counter["update"])
+        self.assertEqual(91, result_type_counter["same"])
+        self.assertEqual(0, result_type_counter["exception"])
+        self.assertEqual("ds1 desc", self.bq.state_dict["ds1"][0])
+        self.assertEqual("t090 desc", self.bq.state_dict["ds0.t090"][0])
+        # one AsyncClient per run, closed at the end
+        self.assertEqual(1, len(self.firestore.async_client_list))
+        self.assertEqual(self.firestore.async_client_list, self.firestore.closed_async_client_list)
+
+    def test_restore_all_async_with_raising_update(self):
+        self.bq.fail_name = "ds0.t030"
+        with self.assertRaises(Exception) as cm:
+            self.controller.restore_all()
+        result_type_counter = ast.literal_eval(str(cm.exception).split(". ", 1)[1])
+        self.assertEqual(1, result_type_counter["exception"])
+        self.assertEqual(10, result_type_counter["update"])
+        self.assertEqual(91, result_type_counter["same"])
+        # the others are restored
+        self.assertEqual("old", self.bq.state_dict["ds0.t030"][0])
+        self.assertEqual("t040 desc", self.bq.state_dict["ds0.t040"][0])
+        self.assertEqual(self.firestore.async_client_list, self.firestore.closed_async_client_list)
+
+    def test_plan_and_apply(self):
+        self.controller.restore_plan(self.path)
+        with RestorePlanReader(self.path) as reader:
+            self.assertEqual("stand-in", reader.header["project"])
+            update_list = list(reader.iter_updates())
+        # only entities to update are in the plan
+        self.assertEqual(11, len(update_list))
+        self.assertEqual({"ds1"} | {f"ds0.t{i:03d}" for i in range(0, 100, 10)},
+                         {".".join(filter(None, [u["dataset_id"], u.get("table_id")])) for _, u in update_list})
+        # nothing is updated by the plan
+        self.assertEqual("old", self.bq.state_dict["ds1"][0])
+
+        self.controller.restore_apply(self.path)
+        self.assertEqual(11, self.bq.num_of_apply)
+        self.assertEqual("ds1 desc", self.bq.state_dict["ds1"][0])
+        self.assertEqual("t010 desc", self.bq.state_dict["ds0.t010"][0])
+
+    def test_apply_rejects_changed_since_plan(self):
+        self.controller.restore_plan(self.path)
+        self.bq.modify("ds0.t020", "modified after the plan")
+        with self.assertRaises(Exception) as cm:
+            self.controller.restore_apply(self.path)
+        self.assertIn("'changed since plan': 1", str(cm.exception))
+        self.assertEqual("modified after the plan", self.bq.state_dict["ds0.t020"][0])
+        # the others are applied
+        self.assertEqual("t030 desc", self.bq.state_dict["ds0.t030"][0])
+
+    def test_plan_with_errors(self):
+        del self.bq.state_dict["ds0.t050"]
+        with self.assertRaises(Exception):
+            self.controller.restore_plan(self.path)
+        # plan of the others is written
+        with RestorePlanReader(self.path) as reader:
+            self.assertEqual(10, len(list(reader.iter_updates())))
+
+    def test_apply_plan_of_other_project(self):
+        self.controller.restore_plan(self.path)
+        self.bq.project = "other"
+        with self.assertRaises(Exception):
+            self.controller.restore_apply(self.path)
+        self.assertEqual(0, self.bq.num_of_apply)
+
+
 if __name__ == '__main__':
     unittest.main(warnings='ignore')
+
+
+class TestControllerWithMetrics(unittest.TestCase):
+
+    def test_with_metrics(self):
+        root = Controller(config=config, logger=logger, bigquery=Bigquery(config=config, logger=logger, client=object()),
+                          firestore=StandInFirestore())
+        metrics_list = [Metrics(), Metrics()]
+        controller_list = [root.with_metrics(metrics) for metrics in metrics_list]
+        for controller, metrics in zip(controller_list, metrics_list):
+            # calls of each request are recorded to its own metrics, with the clients of root
+            self.assertIs(metrics, controller.bigquery.metrics)
+            self.assertIs(metrics, controller.firestore.metrics)
+            self.assertIs(root.bigquery.client, controller.bigquery.client)
+            self.assertIs(root.bigquery.rate_limiter, controller.bigquery.rate_limiter)
+            self.assertIs(controller, controller.for_project(config.gcp_project))
+        self.assertIs(root, root.with_metrics(root.metrics))
+
+
+class OldConfig(object):
+    """
+    config.py made from the sample of the first release, without keys added after that.
+    """
+    loglevel = "info"
+    gcp_project = config.gcp_project
+    gcp_use_key_json = False
+    gcp_key_json = "/path/to/json"
+    firesotre_dataset_desc_collection_name = "dataset"
+    firestore_table_desc_collection_name = "table"
+    dataset_include_pattern = r'.*'
+    dataset_exclude_pattern = r'^$'
+    table_include_pattern = r'.*'
+    table_exclude_pattern = r'^$'
+    enable_slack_notify = False
+    slack_incomming_webhook_url = "https://hooks.slack.com/services/xxxxx"
+    ignore_dataset_not_found_error_when_restore = False
+    ignore_table_not_found_error_when_restore = False
+
+
+class TestOldConfigWithStandIn(unittest.TestCase):
+
+    def test_backup_all(self):
+        firestore = StandInFirestore()
+        controller = Controller(config=OldConfig, logger=logger, firestore=firestore,
+                                bigquery=StandInBigquery(num_of_dataset=2, num_of_table=10, get_sec=0))
+        result_type_counter, is_finished = controller._backup_all_resumable()
+        self.assertTrue(is_finished)
+        self.assertEqual(2 + 2 * 10, result_type_counter["ok"])
+
+    def test_restore_all(self):
+        firestore = StandInRestoreFirestore({"ds0": "ds0 desc", "ds0.t000": "t000 desc"})
+        bq = StandInRestoreBigquery({"ds0": "old", "ds0.t000": "old"})
+        controller = Controller(config=OldConfig, logger=logger, bigquery=bq, firestore=firestore)
+        self.assertEqual(2, ast.literal_eval(controller.restore_all())["update"])
+
+    def test_bigquery(self):
+        bq = Bigquery(config=OldConfig, logger=logger, client=object())
+        self.assertEqual(50, bq.rate_limiter.rate_per_sec)
+        self.assertEqual(32, bq.rate_limiter.max_concurrency)
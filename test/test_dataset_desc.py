@@ -34,6 +34,16 @@ class TestDatasetDesc(unittest.TestCase):
         self.assertTrue(dataset_dict.is_no_description())
         self.assertEqual('', dataset_dict.description)
 
+    def test_content_hash(self):
+        dataset_dict = {
+            'description': 'dataset desc',
+            'datasetReference': {"projectId": "a", "datasetId": "b"}
+        }
+        dataset_desc = DatasetDesc(dataset_dict)
+        self.assertEqual(dataset_desc.content_hash(), DatasetDesc(dict(dataset_dict)).content_hash())
+        self.assertNotEqual(dataset_desc.content_hash(),
+                            DatasetDesc(dict(dataset_dict, description='dataset desc 2')).content_hash())
+
 
 if __name__ == '__main__':
     unittest.main(warnings='ignore')
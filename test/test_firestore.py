@@ -1,10 +1,16 @@
+import copy
 import datetime
+import threading
+import time
 import unittest
 
+from google.cloud import firestore
+
 from init import config, logger, ignore_warnings
 
 from lib.dataset_desc import DatasetDesc
-from lib.firestore import Firestore
+from lib.firestore import Firestore, FirestoreBatchWriter
+from lib.metrics import Metrics
 from lib.table_desc import TableDesc
 
 TEST_DS = "test_bqdesc_buckuper"
@@ -37,6 +43,58 @@ class TestFireStore(unittest.TestCase):
         ret = self.db.get_dataset_desc(TEST_DS)
         self.assertEqual(rand_desc, ret.description)
 
+    @ignore_warnings
+    def test_table_put_get_with_batch_writer(self):
+        rand_desc = "{0}".format(datetime.datetime.now())
+        table_dict = {
+            'description': rand_desc,
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': rand_desc}]},
+            'tableReference': {'projectId': 'a', 'datasetId': TEST_DS, 'tableId': TEST_TABLE}
+        }
+        table_desc = TableDesc(in_dict=table_dict)
+        error_list = []
+        with self.db.batch_writer() as writer:
+            self.db.put_table_desc(TEST_DS, TEST_TABLE, table_desc, writer=writer, on_done=error_list.append)
+        self.assertEqual([None], error_list)
+        ret = self.db.get_table_desc(TEST_DS, TEST_TABLE)
+        self.assertEqual(rand_desc, ret.description)
+
+    @ignore_warnings
+    def test_get_table_doc_field_dict_of_datasets(self):
+        table_desc = TableDesc(in_dict={
+            'description': "a", 'schema': {'fields': []},
+            'tableReference': {'projectId': 'a', 'datasetId': TEST_DS, 'tableId': TEST_TABLE}})
+        self.db.put_table_desc(TEST_DS, TEST_TABLE, table_desc)
+        ret = self.db.get_all_table_doc_field_dict(["content_hash"], dataset_id_list=[TEST_DS])
+        self.assertEqual(table_desc.content_hash(), ret[f"{TEST_DS}.{TEST_TABLE}"]["content_hash"])
+        self.assertTrue(all(document_id.startswith(TEST_DS + ".") for document_id in ret.keys()))
+        self.assertEqual({}, self.db.get_all_table_doc_field_dict(["content_hash"], dataset_id_list=[]))
+
+    @ignore_warnings
+    def test_iter_all_table_desc(self):
+        table_dict = {
+            'description': "{0}".format(datetime.datetime.now()),
+            'schema': {'fields': []},
+            'tableReference': {'projectId': 'a', 'datasetId': TEST_DS, 'tableId': TEST_TABLE}
+        }
+        self.db.put_table_desc(TEST_DS, TEST_TABLE, TableDesc(in_dict=table_dict))
+        # page_size=1 reads documents with cursor one by one
+        id_list = [f"{t.dataset_id}.{t.table_id}" for t in self.db.iter_all_table_desc(page_size=1)]
+        self.assertIn(f"{TEST_DS}.{TEST_TABLE}", id_list)
+        self.assertEqual(sorted(id_list), id_list)
+        self.assertEqual(len(id_list), len(set(id_list)))
+
+    @ignore_warnings
+    def test_for_project(self):
+        self.assertIs(self.db, self.db.for_project(config.gcp_project))
+        other_db = self.db.for_project("other-project")
+        self.assertEqual(config.firestore_table_desc_collection_name + "-other-project", other_db.table_desc_col)
+        rand_desc = "{0}".format(datetime.datetime.now())
+        other_db.put_dataset_desc(TEST_DS, DatasetDesc(
+            in_dict={'description': rand_desc, 'datasetReference': {'projectId': 'other-project', 'datasetId': TEST_DS}}))
+        self.assertEqual(rand_desc, other_db.get_dataset_desc(TEST_DS).description)
+        self.assertNotEqual(rand_desc, self.db.get_dataset_desc(TEST_DS).description)
+
     @ignore_warnings
     def test_snapshot_for_table_desc(self):
         TR = {'projectId': 'a', 'datasetId': TEST_DS, 'tableId': TEST_TABLE}
@@ -85,9 +143,323 @@ class TestFireStore(unittest.TestCase):
         # check
         self.assertEqual(rand_desc1, self.db.get_dataset_desc(TEST_DS).description)
 
+    @ignore_warnings
+    def test_delta_snapshot_for_table_desc(self):
+        TR = {'projectId': 'a', 'datasetId': TEST_DS, 'tableId': TEST_TABLE}
+        rand_desc1 = "{0}".format(datetime.datetime.now())
+        self.db.put_table_desc(TEST_DS, TEST_TABLE, TableDesc(
+            in_dict={'description': rand_desc1, 'schema': {'fields': []}, 'tableReference': TR}))
+        # full snapshot if no previous snapshot, otherwise delta snapshot with changed documents
+        ymd = self.db.make_db_snapshot(mode="delta")
+        rand_desc2 = "{0}".format(datetime.datetime.now())
+        self.db.put_table_desc(TEST_DS, TEST_TABLE, TableDesc(
+            in_dict={'description': rand_desc2, 'schema': {'fields': []}, 'tableReference': TR}))
+        self.db.recover_table_from_snapshot(TEST_DS, TEST_TABLE, ymd)
+        self.assertEqual(rand_desc1, self.db.get_table_desc(TEST_DS, TEST_TABLE).description)
+        with self.assertRaises(Exception):
+            self.db.recover_table_from_snapshot(TEST_DS, "not_exist_table", ymd)
+
     @ignore_warnings
     def test_list_snapshot(self):
-        self.db.list_db_snapshot()
+        ymd = self.db.make_db_snapshot()
+        # listing reads only the registry document
+        self.db.firestore_client.collections = None
+        entry = self.db.list_db_snapshot()[-1]
+        self.assertEqual(ymd, entry["id"])
+        self.assertEqual("full", entry["type"])
+        self.assertEqual([config.firestore_table_desc_collection_name,
+                          config.firesotre_dataset_desc_collection_name],
+                         [c["source"] for c in entry["collections"]])
+        self.assertGreater(entry["num_of_bytes"], 0)
+
+    @ignore_warnings
+    def test_list_snapshot_made_before_registry(self):
+        self.db.make_db_snapshot()
+        # snapshot collection made by old version, which is not in registry
+        old_col = config.firestore_table_desc_collection_name + "-19990101"
+        self.db.firestore_client.collection(old_col).document("a.b").set({"description": "old"})
+        try:
+            self.assertNotIn("19990101", [entry["id"] for entry in self.db.list_db_snapshot()])
+            self.db.migrate_snapshot_registry()
+            entry_list = self.db.list_db_snapshot()
+            self.assertEqual({"id": "19990101", "type": "full", "parent": None, "chain_length": 1}, entry_list[0])
+            self.assertIn("created_at", entry_list[-1])
+        finally:
+            self.db.firestore_client.collection(old_col).document("a.b").delete()
+            self.db.snapshot_registry_ref.update({"snapshots.19990101": firestore.DELETE_FIELD})
+
+
+class StandInBatch(object):
+    def __init__(self, committed_list):
+        self.committed_list = committed_list
+        self.write_list = []
+
+    def set(self, doc_ref, dic):
+        self.write_list.append(("set", doc_ref, dic))
+
+    def update(self, doc_ref, dic):
+        self.write_list.append(("update", doc_ref, dic))
+
+    def delete(self, doc_ref):
+        self.write_list.append(("delete", doc_ref, None))
+
+    def commit(self):
+        self.committed_list.append(self.write_list)
+
+
+class StandInFirestoreClient(object):
+    def __init__(self):
+        self.committed_list = []
+
+    def batch(self):
+        return StandInBatch(self.committed_list)
+
+
+class StandInDocumentBatch(object):
+    def __init__(self, client):
+        self.client = client
+        self.write_list = []
+
+    def set(self, doc_ref, dic):
+        self.write_list.append(("set", doc_ref, dic))
+
+    def delete(self, doc_ref):
+        self.write_list.append(("delete", doc_ref, None))
+
+    def commit(self):
+        with self.client.lock:
+            for op, doc_ref, dic in self.write_list:
+                self.client.batch_write_list.append((op, doc_ref.col, doc_ref.id))
+                if op == "set":
+                    doc_ref.set(dic)
+                else:
+                    doc_ref.delete()
+
+
+class StandInPartition(object):
+    def __init__(self, client, doc_snapshot_list):
+        self.client = client
+        self.doc_snapshot_list = doc_snapshot_list
+
+    def query(self):
+        return self
+
+    def stream(self, read_time=None):
+        self.client.read_time_list.append(read_time)
+        return iter(self.doc_snapshot_list)
+
+
+class StandInCollectionGroup(object):
+    def __init__(self, client, col):
+        self.client = client
+        self.col = col
+
+    def get_partitions(self, partition_count, read_time=None):
+        self.client.read_time_list.append(read_time)
+        # documents of top-level collection and sub collections which have the same name
+        doc_snapshot_list = [StandInDocumentSnapshot(StandInDocumentReference(self.client, self.col, doc_id), data)
+                             for doc_id, data in sorted(self.client.store.get(self.col, {}).items())]
+        doc_snapshot_list += [StandInDocumentSnapshot(
+            StandInSubDocumentReference(self.client, parent_doc_ref, self.col, doc_id), data)
+            for parent_doc_ref, doc_id, data in self.client.sub_store.get(self.col, [])]
+        doc_snapshot_list.sort(key=lambda doc_snp: doc_snp.id)
+        size = -(-len(doc_snapshot_list) // partition_count) or 1
+        for i in range(0, max(len(doc_snapshot_list), 1), size):
+            yield StandInPartition(self.client, doc_snapshot_list[i:i + size])
+
+
+class StandInDocumentSnapshot(object):
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self.data)
+
+
+class StandInDocumentReference(object):
+    def __init__(self, client, col, document_id):
+        self.client = client
+        self.col = col
+        self.id = document_id
+
+    def get(self):
+        return StandInDocumentSnapshot(self, self.client.store.get(self.col, {}).get(self.id))
+
+    def set(self, dic, merge=False):
+        col_dict = self.client.store.setdefault(self.col, {})
+        if merge and self.id in col_dict:
+            merge_dict(col_dict[self.id], copy.deepcopy(dic))
+        else:
+            col_dict[self.id] = copy.deepcopy(dic)
+
+    def delete(self):
+        self.client.store.get(self.col, {}).pop(self.id, None)
+
+    @property
+    def parent(self):
+        return StandInCollectionReference(self.client, self.col)
+
+
+class StandInSubDocumentReference(object):
+    def __init__(self, client, parent_doc_ref, col, document_id):
+        self.client = client
+        self.parent = StandInCollectionReference(client, col, parent=parent_doc_ref)
+        self.id = document_id
+
+
+class StandInCollectionReference(object):
+    def __init__(self, client, col, parent=None):
+        self.client = client
+        self.id = col
+        self.parent = parent
+
+    def document(self, document_id):
+        return StandInDocumentReference(self.client, self.id, document_id)
+
+
+class StandInDocumentClient(object):
+    """
+    In-memory stand-in of firestore.Client. Documents of sub collections are only read by collection group.
+    Records calls of collections(), read_time of partition queries and batch writes.
+    """
+
+    def __init__(self):
+        self.store = {}
+        # {col: [(parent document reference, document id, data)]}
+        self.sub_store = {}
+        self.lock = threading.Lock()
+        self.num_of_collections_call = 0
+        self.read_time_list = []
+        self.batch_write_list = []
+
+    def collection(self, col):
+        return StandInCollectionReference(self, col)
+
+    def collection_group(self, col):
+        return StandInCollectionGroup(self, col)
+
+    def batch(self):
+        return StandInDocumentBatch(self)
+
+    def collections(self):
+        self.num_of_collections_call += 1
+        return [StandInCollectionReference(self, col) for col in sorted(self.store.keys()) if self.store[col]]
+
+
+def merge_dict(base, dic):
+    for key, value in dic.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_dict(base[key], value)
+        else:
+            base[key] = value
+
+
+class TestSnapshotRegistryWithStandIn(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StandInDocumentClient()
+        self.db = Firestore(config, logger, client=self.client)
+        self.table_desc_col = config.firestore_table_desc_collection_name
+        # snapshot collections made before the registry
+        for ymd in ["20191218", "20191219"]:
+            self.client.collection(f"{self.table_desc_col}-{ymd}").document("a.b").set({"description": "old"})
+        self.client.collection(f"{self.table_desc_col}-other").document("a.b").set({"description": "other"})
+
+    def test_registry_is_migrated_once(self):
+        self.assertEqual(["20191218", "20191219"], [entry["id"] for entry in self.db.list_db_snapshot()])
+        self.assertEqual("full", self.db.list_db_snapshot()[0]["type"])
+        # the registry document was made by the first read. Collections are not scanned again.
+        self.assertEqual(1, self.client.num_of_collections_call)
+
+    def test_migrate_without_legacy_snapshot(self):
+        db = Firestore(config, logger, client=StandInDocumentClient())
+        self.assertEqual([], db.list_db_snapshot())
+        self.assertEqual([], db.list_db_snapshot())
+        self.assertEqual(1, db.firestore_client.num_of_collections_call)
+
+    def test_migrate_keeps_registered_snapshot(self):
+        entry = {"id": "20191219", "type": "delta", "parent": "20191218", "chain_length": 2}
+        self.db.snapshot_registry_ref.set({"snapshots": {"20191219": entry}})
+        self.client.collection(f"{self.table_desc_col}-20191220").document("a.b").set({"description": "old"})
+        # registry exists, so old snapshots are not listed until migrated
+        self.assertEqual([entry], self.db.list_db_snapshot())
+        self.db.migrate_snapshot_registry()
+        self.assertEqual([{"id": "20191218", "type": "full", "parent": None, "chain_length": 1}, entry,
+                          {"id": "20191220", "type": "full", "parent": None, "chain_length": 1}],
+                         self.db.list_db_snapshot())
+
+
+class TestCopyCollectionWithStandIn(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StandInDocumentClient()
+        self.db = Firestore(config, logger, client=self.client)
+
+    def test_copy_all_documents_once(self):
+        for i in range(25):
+            self.client.collection("src").document(f"ds.t{i:02}").set({"description": f"table {i}"})
+        parent_doc_ref = self.client.collection("other").document("x")
+        self.client.sub_store["src"] = [(parent_doc_ref, "ds.t00", {"description": "sub collection"}),
+                                        (parent_doc_ref, "ds.sub", {"description": "sub collection"})]
+        num_of_docs, num_of_bytes = self.db._copy_collection("src", "dst")
+        self.assertEqual(25, num_of_docs)
+        self.assertGreater(num_of_bytes, 0)
+        # each document is written once, and documents of sub collections are not copied
+        self.assertEqual([("set", "dst", f"ds.t{i:02}") for i in range(25)], sorted(self.client.batch_write_list))
+        self.assertEqual(self.client.store["src"], self.client.store["dst"])
+        # partitions are listed and streamed as of the same read_time
+        self.assertEqual(1, len(set(self.client.read_time_list)))
+        self.assertIsNotNone(self.client.read_time_list[0])
+
+    def test_copy_empty_collection(self):
+        self.assertEqual((0, 0), self.db._copy_collection("src", "dst"))
+        self.assertNotIn("dst", self.client.store)
+
+
+class TestForProjectWithStandIn(unittest.TestCase):
+
+    def test_for_project(self):
+        db = Firestore(config, logger, client=StandInDocumentClient())
+        other = db.for_project("other-project")
+        self.assertEqual(f"{config.firestore_table_desc_collection_name}-other-project", other.table_desc_col)
+        self.assertEqual(f"{config.firesotre_dataset_desc_collection_name}-other-project", other.dataset_desc_col)
+        self.assertIs(other, other.for_project("other-project"))
+        self.assertEqual(db.table_desc_col, other.for_project(config.gcp_project).table_desc_col)
+        self.assertIs(db, db.for_project(config.gcp_project))
+
+    def test_with_metrics(self):
+        db = Firestore(config, logger, client=StandInDocumentClient())
+        metrics = Metrics()
+        other = db.with_metrics(metrics)
+        self.assertIs(metrics, other.metrics)
+        self.assertIsNot(metrics, db.metrics)
+        self.assertIs(db.firestore_client, other.firestore_client)
+        self.assertIs(metrics, other.batch_writer().metrics)
+
+
+class TestFirestoreBatchWriter(unittest.TestCase):
+    def test_batch_size(self):
+        client = StandInFirestoreClient()
+        with FirestoreBatchWriter(client, logger, batch_size=2, flush_interval_sec=60) as writer:
+            writer.set("a", {"x": 1})
+            writer.update("b", {"x": 2})
+            writer.delete("c")
+            self.assertEqual([[("set", "a", {"x": 1}), ("update", "b", {"x": 2})]], client.committed_list)
+        self.assertEqual([("delete", "c", None)], client.committed_list[1])
+
+    def test_flush_interval_without_more_write(self):
+        client = StandInFirestoreClient()
+        done = threading.Event()
+        with FirestoreBatchWriter(client, logger, flush_interval_sec=0.1) as writer:
+            writer.set("a", {"x": 1}, on_done=lambda error: done.set())
+            # committed by the background thread while nothing else is queued
+            self.assertTrue(done.wait(2))
+            self.assertEqual([[("set", "a", {"x": 1})]], client.committed_list)
+            time.sleep(0.2)
+        self.assertEqual(1, len(client.committed_list))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,150 @@
+import json
+import unittest
+
+from lib.metrics import LATENCY_BUCKET_SEC, Histogram, Metrics, timed, to_openmetrics
+
+
+class StandInClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StandInDesc(object):
+    def __init__(self, dataset_id, table_id):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+
+class StandInClient(object):
+    def __init__(self, metrics, clock, sec):
+        self.metrics = metrics
+        self.clock = clock
+        self.sec = sec
+
+    @timed("client.get")
+    def get(self, dataset_id, table_id=None):
+        self.clock.now += self.sec
+        return f"{dataset_id}.{table_id}"
+
+    @timed("client.update")
+    def update(self, desc, fail=False):
+        self.clock.now += self.sec
+        if fail:
+            raise KeyError(desc.table_id)
+
+    @timed("client.list")
+    def list(self):
+        return []
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram()
+        for sec in [0.001, 0.005, 0.02, 100]:
+            histogram.observe(sec)
+        histogram.observe(0.3, is_error=True)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.error_count, 1)
+        self.assertAlmostEqual(histogram.sum_sec, 100.326)
+        self.assertEqual(histogram.max_sec, 100)
+        # upper bound is inclusive
+        self.assertEqual(histogram.bucket_count_list[0], 2)
+        self.assertEqual(histogram.bucket_count_list[LATENCY_BUCKET_SEC.index(0.025)], 1)
+        self.assertEqual(histogram.bucket_count_list[LATENCY_BUCKET_SEC.index(0.5)], 1)
+        self.assertEqual(histogram.bucket_count_list[-1], 1)
+
+    def test_quantile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.quantile(0.5), 0.0)
+        for _ in range(100):
+            histogram.observe(0.2)
+        # interpolated in (0.1, 0.25], capped by max
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.175)
+        self.assertAlmostEqual(histogram.quantile(0.99), 0.2)
+        histogram.observe(90)
+        self.assertEqual(histogram.quantile(1.0), 90)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = StandInClock()
+        self.metrics = Metrics(clock=self.clock)
+        self.metrics.start("backup all")
+        self.client = StandInClient(self.metrics, self.clock, sec=0.02)
+
+    def test_timed(self):
+        self.assertEqual(self.client.get("ds1", "t1"), "ds1.t1")
+        self.client.get(dataset_id="ds1", table_id="t2")
+        self.client.update(StandInDesc("ds2", "t1"))
+        with self.assertRaises(KeyError):
+            self.client.update(StandInDesc("ds2", "t2"), fail=True)
+        self.client.list()
+
+        report = self.metrics.report()
+        self.assertEqual(report["action"], "backup all")
+        self.assertAlmostEqual(report["elapsed_sec"], 0.08)
+        self.assertEqual(report["operations"]["client.get"]["count"], 2)
+        self.assertAlmostEqual(report["operations"]["client.get"]["sum_sec"], 0.04)
+        self.assertEqual(report["operations"]["client.update"]["errors"], 1)
+        self.assertEqual(report["operations"]["client.update"]["error_types"], {"KeyError": 1})
+        self.assertEqual(report["operations"]["client.list"]["count"], 1)
+        self.assertEqual(set(report["datasets"].keys()), {"ds1", "ds2"})
+        self.assertEqual(report["datasets"]["ds1"]["client.get"]["count"], 2)
+        self.assertEqual(report["datasets"]["ds2"]["client.update"], {"count": 2, "errors": 1, "sum_sec": 0.04,
+                                                                     "max_sec": 0.02})
+        # serializable as it is
+        json.dumps(report)
+
+    def test_span_listener(self):
+        span_list = []
+
+        def listener(op, start, end, dataset_id, table_id, error):
+            span_list.append((op, start, end, dataset_id, table_id, type(error).__name__ if error else None))
+
+        self.metrics.add_span_listener(listener)
+        self.client.get("ds1", "t1")
+        with self.assertRaises(KeyError):
+            self.client.update(StandInDesc("ds2", "t2"), fail=True)
+        self.metrics.remove_span_listener(listener)
+        self.client.get("ds1", "t3")
+        self.assertEqual(span_list, [("client.get", 0.0, 0.02, "ds1", "t1", None),
+                                     ("client.update", 0.02, 0.04, "ds2", "t2", "KeyError")])
+
+    def test_start_resets(self):
+        self.client.get("ds1")
+        self.clock.now = 10
+        self.metrics.start("restore all")
+        report = self.metrics.report(status="ok")
+        self.assertEqual(report["action"], "restore all")
+        self.assertEqual(report["status"], "ok")
+        self.assertEqual(report["elapsed_sec"], 0)
+        self.assertEqual(report["operations"], {})
+        self.assertEqual(report["datasets"], {})
+
+    def test_to_openmetrics(self):
+        self.client.get("ds1", "t1")
+        self.client.get('d"s', "t1")
+        text = to_openmetrics(self.metrics.report())
+        line_list = text.splitlines()
+        self.assertEqual(line_list[-1], "# EOF")
+        self.assertIn("# TYPE bqdesc_call_latency_seconds histogram", line_list)
+        # buckets are cumulative
+        self.assertIn('bqdesc_call_latency_seconds_bucket{action="backup all",op="client.get",le="0.01"} 0',
+                      line_list)
+        self.assertIn('bqdesc_call_latency_seconds_bucket{action="backup all",op="client.get",le="0.025"} 2',
+                      line_list)
+        self.assertIn('bqdesc_call_latency_seconds_bucket{action="backup all",op="client.get",le="+Inf"} 2',
+                      line_list)
+        self.assertIn('bqdesc_call_latency_seconds_count{action="backup all",op="client.get"} 2', line_list)
+        self.assertIn('bqdesc_dataset_calls_total{action="backup all",op="client.get",dataset="d\\"s"} 1',
+                      line_list)
+        self.assertIn('bqdesc_action_duration_seconds{action="backup all"} 0.04', line_list)
+
+
+if __name__ == "__main__":
+    unittest.main()
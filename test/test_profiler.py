@@ -0,0 +1,83 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.metrics import Metrics, timed
+from lib.profiler import Profiler
+
+
+def busy_in_worker(n):
+    return sum(i * i for i in range(n))
+
+
+class StandInClient(object):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @timed("bigquery.get_table_desc")
+    def get_table_desc(self, dataset_id, table_id):
+        return busy_in_worker(10000)
+
+    @timed("firestore.put_table_desc")
+    def put_table_desc(self, dataset_id, table_id, fail=False):
+        if fail:
+            raise ValueError(table_id)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp_dir, "profile")
+        self.metrics = Metrics()
+        self.client = StandInClient(self.metrics)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_action(self):
+        profiler = Profiler(self.metrics)
+        profiler.start()
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="worker") as executor:
+            for future in [executor.submit(self.client.get_table_desc, "ds1", f"t{i}") for i in range(4)]:
+                future.result()
+        self.client.put_table_desc("ds1", "t0")
+        with self.assertRaises(ValueError):
+            self.client.put_table_desc(dataset_id="ds1", table_id="t1", fail=True)
+        profiler.stop()
+        # spans after stop are not recorded
+        self.client.put_table_desc("ds1", "t2")
+        return profiler.write(self.prefix)
+
+    def test_cpu_profile_of_worker_threads(self):
+        pstats_path, _ = self.run_action()
+        stats = pstats.Stats(pstats_path)
+        function_name_set = {function_name for _, _, function_name in stats.stats.keys()}
+        # worker threads and the main thread
+        self.assertIn("busy_in_worker", function_name_set)
+        self.assertIn("submit", function_name_set)
+
+    def test_timeline(self):
+        _, trace_path = self.run_action()
+        with open(trace_path) as f:
+            trace = json.load(f)
+        event_list = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(len(event_list), 6)
+        get_event_list = [e for e in event_list if e["name"] == "bigquery.get_table_desc"]
+        self.assertEqual(sorted(e["args"]["table"] for e in get_event_list), ["t0", "t1", "t2", "t3"])
+        self.assertTrue(all(e["cat"] == "bigquery" and e["args"]["dataset"] == "ds1" for e in get_event_list))
+        self.assertTrue(all(e["ts"] >= 0 and e["dur"] > 0 for e in get_event_list))
+        put_event_list = [e for e in event_list if e["name"] == "firestore.put_table_desc"]
+        self.assertEqual([e["args"] for e in put_event_list],
+                         [{"dataset": "ds1", "table": "t0"}, {"dataset": "ds1", "table": "t1", "error": True}])
+        # a row per thread, with its name
+        thread_name_dict = {e["tid"]: e["args"]["name"] for e in trace["traceEvents"] if e["ph"] == "M"}
+        self.assertEqual({thread_name_dict[e["tid"]].startswith("worker") for e in get_event_list}, {True})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+from lib.rate_limiter import RateLimiter
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after=0):
+        self.retry_after = retry_after
+
+
+def throttle_of(e):
+    return e.retry_after if isinstance(e, Throttled) else None
+
+
+class StandInClock(object):
+    """
+    Clock which advances only by sleep.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleep_list = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleep_list.append(sec)
+        self.now += sec
+
+
+class FailTimes(object):
+    def __init__(self, error_list):
+        self.error_list = list(error_list)
+        self.num_of_calls = 0
+
+    def __call__(self):
+        self.num_of_calls += 1
+        if self.error_list:
+            raise self.error_list.pop(0)
+        return "ok"
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def make_limiter(self, **kwargs):
+        self.clock = StandInClock()
+        return RateLimiter(throttle_of, clock=self.clock.clock, sleep=self.clock.sleep, rand=lambda: 0.5, **kwargs)
+
+    def test_token_bucket(self):
+        limiter = self.make_limiter(rate_per_sec=10, burst=5)
+        for _ in range(25):
+            limiter.call("op", lambda: None)
+        # 5 by burst, and 20 at 10 per sec
+        self.assertAlmostEqual(2.0, self.clock.now)
+        self.assertAlmostEqual(2.0, limiter.stats()["rate_wait_sec"])
+
+    def test_no_rate_limit(self):
+        limiter = self.make_limiter(rate_per_sec=0)
+        for _ in range(100):
+            limiter.call("op", lambda: None)
+        self.assertEqual(0, self.clock.now)
+        self.assertEqual(100, limiter.stats()["calls"])
+
+    def test_backoff(self):
+        limiter = self.make_limiter(base_backoff_sec=1.0, max_retry=5)
+        func = FailTimes([Throttled(), Throttled(), Throttled()])
+        self.assertEqual("ok", limiter.call("get_table", func))
+        self.assertEqual(4, func.num_of_calls)
+        # full jitter. rand() = 0.5 of 1, 2, 4 sec
+        self.assertEqual([0.5, 1.0, 2.0], self.clock.sleep_list)
+        stats = limiter.stats()
+        self.assertEqual(3, stats["throttled"])
+        self.assertEqual({"get_table": 3}, stats["throttled_by_op"])
+        self.assertAlmostEqual(3.5, stats["backoff_sec"])
+
+    def test_retry_after(self):
+        limiter = self.make_limiter(base_backoff_sec=1.0)
+        limiter.call("op", FailTimes([Throttled(retry_after=10)]))
+        self.assertEqual([10.5], self.clock.sleep_list)
+
+    def test_give_up(self):
+        limiter = self.make_limiter(max_retry=2)
+        func = FailTimes([Throttled()] * 10)
+        with self.assertRaises(Throttled):
+            limiter.call("op", func)
+        self.assertEqual(3, func.num_of_calls)
+        self.assertEqual(1, limiter.stats()["gave_up"])
+
+    def test_other_error_is_not_retried(self):
+        limiter = self.make_limiter()
+        func = FailTimes([ValueError("not throttling")])
+        with self.assertRaises(ValueError):
+            limiter.call("op", func)
+        self.assertEqual(1, func.num_of_calls)
+        self.assertEqual(0, limiter.stats()["throttled"])
+
+    def test_aimd(self):
+        limiter = self.make_limiter(max_concurrency=16, min_concurrency=2)
+        limiter.call("op", FailTimes([Throttled()]))
+        self.assertEqual(8, limiter.stats()["concurrency_limit"])
+        limiter.call("op", FailTimes([Throttled(), Throttled(), Throttled()]))
+        self.assertEqual(2, limiter.stats()["concurrency_limit"])
+        self.assertEqual(2, limiter.stats()["min_concurrency_limit"])
+        # additive increase. +1 after as many successes as the limit
+        for _ in range(2 + 3):
+            limiter.call("op", lambda: None)
+        self.assertEqual(4, limiter.stats()["concurrency_limit"])
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
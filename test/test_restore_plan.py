@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.restore_plan import RestorePlanReader, RestorePlanWriter
+from lib.snapshot_file import KIND_DATASET, KIND_TABLE
+
+
+class TestRestorePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "plan.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_table_update(self, i):
+        return {"dataset_id": "ds", "table_id": f"t{i}", "etag": f"etag{i}", "description": f"日本語 {i}",
+                "fields": [{"name": "col1", "type": "STRING", "description": f"col1 {i}"}],
+                "diff": f"table desc: old -> 日本語 {i}"}
+
+    def test_write_and_read(self):
+        dataset_update = {"dataset_id": "ds", "etag": "etag", "description": "new", "diff": "old -> new"}
+        with RestorePlanWriter(self.path, project="a", table_desc_col="table") as writer:
+            writer.write(KIND_DATASET, dataset_update)
+            for i in range(3):
+                writer.write(KIND_TABLE, self.make_table_update(i))
+        self.assertEqual({KIND_TABLE: 3, KIND_DATASET: 1}, writer.num_of_updates)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        with RestorePlanReader(self.path) as reader:
+            self.assertEqual("a", reader.header["project"])
+            self.assertEqual("table", reader.header["table_desc_col"])
+            self.assertIn("created_at", reader.header)
+            self.assertEqual([(KIND_DATASET, dataset_update)] + [(KIND_TABLE, self.make_table_update(i))
+                                                                 for i in range(3)],
+                             list(reader.iter_updates()))
+
+    def test_empty_plan(self):
+        with RestorePlanWriter(self.path, project="a"):
+            pass
+        with RestorePlanReader(self.path) as reader:
+            self.assertEqual([], list(reader.iter_updates()))
+
+    def test_abort_on_exception(self):
+        with RestorePlanWriter(self.path, project="a") as writer:
+            writer.write(KIND_TABLE, self.make_table_update(0))
+        with self.assertRaises(ValueError):
+            with RestorePlanWriter(self.path, project="b") as writer:
+                writer.write(KIND_TABLE, self.make_table_update(1))
+                raise ValueError()
+        # previous plan is kept as it is
+        self.assertEqual(["plan.jsonl"], os.listdir(self.tmp_dir))
+        with RestorePlanReader(self.path) as reader:
+            self.assertEqual("a", reader.header["project"])
+            self.assertEqual([(KIND_TABLE, self.make_table_update(0))], list(reader.iter_updates()))
+
+    def test_not_a_plan(self):
+        with open(self.path, "w") as f:
+            f.write('{"version": 999}\n')
+        with self.assertRaises(Exception):
+            RestorePlanReader(self.path)
+        with open(self.path, "w") as f:
+            f.write("not json\n")
+        with self.assertRaises(Exception):
+            RestorePlanReader(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from lib.selector import Selector, shard_of
+
+
+class TestSelector(unittest.TestCase):
+
+    def test_default(self):
+        selector = Selector()
+        self.assertTrue(selector.match("any_id"))
+        self.assertIsNone(selector.label_filter())
+        self.assertFalse(selector.has_label_rule())
+
+    def test_pattern(self):
+        selector = Selector(r'^(dwh_|raw_)', r'_tmp$')
+        self.assertTrue(selector.match("dwh_sales"))
+        self.assertFalse(selector.match("mart_sales"))
+        self.assertFalse(selector.match("raw_sales_tmp"))
+
+    def test_pattern_list(self):
+        selector = Selector([r'^dwh_', r'^raw_'], [r'_tmp$', r'^raw_secret'])
+        self.assertTrue(selector.match("dwh_sales"))
+        self.assertTrue(selector.match("raw_sales"))
+        self.assertFalse(selector.match("raw_secret_sales"))
+        self.assertFalse(selector.match("dwh_sales_tmp"))
+
+    def test_label(self):
+        selector = Selector(['labels.backup:true', 'labels.team'], ['labels.env:dev'])
+        self.assertTrue(selector.has_label_rule())
+        self.assertEqual("labels.backup:true labels.team", selector.label_filter())
+        # no include regexp, so any id
+        self.assertTrue(selector.match("ds", {"backup": "true", "team": "a"}))
+        self.assertFalse(selector.match("ds", {"backup": "true"}))
+        self.assertFalse(selector.match("ds", {"backup": "false", "team": "a"}))
+        self.assertFalse(selector.match("ds", {"backup": "true", "team": "a", "env": "dev"}))
+        self.assertFalse(selector.match("ds", None))
+
+    def test_pattern_and_label(self):
+        selector = Selector([r'^dwh_', 'labels.backup:true'])
+        self.assertTrue(selector.match("dwh_sales", {"backup": "true"}))
+        self.assertFalse(selector.match("raw_sales", {"backup": "true"}))
+        self.assertFalse(selector.match("dwh_sales", {}))
+
+    def test_invalid_label_rule(self):
+        with self.assertRaises(Exception):
+            Selector("labels.")
+
+    def test_shard_of(self):
+        # stable across processes
+        self.assertEqual(shard_of("dwh_sales", 8), shard_of("dwh_sales", 8))
+        self.assertEqual(3, shard_of("a", 4))
+        shard_list = [shard_of(f"ds{i}", 8) for i in range(1000)]
+        self.assertEqual(set(range(8)), set(shard_list))
+        self.assertLess(max(shard_list.count(i) for i in range(8)), 200)
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
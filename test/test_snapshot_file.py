@@ -0,0 +1,78 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from datetime import datetime, timezone
+
+from lib.snapshot_file import KIND_DATASET, KIND_TABLE, SnapshotFileReader, SnapshotFileWriter
+
+
+class TestSnapshotFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "snapshot.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_table_doc(self, i):
+        return {
+            'description': f'table desc {i}',
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': f'日本語 {i}'}]},
+            'tableReference': {'projectId': 'a', 'datasetId': 'ds', 'tableId': f't{i}'},
+            'created_at': datetime(2019, 12, 19, 10, 0, i, tzinfo=timezone.utc)
+        }
+
+    def test_write_and_get(self):
+        with SnapshotFileWriter(self.path) as writer:
+            for i in range(10):
+                writer.write(KIND_TABLE, f"ds.t{i}", self.make_table_doc(i))
+            writer.write(KIND_DATASET, "ds", {'description': 'ds desc',
+                                              'datasetReference': {'projectId': 'a', 'datasetId': 'ds'}})
+        self.assertTrue(os.path.exists(self.path + ".idx"))
+        with SnapshotFileReader(self.path) as reader:
+            self.assertEqual(self.make_table_doc(3), reader.get(KIND_TABLE, "ds.t3"))
+            self.assertEqual(self.make_table_doc(9), reader.get(KIND_TABLE, "ds.t9"))
+            self.assertEqual('ds desc', reader.get(KIND_DATASET, "ds")['description'])
+            self.assertEqual(10, len(reader.id_list(KIND_TABLE)))
+            with self.assertRaises(KeyError):
+                reader.get(KIND_TABLE, "ds.not_exist")
+            with self.assertRaises(KeyError):
+                reader.get(KIND_DATASET, "ds.t1")
+
+    def test_iter_records(self):
+        with SnapshotFileWriter(self.path) as writer:
+            writer.write(KIND_TABLE, "ds.t1", self.make_table_doc(1))
+            writer.write(KIND_DATASET, "ds", {'description': 'ds desc'})
+        with SnapshotFileReader(self.path) as reader:
+            self.assertEqual([(KIND_TABLE, "ds.t1", self.make_table_doc(1)),
+                              (KIND_DATASET, "ds", {'description': 'ds desc'})],
+                             list(reader.iter_records()))
+
+    def test_failed_export_leaves_nothing(self):
+        with self.assertRaises(ValueError):
+            with SnapshotFileWriter(self.path) as writer:
+                writer.write(KIND_TABLE, "ds.t0", self.make_table_doc(0))
+                raise ValueError("export failed midway")
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_not_snapshot_file(self):
+        with SnapshotFileWriter(self.path):
+            pass
+        for content in [b"not a snapshot", b""]:
+            with open(self.path, "wb") as f:
+                f.write(content)
+            with warnings.catch_warnings(record=True) as warning_list:
+                warnings.simplefilter("always", ResourceWarning)
+                with self.assertRaises(Exception):
+                    SnapshotFileReader(self.path)
+                gc.collect()
+            # the file is closed before raising
+            self.assertEqual([], [w for w in warning_list if issubclass(w.category, ResourceWarning)])
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -1,3 +1,4 @@
+import copy
 import unittest
 
 from lib.table_desc import TableDesc
@@ -43,6 +44,38 @@ class TestTableDesc(unittest.TestCase):
         self.assertEqual('', table_desc.description)
         self.assertEqual(0, len(table_desc.field_list))
 
+    def test_init_with_etag_and_last_modified_time(self):
+        table_dict = {
+            'description': 'table desc',
+            'schema': {'fields': []},
+            'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+        }
+        table_desc = TableDesc(dict(table_dict, etag='abc==', lastModifiedTime='1577804400000'))
+        self.assertEqual('abc==', table_desc.etag)
+        self.assertEqual('1577804400000', table_desc.last_modified_time)
+        self.assertEqual(table_dict, table_desc.to_dict())
+
+    def test_content_hash(self):
+        table_dict = {
+            'description': 'table desc',
+            'schema': {'fields': [{'name': 'col1', 'type': 'STRING', 'description': 'col1 desc'}]},
+            'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+        }
+        table_desc = TableDesc(table_dict)
+        # etag and lastModifiedTime do not affect hash
+        self.assertEqual(table_desc.content_hash(),
+                         TableDesc(dict(table_dict, etag='abc==', lastModifiedTime='1')).content_hash())
+        self.assertNotEqual(table_desc.content_hash(),
+                            TableDesc(dict(table_dict, description='table desc 2')).content_hash())
+        self.assertNotEqual(table_desc.content_hash(),
+                            TableDesc(dict(table_dict, schema={'fields': [
+                                {'name': 'col1', 'type': 'STRING', 'description': 'col1 desc 2'}]})).content_hash())
+        # attributes of fields other than name, type and description do not affect hash
+        self.assertEqual(table_desc.content_hash(),
+                         TableDesc(dict(table_dict, schema={'fields': [
+                             {'name': 'col1', 'type': 'STRING', 'description': 'col1 desc', 'mode': 'REQUIRED',
+                              'maxLength': '10'}]})).content_hash())
+
     def test_field_name_list(self):
         table_dict = {
             'description': 'table desc',
@@ -83,6 +116,53 @@ class TestTableDesc(unittest.TestCase):
         self.assertEqual('col2 desc 2', table_desc.field_list[1].description)
         self.assertEqual('col3 desc 1', table_desc.field_list[2].description)
 
+    def test_check_diff(self):
+        table_dict = {'description': 'table desc 1',
+                      'schema': {'fields': [
+                          {'name': 'col1', 'type': 'STRING', 'description': 'col1 desc 1'},
+                          {'name': 'col2', 'type': 'STRING', 'description': 'col2 desc 1'}
+                      ]},
+                      'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+                      }
+        table_dict_2 = {'description': 'table desc 1',
+                        'schema': {'fields': [
+                            {'name': 'col2', 'type': 'STRING', 'description': 'col2 desc 2'},
+                            {'name': 'col1', 'type': 'STRING', 'description': 'col1 desc 1'},
+                            {'name': 'col9', 'type': 'STRING', 'description': 'col9 desc 2'}
+                        ]},
+                        'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+                        }
+        self.assertEqual((True, ""), TableDesc(table_dict).check_diff(TableDesc(table_dict)))
+        self.assertEqual((False, "number of fields is different 2 != 3,"
+                                 "field(col2) description is defferent col2 desc 2 != col2 desc 1."),
+                         TableDesc(table_dict).check_diff(TableDesc(table_dict_2)))
+
+    def test_nested_fields(self):
+        table_dict = {
+            'description': 'table desc',
+            'schema': {'fields': [
+                {'name': 'col1', 'type': 'STRING', 'description': '', 'mode': 'REQUIRED'},
+                {'name': 'rec', 'type': 'RECORD', 'description': 'rec desc', 'mode': 'REPEATED', 'fields': [
+                    {'name': 'a', 'type': 'STRING', 'description': 'a desc'},
+                    {'name': 'sub', 'type': 'RECORD', 'description': '', 'fields': [
+                        {'name': 'b', 'type': 'INTEGER', 'description': 'b desc'}]}]}
+            ]},
+            'tableReference': {"projectId": "a", "datasetId": "b", "tableId": "c"}
+        }
+        table_desc = TableDesc(table_dict)
+        self.assertEqual(['col1', 'rec', 'rec.a', 'rec.sub', 'rec.sub.b'], list(table_desc.field_index.keys()))
+        self.assertEqual(3, table_desc.num_of_field_desc())
+        self.assertEqual(table_dict, table_desc.to_dict())
+
+        table_dict_2 = copy.deepcopy(table_dict)
+        table_dict_2['schema']['fields'][1]['fields'][1]['fields'][0]['description'] = 'b desc 2'
+        is_same, diff_msg = table_desc.check_diff(TableDesc(table_dict_2))
+        self.assertFalse(is_same)
+        self.assertEqual("field(rec.sub.b) description is defferent b desc 2 != b desc.", diff_msg)
+
+        table_desc.update_description(TableDesc(table_dict_2))
+        self.assertEqual(table_dict_2, table_desc.to_dict())
+
     # table descriptipnが指定されていない場合は "" が書かれているのと同義
     def test_update_description_only_table(self):
         table_dict = {'description': 'table desc 1',